@@ -0,0 +1,305 @@
+"""
+Load test of ChatConsumer in one process.
+
+Simulated users connect with channels' WebsocketCommunicator over an
+InMemoryChannelLayer, so the numbers cover the consumer's hot paths (ORM,
+caches, encoding, fan-out) without a network or a Redis in the way. A run
+has three phases:
+
+* connect storm: every user connects at once;
+* message load: every user sends ``rate`` messages per second to random
+  peers for ``duration`` seconds, while ``churn`` idle users per second
+  disconnect and reconnect to drive presence broadcasts;
+* drain: wait up to ``drain_timeout`` seconds for in-flight deliveries.
+
+Latency is end to end, from handing the frame to the sender's socket to
+decoding it from the receiver's. Queries are counted on the connection of
+asgiref's thread-sensitive executor, where the consumer's ORM calls run;
+start ``run_benchmark`` with ``asyncio.run`` rather than ``async_to_sync``
+so no outer sync thread takes them over.
+"""
+import asyncio
+import itertools
+import json
+import math
+import random
+import time
+
+import msgpack
+from asgiref.sync import sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.db import connection
+
+from .consumers import ChatConsumer
+from .protocol import JSON_CODEC, MSGPACK_CODEC, MsgpackCodec
+from .ratelimit import overload_stats
+
+# Settings the benchmark runs under: local backends so runs are comparable
+# between machines, and limits high enough that they never kick in
+BENCHMARK_SETTINGS = {
+    'CHANNEL_LAYERS': {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+            'CONFIG': {'capacity': 100000},
+        },
+    },
+    'CACHES': {
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    },
+    'PRESENCE_BACKEND': 'chat.presence.InMemoryPresenceStore',
+    'RECENT_MESSAGES_BACKEND': 'chat.recent.LocmemRecentMessages',
+    # Only the throwaway primary exists
+    'DATABASE_REPLICAS': [],
+    'WS_CONNECTION_MESSAGE_RATE': 1e9,
+    'WS_CONNECTION_MESSAGE_BURST': 10 ** 9,
+    'WS_USER_MESSAGE_RATE': 1e9,
+    'WS_USER_MESSAGE_BURST': 10 ** 9,
+}
+
+# Message content carries the sequence number used to match deliveries
+TOKEN_PREFIX = 'bench:'
+
+
+def percentiles(samples):
+    """p50/p95/p99/max of latencies in seconds, in milliseconds (nearest rank)"""
+    if not samples:
+        return {'p50': None, 'p95': None, 'p99': None, 'max': None}
+    ordered = sorted(samples)
+
+    def rank(p):
+        return round(ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)] * 1000, 3)
+
+    return {'p50': rank(50), 'p95': rank(95), 'p99': rank(99), 'max': round(ordered[-1] * 1000, 3)}
+
+
+class QueryCounter:
+    """``connection.execute_wrapper`` that only counts statements"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def _add_wrapper(wrapper):
+    connection.execute_wrappers.append(wrapper)
+
+
+def _remove_wrapper(wrapper):
+    connection.execute_wrappers.remove(wrapper)
+
+
+class SimulatedClient:
+    """One authenticated socket plus a task reading everything it is sent"""
+
+    def __init__(self, run, user, profile_id):
+        self.run = run
+        self.user = user
+        self.profile_id = profile_id
+        self.communicator = None
+        self.reader = None
+
+    async def connect(self):
+        query = f'proto={self.run.protocol}' + ('&batch=1' if self.run.batch else '')
+        self.communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/?{query}')
+        self.communicator.scope['user'] = self.user
+        started = time.monotonic()
+        connected, _ = await self.communicator.connect(timeout=self.run.connect_timeout)
+        if not connected:
+            raise RuntimeError(f'User {self.profile_id} was refused')
+        self.reader = asyncio.ensure_future(self.read())
+        return time.monotonic() - started
+
+    async def disconnect(self):
+        self.reader.cancel()
+        await self.communicator.disconnect()
+
+    async def send(self, event):
+        await self.communicator.send_input({
+            'type': 'websocket.receive',
+            **self.run.encode(event),
+        })
+
+    async def read(self):
+        # Read the output queue directly; receive_output's timeout would
+        # cancel the consumer
+        queue = self.communicator.output_queue
+        while True:
+            message = await queue.get()
+            if message['type'] == 'websocket.send':
+                self.run.received(self, message.get('text'), message.get('bytes'))
+
+
+class BenchmarkRun:
+    def __init__(self, rate, duration, churn=0, protocol=1, batch=False,
+                 connect_timeout=10, drain_timeout=5, seed=None):
+        self.rate = rate
+        self.duration = duration
+        self.churn = churn
+        self.protocol = protocol
+        self.batch = batch
+        self.connect_timeout = connect_timeout
+        self.drain_timeout = drain_timeout
+        self.codec = MSGPACK_CODEC if protocol == 2 else JSON_CODEC
+        self.random = random.Random(seed)
+        self.sequence = itertools.count()
+        self.sent_at = {}
+        self.latencies = []
+        self.frames = 0
+        self.presence_frames = 0
+        self.errors = 0
+
+    def encode(self, event):
+        if self.codec.binary:
+            return {'bytes': self.codec.encode(event)}
+        return {'text': self.codec.encode(event)}
+
+    def received(self, client, text_data, bytes_data):
+        now = time.monotonic()
+        if bytes_data is not None:
+            events = msgpack.unpackb(bytes_data)
+        else:
+            events = json.loads(text_data)
+        # Batched connections get array frames
+        if not isinstance(events, list):
+            events = [events]
+        for event in events:
+            if bytes_data is not None:
+                event = MsgpackCodec.expand(event)
+            self.frames += 1
+            event_type = event.get('type')
+            if event_type == 'chat_message' and event.get('receiver_id') == client.profile_id:
+                sequence = self.token_of(event.get('message', ''))
+                sent_at = self.sent_at.pop(sequence, None)
+                if sent_at is not None:
+                    self.latencies.append(now - sent_at)
+            elif event_type == 'presence':
+                self.presence_frames += 1
+            elif event_type in ('error', 'rate_limited'):
+                self.errors += 1
+
+    @staticmethod
+    def token_of(content):
+        if content.startswith(TOKEN_PREFIX):
+            try:
+                return int(content[len(TOKEN_PREFIX):])
+            except ValueError:
+                pass
+        return None
+
+    async def send_messages(self, client, peers, deadline):
+        interval = 1 / self.rate
+        # Spread the senders' first messages over one interval
+        await asyncio.sleep(self.random.uniform(0, interval))
+        while time.monotonic() < deadline:
+            sequence = next(self.sequence)
+            receiver = self.random.choice(peers)
+            self.sent_at[sequence] = time.monotonic()
+            await client.send({
+                'type': 'chat_message',
+                'message': f'{TOKEN_PREFIX}{sequence}',
+                'receiver_id': receiver.profile_id,
+                'client_id': sequence,
+            })
+            await asyncio.sleep(interval)
+
+    async def churn_presence(self, idle, deadline):
+        reconnects = []
+        if not idle or not self.churn:
+            return reconnects
+        interval = 1 / self.churn
+        while time.monotonic() + interval < deadline:
+            await asyncio.sleep(interval)
+            client = self.random.choice(idle)
+            await client.disconnect()
+            reconnects.append(await client.connect())
+        return reconnects
+
+    async def run(self, clients, idle):
+        queries = QueryCounter()
+        await sync_to_async(_add_wrapper)(queries)
+        try:
+            # Connect storm
+            started = time.monotonic()
+            connect_latencies = await asyncio.gather(*(client.connect() for client in clients + idle))
+            connect_seconds = time.monotonic() - started
+            connect_queries = queries.count
+            await asyncio.sleep(0.1)
+
+            # Message load with presence churn
+            queries.count = 0
+            frames_before = self.frames
+            started = time.monotonic()
+            deadline = started + self.duration
+            senders = [
+                self.send_messages(client, [peer for peer in clients if peer is not client], deadline)
+                for client in clients
+            ] if len(clients) > 1 else []
+            results = await asyncio.gather(self.churn_presence(idle, deadline), *senders)
+            reconnects = results[0]
+
+            # Drain
+            drain_deadline = time.monotonic() + self.drain_timeout
+            while self.sent_at and time.monotonic() < drain_deadline:
+                await asyncio.sleep(0.01)
+            load_seconds = time.monotonic() - started
+            load_queries = queries.count
+
+            for client in clients + idle:
+                await client.disconnect()
+        finally:
+            await sync_to_async(_remove_wrapper)(queries)
+
+        sent = len(self.latencies) + len(self.sent_at)
+        delivered = len(self.latencies)
+        return {
+            'config': {
+                'users': len(clients),
+                'idle_users': len(idle),
+                'rate_per_user': self.rate,
+                'duration': self.duration,
+                'churn_per_second': self.churn,
+                'protocol': self.protocol,
+                'batch': self.batch,
+            },
+            'connect': {
+                'count': len(connect_latencies),
+                'seconds': round(connect_seconds, 3),
+                'per_second': round(len(connect_latencies) / connect_seconds, 1) if connect_seconds else None,
+                'latency_ms': percentiles(connect_latencies),
+                'queries_per_connection': round(connect_queries / len(connect_latencies), 2) if connect_latencies else None,
+            },
+            'messages': {
+                'sent': sent,
+                'delivered': delivered,
+                'lost': sent - delivered,
+                'seconds': round(load_seconds, 3),
+                'throughput_per_second': round(delivered / load_seconds, 1) if load_seconds else None,
+                'latency_ms': percentiles(self.latencies),
+                # Includes the reconnects of the churn, as in production
+                'queries_per_message': round(load_queries / sent, 2) if sent else None,
+                'frames_received': self.frames - frames_before,
+                'errors': self.errors,
+            },
+            'presence': {
+                'reconnects': len(reconnects),
+                'reconnect_latency_ms': percentiles(reconnects),
+                'frames_received': self.presence_frames,
+            },
+            'overload': dict(overload_stats),
+        }
+
+
+async def run_benchmark(users, idle_users=(), **options):
+    """
+    Run a benchmark with ``users`` sending messages and ``idle_users`` only
+    churning presence, both lists of (User, UserProfile ID) pairs, and
+    return the report as a JSON-serializable dict. ``options`` are those of
+    ``BenchmarkRun``.
+    """
+    run = BenchmarkRun(**options)
+    clients = [SimulatedClient(run, user, profile_id) for user, profile_id in users]
+    idle = [SimulatedClient(run, user, profile_id) for user, profile_id in idle_users]
+    return await run.run(clients, idle)
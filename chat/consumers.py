@@ -1,16 +1,82 @@
-import base64
-import json
+import asyncio
+import logging
+import time
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from django.contrib.auth.models import User
-from django.core.files.base import ContentFile
+from django.conf import settings
 from django.core.files.storage import default_storage
-
-from .models import Message, UserProfile
-from channels.db import database_sync_to_async
-from datetime import datetime
+from django.db import close_old_connections
+
+from .db_router import areplica_for, reading_from
+from .logqueue import bind_log_context
+from .media import resolve_media_id
+from .metrics import (
+    GROUP_SEND_SECONDS,
+    PRESENCE_SNAPSHOT_USERS,
+    SAVE_MESSAGE_SECONDS,
+    WS_CONNECTIONS,
+    WS_CONNECTS,
+    WS_MESSAGES_DELIVERED,
+    WS_MESSAGES_RECEIVED,
+    WS_RECEIVE_SECONDS,
+)
+from .models import MediaBlob, Message
+from .outbox import FrameBatcher, OutboundQueue, batching_requested
+from .persistence import get_message_writer
+from .presence import PRESENCE_GROUP, current_version, get_presence_store, next_version, presence_delta
+from .profiles import aget_identity, aget_identity_for_user
+from .profiling import sample
+from .protocol import encode_frames, negotiate
+from .ratelimit import connection_bucket, overload_stats, user_bucket
+from .repository import (
+    CHAT_VIEW_CONVERSATIONS,
+    acreate_room_message,
+    alast_received_id,
+    arecent_peer_ids,
+    aroom_ids_for,
+    create_message,
+    missed_messages,
+)
+from .rooms import aget_member_ids, room_group
+from .thumbnails import thumbnail_url
+from asgiref.sync import sync_to_async
+
+logger = logging.getLogger(__name__)
+
+# Frame types counted by name; anything else a client sends is 'other'
+RECEIVED_TYPES = {'chat_message', 'room_message', 'presence_sync', 'ping'}
+
+# Most users a presence_sync can ask about at once
+PRESENCE_SYNC_MAX_IDS = 1000
+
+# Database connections of the thread running the consumers' ORM calls are
+# recycled at most this often, see check_connections
+CONNECTION_CHECK_SECONDS = 1
+_connections_checked_at = None
+
+
+async def check_connections():
+    """
+    ``close_old_connections`` for the thread the consumers' ORM calls run
+    in, throttled process-wide. Requests do this when they start and end;
+    sockets never end, so without it connections (replicas included) would
+    outlive CONN_MAX_AGE and skip CONN_HEALTH_CHECKS.
+    """
+    global _connections_checked_at
+    now = time.monotonic()
+    if _connections_checked_at is not None and now - _connections_checked_at < CONNECTION_CHECK_SECONDS:
+        return
+    _connections_checked_at = now
+    await sync_to_async(close_old_connections)()
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    async def dispatch(self, message):
+        # Every socket and channel layer event passes here; while profiling
+        # is on a sample of them is profiled per event type
+        await check_connections()
+        await sample(f"ws.{message['type']}", super().dispatch(message))
+
     async def connect(self):
         # Check if user is authenticated
         if self.scope["user"].is_anonymous:
@@ -18,12 +84,43 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
 
         self.user = self.scope["user"]
+        self.pending_deliveries = set()
+        # Everything logged for this socket carries its channel and user
+        bind_log_context(connection=self.channel_name)
+
+        # JSON text frames unless the client negotiated the msgpack protocol
+        self.codec, subprotocol = negotiate(self.scope)
+
+        # Outgoing frames go through a bounded queue so a slow reader can
+        # neither block this consumer nor pile up memory
+        self.outbound = OutboundQueue(
+            self.write_frame,
+            settings.WS_OUTBOUND_QUEUE_SIZE,
+            settings.WS_OUTBOUND_HIGH_WATER,
+            settings.WS_SLOW_CONSUMER_TIMEOUT,
+            self.close_slow_consumer
+        )
 
-        # Get the user's profile
-        self.user_profile = await self.get_user_profile(self.user.id)
+        # Inbound chat messages are limited per connection and per user
+        self.message_bucket = connection_bucket()
+
+        # Clients that opt in get their frames coalesced into array frames
+        self.batcher = None
+        if batching_requested(self.scope):
+            self.batcher = FrameBatcher(
+                self.enqueue_frame,
+                self.codec,
+                settings.WS_BATCH_WINDOW,
+                settings.WS_BATCH_MAX_FRAMES
+            )
+
+        # Get the user's profile identity (cached across connections)
+        self.profile = await self.get_user_profile(self.user)
+        bind_log_context(user=self.profile.id)
+        self.user_message_bucket = user_bucket(self.profile.id)
 
         # Room name uses the UserProfile ID, not the User ID
-        self.room_name = f'chat_{self.user_profile.id}'
+        self.room_name = f'chat_{self.profile.id}'
 
         # Join user's personal group for chat messages
         await self.channel_layer.group_add(
@@ -31,25 +128,58 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
+        # Join the group of every room the user is a member of
+        self.room_ids = set(await aroom_ids_for(self.profile.id))
+        for room_id in self.room_ids:
+            await self.channel_layer.group_add(
+                room_group(room_id),
+                self.channel_name
+            )
+
         # Join presence group for status updates
         await self.channel_layer.group_add(
-            "presence",
+            PRESENCE_GROUP,
             self.channel_name
         )
 
-        # Set user online status
-        await self.set_online_status(True)
+        # Register this connection with the presence store; only the user's
+        # first live connection (across tabs and workers) changes their status
+        came_online = await get_presence_store().add_connection(self.profile.id, self.channel_name)
 
         # Accept the connection
-        await self.accept()
-
-        # Send initial user list to the client
+        await self.accept(subprotocol=subprotocol)
+        self.counted = True
+        WS_CONNECTIONS.inc()
+        WS_CONNECTS.inc()
+
+        # Binary protocol clients get our identity once instead of per message
+        if self.codec.binary:
+            await self.send_event({
+                'type': 'hello',
+                'self_id': self.profile.id,
+                'username': self.profile.username,
+                'profile_picture': self.profile.avatar_url
+            })
+
+        # Send initial user list snapshot to the client
         await self.send_initial_user_list()
 
-        # Broadcast status to all clients
-        await self.broadcast_status()
+        # Replay what a reconnecting client missed; the personal group was
+        # joined first, so nothing falls between the replay and live frames
+        await self.send_missed_messages(self.query_param('since'))
+
+        # Broadcast our status change to all clients
+        if came_online:
+            await self.broadcast_status(True)
 
     async def disconnect(self, close_code):
+        if getattr(self, 'batcher', None) is not None:
+            self.batcher.close()
+        if hasattr(self, 'outbound'):
+            self.outbound.close()
+        if getattr(self, 'counted', False):
+            WS_CONNECTIONS.dec()
+
         # Leave chat group
         if hasattr(self, 'room_name'):
             await self.channel_layer.group_discard(
@@ -57,204 +187,441 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 self.channel_name
             )
 
+        # Leave room groups
+        for room_id in getattr(self, 'room_ids', ()):
+            await self.channel_layer.group_discard(
+                room_group(room_id),
+                self.channel_name
+            )
+
         # Leave presence group and set offline status
         if self.user.is_authenticated:
-            await self.set_online_status(False)
+            went_offline = await get_presence_store().remove_connection(self.profile.id, self.channel_name)
             await self.channel_layer.group_discard(
-                "presence",
+                PRESENCE_GROUP,
                 self.channel_name
             )
-            await self.broadcast_status()
-
-    async def receive(self, text_data):
+            # Other tabs or workers may still hold a connection for this user
+            if went_offline:
+                await self.broadcast_status(False)
+
+    async def send_event(self, event):
+        # Encode an outgoing event in the connection's negotiated protocol
+        await self.send_frame(self.codec.encode(event))
+
+    async def send_frames(self, frames, droppable=False):
+        # Forward an event pre-encoded by encode_frames, untouched
+        await self.send_frame(frames[str(self.codec.version)], droppable)
+
+    async def send_frame(self, frame, droppable=False):
+        # Only frames a client can recover without a replay (presence) may
+        # be dropped when the socket falls behind
+        if self.batcher is not None:
+            await self.batcher.add(frame, droppable)
+        else:
+            await self.enqueue_frame(frame, droppable)
+
+    async def enqueue_frame(self, frame, droppable=False):
+        self.outbound.put(frame, droppable)
+
+    def close_slow_consumer(self):
+        # The client stopped reading; free its queue rather than buffer more
+        asyncio.ensure_future(self.close(code=4008))
+
+    async def write_frame(self, frame):
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        with WS_RECEIVE_SECONDS.time():
+            await self.handle_frame(text_data, bytes_data)
+
+    async def handle_frame(self, text_data, bytes_data):
         try:
-            text_data_json = json.loads(text_data)
+            text_data_json = self.codec.decode(text_data, bytes_data)
             message_type = text_data_json.get('type', 'chat_message')
+            WS_MESSAGES_RECEIVED.labels(message_type if message_type in RECEIVED_TYPES else 'other').inc()
 
+            if message_type in ('chat_message', 'room_message') and not await self.allow_message(text_data_json):
+                return
 
             if message_type == 'chat_message':
                 message = text_data_json.get('message', '')
                 receiver_id = text_data_json.get('receiver_id', '')
-                image_url = None
 
-                if text_data_json['image_base64']:
-                    # Decode base64 and save image
-                    image_data = base64.b64decode(text_data_json['image_base64'])
-                    image_file = ContentFile(image_data, name='image.jpg')
-                    path = default_storage.save(f'media/images/image.jpg', image_file)
-                    image_url = default_storage.url(path)
+                try:
+                    image_url, image_thumbnail_url, media = await self.read_image(text_data_json)
+                except ValueError as e:
+                    await self.send_event({
+                        'type': 'error',
+                        'error': str(e)
+                    })
+                    return
 
                 if (not message and not image_url) or not receiver_id:
-                    await self.send(text_data=json.dumps({
+                    await self.send_event({
                         'type': 'error',
                         'error': 'Message or receiver_id missing'
-                    }))
+                    })
                     return
 
-                # Save the message in the database
-                saved_message = await self.save_message(message,image_url, receiver_id)
-
-                # Format timestamp for frontend
-                timestamp = saved_message.timestamp.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-
-                # Get sender's user profile
-                sender_profile_pic = await self.get_profile_picture_url(self.user_profile)
-
-                # Send to receiver's group - using UserProfile ID for the room
-                receiver_room = f'chat_{receiver_id}'
-                await self.channel_layer.group_send(
-                    receiver_room,
-                    {
-                        'type': 'chat_message',
-                        'message': message,
-                        'content': message,  # Include both for compatibility
-                        'sender': self.user.username,
-                        'sender_id': self.user_profile.id,  # Send profile ID, not user ID
-                        'receiver_id': receiver_id,
-                        'sender_profile_picture': sender_profile_pic,
-                        'timestamp': timestamp,
-                        'image_url': image_url
-                    }
-                )
-
-                # Send confirmation back to sender
-                await self.send(text_data=json.dumps({
-                    'type': 'chat_message',
-                    'message': message,
-                    'content': message,  # Include both for compatibility
-                    'sender': self.user.username,
-                    'sender_id': self.user_profile.id,  # Send profile ID, not user ID
-                    'receiver_id': receiver_id,
-                    'sender_profile_picture': sender_profile_pic,
-                    'timestamp': timestamp,
-                    'image_url': image_url
-                }))
+                client_id = text_data_json.get('client_id')
+                if settings.MESSAGE_WRITE_BEHIND:
+                    # Buffer the message for the next batch insert and return
+                    # straight away; delivery happens once the batch commits
+                    await self.check_receiver(receiver_id)
+                    saved = get_message_writer().submit(Message(
+                        sender_id=self.profile.id,
+                        receiver_id=receiver_id,
+                        conversation_key=Message.conversation_key_for(self.profile.id, receiver_id),
+                        content=message,
+                        image_url=image_url,
+                        media=media
+                    ))
+                    delivery = asyncio.ensure_future(self.deliver_when_saved(saved, image_thumbnail_url, client_id))
+                    self.pending_deliveries.add(delivery)
+                    delivery.add_done_callback(self.pending_deliveries.discard)
+                else:
+                    # Save the message in the database
+                    saved_message = await self.save_message(message, image_url, media, receiver_id)
+                    await self.deliver_message(saved_message, image_thumbnail_url, client_id)
+            elif message_type == 'room_message':
+                await self.receive_room_message(text_data_json)
+            elif message_type == 'presence_sync':
+                # Client noticed a gap in presence versions, resend the
+                # snapshot for the users it shows
+                await self.send_initial_user_list(self.presence_sync_ids(text_data_json.get('ids')))
             elif message_type == 'ping':
-                # Handle ping request for keeping connection alive
-                await self.send(text_data=json.dumps({
+                # Handle ping request for keeping connection alive; it doubles
+                # as the presence heartbeat
+                if await get_presence_store().heartbeat(self.profile.id, self.channel_name):
+                    await self.broadcast_status(True)
+                await self.send_event({
                     'type': 'pong'
-                }))
+                })
             else:
                 # Handle other message types if needed
                 pass
 
         except Exception as e:
-            print(f"Error in receive: {e}")
-            await self.send(text_data=json.dumps({
+            logger.exception('Failed to handle a received frame')
+            await self.send_event({
                 'type': 'error',
                 'error': str(e)
-            }))
+            })
+
+    async def allow_message(self, data):
+        """Take a token for an inbound message, or tell the client to back off"""
+        if self.message_bucket.take():
+            if self.user_message_bucket.take():
+                return True
+            # Refused messages do not count against the connection
+            self.message_bucket.refund()
+        overload_stats['rate_limited'] += 1
+        await self.send_event({
+            'type': 'rate_limited',
+            'error': 'Too many messages, slow down',
+            'retry_after': round(max(self.message_bucket.retry_after(), self.user_message_bucket.retry_after()), 2),
+            'client_id': data.get('client_id')
+        })
+        return False
+
+    async def read_image(self, data):
+        """
+        Return (image_url, thumbnail_url, MediaBlob) of the image attached to
+        an incoming message, or Nones. The blob carries only the ID and path
+        signed into the media id, so saving and caching the message need not
+        load it. Raises ValueError when the attachment is not acceptable.
+        """
+        if data.get('image_base64'):
+            raise ValueError('Inline images are no longer supported, upload them to /api/media/')
+
+        # Images are uploaded over HTTP first and referenced by media_id
+        if not data.get('media_id'):
+            return None, None, None
+        blob_id, media_path = resolve_media_id(data['media_id'], self.profile.id)
+        image_url, image_thumbnail_url = await self.get_image_urls(media_path)
+        return image_url, image_thumbnail_url, MediaBlob(id=blob_id, path=media_path)
+
+    async def receive_room_message(self, data):
+        message = data.get('message', '')
+        try:
+            room_id = int(data.get('room_id'))
+        except (TypeError, ValueError):
+            room_id = None
+
+        try:
+            image_url, image_thumbnail_url, media = await self.read_image(data)
+        except ValueError as e:
+            await self.send_event({
+                'type': 'error',
+                'error': str(e)
+            })
+            return
+
+        if (not message and not image_url) or room_id is None:
+            await self.send_event({
+                'type': 'error',
+                'error': 'Message or room_id missing'
+            })
+            return
+
+        # Membership comes from the room's cached member list, not the table
+        if self.profile.id not in await aget_member_ids(room_id):
+            await self.send_event({
+                'type': 'error',
+                'error': f"Not a member of room {room_id}"
+            })
+            return
+
+        saved_message = await self.create_room_message(room_id, message, image_url, media)
+        event = {
+            'type': 'room_message',
+            'id': saved_message.id,
+            'room_id': room_id,
+            'message': saved_message.content,
+            'sender': self.profile.username,
+            'sender_id': self.profile.id,
+            'sender_profile_picture': self.profile.avatar_url,
+            'timestamp': saved_message.timestamp.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            'image_url': saved_message.image_url,
+            'thumbnail_url': image_thumbnail_url
+        }
+
+        # One group_send reaches every member's connections, this one included
+        await self.group_send('room', room_group(room_id), {
+            'type': 'room_message',
+            'frames': encode_frames(event)
+        })
+        await self.send_event({
+            'type': 'message_ack',
+            'id': saved_message.id,
+            'client_id': data.get('client_id')
+        })
+
+    def message_event(self, message, sender, image_thumbnail_url):
+        return {
+            'type': 'chat_message',
+            'id': message.id,
+            'message': message.content,
+            'content': message.content,  # Include both for compatibility
+            'sender': sender.username,
+            'sender_id': sender.id,  # Send profile ID, not user ID
+            'receiver_id': message.receiver_id,
+            'sender_profile_picture': sender.avatar_url,
+            # Format timestamp for frontend
+            'timestamp': message.timestamp.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            'image_url': message.image_url,
+            'thumbnail_url': image_thumbnail_url
+        }
+
+    async def deliver_message(self, saved_message, image_thumbnail_url, client_id=None):
+        message_data = self.message_event(saved_message, self.profile, image_thumbnail_url)
+
+        # Encode once; the receiver's consumers and the sender's echo all
+        # forward the same frames
+        frames = encode_frames(message_data)
+
+        # Send to receiver's group - using UserProfile ID for the room
+        receiver_room = f'chat_{saved_message.receiver_id}'
+        await self.group_send('user', receiver_room, {
+            'type': 'chat_message',
+            'frames': frames
+        })
+
+        # Send confirmation back to sender, then acknowledge the commit
+        await self.send_frames(frames)
+        await self.send_event({
+            'type': 'message_ack',
+            'id': saved_message.id,
+            'client_id': client_id
+        })
+
+    async def group_send(self, target, group, event):
+        # Timed per kind of group: a user's sockets, a room or presence
+        with GROUP_SEND_SECONDS.labels(target).time():
+            await self.channel_layer.group_send(group, event)
+
+    async def deliver_when_saved(self, saved, image_thumbnail_url, client_id):
+        try:
+            saved_message = await saved
+        except Exception as e:
+            await self.send_event({
+                'type': 'error',
+                'error': str(e),
+                'client_id': client_id
+            })
+            return
+        try:
+            await self.deliver_message(saved_message, image_thumbnail_url, client_id)
+        except Exception:
+            logger.exception('Failed to deliver message %s', saved_message.id)
 
     async def chat_message(self, event):
         try:
-            # Send chat message to WebSocket
-            message_data = {
-                'type': 'chat_message',
-                'message': event.get('message', ''),
-                'content': event.get('content', event.get('message', '')),
-                'sender': event['sender'],
-                'sender_id': event['sender_id'],
-                'receiver_id': event.get('receiver_id'),
-                'sender_profile_picture': event.get('sender_profile_picture', '/static/images/profile-icon.png'),
-                'timestamp': event.get('timestamp', datetime.now().isoformat())
-            }
-
-            # Add image URL if present
-            if 'image_url' in event:
-                message_data['image_url'] = event['image_url']
-
-            await self.send(text_data=json.dumps(message_data))
+            # Forward the chat message frame encoded by the sender
+            await self.send_frames(event['frames'])
+            WS_MESSAGES_DELIVERED.labels('chat_message').inc()
         except Exception as e:
-            print(f"Error in chat_message: {e}")
-            await self.send(text_data=json.dumps({
+            logger.exception('Failed to forward a chat message')
+            await self.send_event({
                 'type': 'error',
                 'error': f"Failed to process message: {str(e)}"
-            }))
+            })
 
-    async def status_update(self, event):
+    async def room_message(self, event):
+        try:
+            # Forward the room message frame encoded by the sender
+            await self.send_frames(event['frames'])
+            WS_MESSAGES_DELIVERED.labels('room_message').inc()
+        except Exception:
+            logger.exception('Failed to forward a room message')
+
+    async def room_joined(self, event):
+        # Added to a room while connected; start receiving its messages
+        room_id = event['room_id']
+        if room_id not in self.room_ids:
+            self.room_ids.add(room_id)
+            await self.channel_layer.group_add(room_group(room_id), self.channel_name)
+        await self.send_event({
+            'type': 'room_joined',
+            'room_id': room_id
+        })
+
+    async def room_left(self, event):
+        room_id = event['room_id']
+        if room_id in self.room_ids:
+            self.room_ids.discard(room_id)
+            await self.channel_layer.group_discard(room_group(room_id), self.channel_name)
+        await self.send_event({
+            'type': 'room_left',
+            'room_id': room_id
+        })
+
+    async def presence_delta(self, event):
         try:
-            # Send status update to WebSocket
-            await self.send(text_data=json.dumps({
-                'type': 'status_update',
-                'users': event['users']
-            }))
+            # Forward a single user's status change to WebSocket; a client
+            # that misses it resyncs on the version gap
+            await self.send_frames(event['frames'], droppable=True)
         except Exception as e:
-            print(f"Error in status_update: {e}")
-            await self.send(text_data=json.dumps({
+            logger.exception('Failed to forward a presence update')
+            await self.send_event({
                 'type': 'error',
                 'error': f"Failed to update status: {str(e)}"
-            }))
+            })
 
-    @database_sync_to_async
-    def get_user_profile(self, user_id):
-        """Get the UserProfile instance for a User ID"""
-        user = User.objects.get(id=user_id)
-        profile, created = UserProfile.objects.get_or_create(user=user)
-        return profile
+    def query_param(self, name):
+        return parse_qs(self.scope.get('query_string', b'').decode()).get(name, [None])[0]
 
-    @database_sync_to_async
-    def save_message(self, message,image_url, receiver_id):
+    async def send_missed_messages(self, since):
+        """
+        Stream the messages received after message ID ``since`` in batches
+        of ``sync`` frames. Without a valid ``since`` only the current
+        cursor is sent, so the client can resume from it next time.
+        """
         try:
-            # Get the receiver's UserProfile
-            receiver_profile = UserProfile.objects.get(id=receiver_id)
-            # Get the sender's UserProfile (which we've already stored)
-            sender_profile = self.user_profile
-
-            # Create message using the correct model fields
-            return Message.objects.create(
-                sender=sender_profile,
-                receiver=receiver_profile,
-                content=message,
-                image_url=image_url
-            )
-        except UserProfile.DoesNotExist:
+            last_id = int(since)
+        except (TypeError, ValueError):
+            await self.send_event({
+                'type': 'sync',
+                'messages': [],
+                'last_id': await self.get_last_received_id(),
+                'done': True
+            })
+            return
+
+        sent = 0
+        while True:
+            limit = min(settings.SYNC_BATCH_SIZE, settings.SYNC_MAX_MESSAGES - sent)
+            messages = await self.get_missed_messages(last_id, limit)
+            if messages:
+                last_id = messages[-1]['id']
+                sent += len(messages)
+            done = len(messages) < limit
+            # Too far behind to replay; the client should refetch history
+            truncated = not done and sent >= settings.SYNC_MAX_MESSAGES
+            await self.send_event({
+                'type': 'sync',
+                'messages': messages,
+                'last_id': last_id,
+                'done': done or truncated,
+                'truncated': truncated
+            })
+            if done or truncated:
+                return
+
+    async def get_missed_messages(self, after_id, limit):
+        # Keyset over the (receiver, id) index, with the batch's senders and
+        # thumbnails resolved in the same thread hop
+        return [
+            self.message_event(message, sender, image_thumbnail_url)
+            for message, sender, image_thumbnail_url in await missed_messages(self.profile.id, after_id, limit)
+        ]
+
+    async def get_last_received_id(self):
+        return await alast_received_id(self.profile.id)
+
+    async def get_user_profile(self, user):
+        """Get the ProfileIdentity of a User, creating its UserProfile if needed"""
+        return await aget_identity_for_user(user)
+
+    async def check_receiver(self, receiver_id):
+        if await aget_identity(receiver_id) is None:
             raise ValueError(f"Receiver with ID {receiver_id} does not exist")
+
+    async def save_message(self, message, image_url, media, receiver_id):
+        await self.check_receiver(receiver_id)
+        try:
+            # Create message using the correct model fields and move the
+            # conversation's inbox row forward in the same transaction
+            with SAVE_MESSAGE_SECONDS.time():
+                return await create_message(self.profile.id, receiver_id, message, image_url, media)
         except Exception as e:
             raise Exception(f"Failed to save message: {str(e)}")
 
-    @database_sync_to_async
-    def get_profile_picture_url(self, user_profile):
-        """Get profile picture URL from a UserProfile instance"""
-        if user_profile.profile_picture:
-            return user_profile.profile_picture.url
-        return '/static/images/profile-icon.png'
-
-    @database_sync_to_async
-    def set_online_status(self, is_online):
+    async def create_room_message(self, room_id, message, image_url, media):
         try:
-            # We already have the user_profile
-            self.user_profile.is_online = is_online
-            self.user_profile.save()
+            # Stored once for the room, whatever its number of members
+            return await acreate_room_message(room_id, self.profile.id, message, image_url, media)
         except Exception as e:
-            print(f"Error setting online status: {e}")
-
-    async def broadcast_status(self):
-        users = await self.get_all_users()
-        await self.channel_layer.group_send(
-            "presence",
-            {
-                "type": "status_update",
-                "users": users,
-            }
-        )
+            raise Exception(f"Failed to save message: {str(e)}")
 
-    async def send_initial_user_list(self):
-        users = await self.get_all_users()
-        await self.send(text_data=json.dumps({
+    async def get_image_urls(self, media_path, full=True):
+        """Get the full and preview URLs of an uploaded image (or just the preview)"""
+        # Storage work only, so it stays off the thread serializing the ORM
+        preview_url = await sync_to_async(thumbnail_url, thread_sensitive=False)(media_path, 'preview')
+        if not full:
+            return preview_url
+        return default_storage.url(media_path), preview_url
+
+    async def broadcast_status(self, is_online):
+        await self.group_send('presence', PRESENCE_GROUP, presence_delta(self.profile.id, is_online, await next_version()))
+
+    async def send_initial_user_list(self, profile_ids=None):
+        # Presence of the users on the client's page, by default the peers
+        # of the conversations the chat page renders; directory pages come
+        # with their own status from /api/users/. Read the version before
+        # the users so every delta at or below it is already reflected in
+        # the snapshot
+        version = await current_version()
+        if profile_ids is None:
+            with reading_from(await areplica_for(self.profile.id)):
+                profile_ids = await arecent_peer_ids(self.profile.id, CHAT_VIEW_CONVERSATIONS)
+        online_ids = await get_presence_store().aonline_ids(profile_ids)
+        users = [{"id": profile_id, "is_online": profile_id in online_ids} for profile_id in profile_ids]
+        PRESENCE_SNAPSHOT_USERS.observe(len(users))
+        await self.send_event({
             "type": "status_update",
+            "version": version,
+            "self_id": self.profile.id,
             "users": users,
-        }))
-
-    @database_sync_to_async
-    def get_all_users(self):
-        # Get all UserProfile objects instead of Users
-        profiles = UserProfile.objects.exclude(user=self.user).select_related('user')
-        return [
-            {
-                "id": profile.id,  # Use UserProfile ID
-                "username": profile.user.username,
-                "is_online": profile.is_online,
-                "profile_picture": profile.profile_picture.url if profile.profile_picture else '/static/images/profile-icon.png'
-            }
-            for profile in profiles
-        ]
+        })
+
+    @staticmethod
+    def presence_sync_ids(ids):
+        # Profile IDs a client asked about; None (no list) for the default
+        if not isinstance(ids, list):
+            return None
+        return list({profile_id for profile_id in ids[:PRESENCE_SYNC_MAX_IDS] if isinstance(profile_id, int)})
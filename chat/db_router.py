@@ -0,0 +1,109 @@
+"""
+Read replicas for history, search and directory reads.
+
+Only code that opts in reads from a replica: views decorated with
+``replica_reads`` and blocks wrapped in ``reading_from``. Everything else,
+all writes and anything inside a transaction stay on the primary. A user
+who just wrote a message is pinned to the primary for
+REPLICA_STICKY_SECONDS (shared through the cache, so it holds across
+workers) and so always reads their own writes. A room that just got a
+message is pinned the same way, so every member reads it.
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from .profiles import get_identity_for_user
+
+# Alias reads go to in the current request or task; None means the primary
+_read_alias = ContextVar('read_alias', default=None)
+
+
+def _sticky_key(profile_id):
+    return f'db:primary:{profile_id}'
+
+
+def _room_sticky_key(room_id):
+    return f'db:primary:room:{room_id}'
+
+
+def _sticky_keys(profile_ids, room_ids):
+    return [_sticky_key(profile_id) for profile_id in profile_ids] + [_room_sticky_key(room_id) for room_id in room_ids]
+
+
+def stick_to_primary(*profile_ids, room_ids=()):
+    """Pin profiles (and rooms) to the primary after a write (sync; call after commit)"""
+    if settings.DATABASE_REPLICAS:
+        cache.set_many(dict.fromkeys(_sticky_keys(profile_ids, room_ids), True), settings.REPLICA_STICKY_SECONDS)
+
+
+async def astick_to_primary(*profile_ids, room_ids=()):
+    if settings.DATABASE_REPLICAS:
+        await cache.aset_many(dict.fromkeys(_sticky_keys(profile_ids, room_ids), True), settings.REPLICA_STICKY_SECONDS)
+
+
+def replica_for(profile_id, room_id=None):
+    """A replica alias for this profile's reads (of this room), or None if they must use the primary"""
+    if not settings.DATABASE_REPLICAS:
+        return None
+    if cache.get_many(_sticky_keys([profile_id], [room_id] if room_id is not None else [])):
+        return None
+    return random.choice(settings.DATABASE_REPLICAS)
+
+
+async def areplica_for(profile_id, room_id=None):
+    if not settings.DATABASE_REPLICAS:
+        return None
+    if await cache.aget_many(_sticky_keys([profile_id], [room_id] if room_id is not None else [])):
+        return None
+    return random.choice(settings.DATABASE_REPLICAS)
+
+
+@contextmanager
+def reading_from(alias):
+    """Route the reads of the block (and threads it hands work to) to ``alias``"""
+    token = _read_alias.set(alias)
+    try:
+        yield
+    finally:
+        _read_alias.reset(token)
+
+
+def replica_reads(view):
+    """
+    Serve a view's reads from a replica unless its user, or the room of a
+    view taking ``room_id``, is pinned to the primary
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not settings.DATABASE_REPLICAS or not request.user.is_authenticated:
+            return view(request, *args, **kwargs)
+        # Writes pin profile IDs; the profile cache usually answers this
+        alias = replica_for(get_identity_for_user(request.user).id, kwargs.get('room_id'))
+        with reading_from(alias):
+            return view(request, *args, **kwargs)
+    return wrapper
+
+
+class ReplicaRouter:
+    """Sends opted-in reads to the chosen replica; has no opinion otherwise"""
+
+    def db_for_read(self, model, **hints):
+        alias = _read_alias.get()
+        # Reads inside a transaction must see its writes
+        if alias is None or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return alias
+
+    def db_for_write(self, model, **hints):
+        # Also for rows that were read from a replica
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
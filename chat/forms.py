@@ -0,0 +1,26 @@
+from django import forms
+from django.conf import settings
+from django.template.defaultfilters import filesizeformat
+
+from .models import UserProfile
+
+
+class ImageUploadForm(forms.Form):
+    image = forms.ImageField()
+
+    def clean_image(self):
+        image = self.cleaned_data['image']
+        if image.size > settings.CHAT_UPLOAD_MAX_SIZE:
+            raise forms.ValidationError(
+                f'Image too large. Maximum size is {filesizeformat(settings.CHAT_UPLOAD_MAX_SIZE)}.'
+            )
+        return image
+
+
+class RoomForm(forms.Form):
+    name = forms.CharField(max_length=100)
+    members = forms.ModelMultipleChoiceField(queryset=UserProfile.objects.all(), required=False)
+
+
+class RoomMemberForm(forms.Form):
+    profile = forms.ModelChoiceField(queryset=UserProfile.objects.all())
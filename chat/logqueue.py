@@ -0,0 +1,134 @@
+"""
+Logging that stays off the event loop.
+
+Loggers hand records to ``QueueListenerHandler``, which only tags them
+with the current connection and user and puts them on a bounded queue; a
+listener thread formats them and writes the console and the log file.
+When the queue is full records are dropped (and counted) rather than
+making the caller wait. DEBUG records are sampled before they are queued.
+"""
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+# Set by ChatConsumer for everything logged while handling a socket
+connection_id = ContextVar('connection_id', default=None)
+user_id = ContextVar('user_id', default=None)
+
+# Records dropped because the listener fell behind, exported as a metric
+dropped_records = 0
+
+# LogRecord attributes that are not extra fields
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def bind_log_context(connection=None, user=None):
+    """Tag records logged from the current task (and what it spawns)"""
+    if connection is not None:
+        connection_id.set(connection)
+    if user is not None:
+        user_id.set(user)
+
+
+class ContextFilter(logging.Filter):
+    """Copy the connection and user of the logging task onto the record"""
+
+    def filter(self, record):
+        record.connection_id = connection_id.get()
+        record.user_id = user_id.get()
+        return True
+
+
+class DebugSampleFilter(logging.Filter):
+    """Pass one in ``rate`` records below INFO; everything else passes"""
+
+    def __init__(self, rate=1):
+        super().__init__()
+        self.rate = max(1, int(rate))
+        self._seen = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.INFO or self.rate == 1:
+            return True
+        # Races between threads only skew the sample slightly
+        self._seen += 1
+        return self._seen % self.rate == 0
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the context and any extra fields"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'process': record.process,
+            'thread': record.thread,
+        }
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES and value is not None:
+                entry[name] = value
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        elif record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class QueueListenerHandler(logging.handlers.QueueHandler):
+    """
+    Queues records for a listener thread that passes them to the console
+    and a rotating file, formatted as JSON (or ``console_format`` on the
+    console). Usable from LOGGING with these arguments.
+    """
+
+    def __init__(self, filename, max_bytes, backup_count, queue_size=10000,
+                 debug_sample_rate=1, console=True, console_format=None):
+        super().__init__(queue.Queue(maxsize=queue_size))
+        self.addFilter(DebugSampleFilter(debug_sample_rate))
+        self.addFilter(ContextFilter())
+
+        handlers = [logging.handlers.RotatingFileHandler(
+            filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8'
+        )]
+        handlers[0].setFormatter(JsonFormatter())
+        if console:
+            handlers.append(logging.StreamHandler())
+            handlers[1].setFormatter(
+                logging.Formatter(console_format, style='{') if console_format else JsonFormatter()
+            )
+        self.listener = logging.handlers.QueueListener(self.queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+        self._closed = threading.Lock()
+
+    def prepare(self, record):
+        # Formatting is left to the listener; only what cannot wait is done
+        # here: merging the arguments (they may change) and the traceback
+        # (its frames may be gone)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        global dropped_records
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_records += 1
+
+    def close(self):
+        # Called by logging.shutdown at exit: write out what is queued
+        if self._closed.acquire(blocking=False):
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+        super().close()
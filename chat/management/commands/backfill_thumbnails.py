@@ -0,0 +1,42 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from chat.models import MediaBlob, UserProfile
+from chat.thumbnails import THUMBNAIL_SIZES, generate_thumbnail
+
+
+class Command(BaseCommand):
+    help = 'Generate missing thumbnails for profile pictures and chat images'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--size', action='append', choices=sorted(THUMBNAIL_SIZES), dest='sizes',
+            help='Only generate this size (repeatable). Defaults to all sizes.',
+        )
+        parser.add_argument('--force', action='store_true', help='Regenerate thumbnails that already exist')
+
+    def handle(self, *args, **options):
+        sizes = options['sizes'] or list(THUMBNAIL_SIZES)
+        sources = [
+            profile.profile_picture.name
+            for profile in UserProfile.objects.exclude(profile_picture='').exclude(profile_picture__isnull=True)
+        ]
+        sources += MediaBlob.objects.values_list('path', flat=True)
+
+        jobs = [(source, size) for source in sources for size in sizes]
+        failed = 0
+        # Threads only shuttle bytes; the resizing happens in the process pool
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [
+                (source, size, executor.submit(generate_thumbnail, source, size, options['force']))
+                for source, size in jobs
+            ]
+            for source, size, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f'{source} ({size}): {e}')
+
+        self.stdout.write(self.style.SUCCESS(f'Processed {len(jobs) - failed} thumbnails, {failed} failed'))
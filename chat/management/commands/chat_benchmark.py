@@ -0,0 +1,81 @@
+import asyncio
+import json
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings, setup_databases, teardown_databases
+
+from chat.benchmark import BENCHMARK_SETTINGS, run_benchmark
+from chat.models import UserProfile
+from chat.presence import get_presence_store
+from chat.profiles import profile_cache
+from chat.ratelimit import overload_stats
+from chat.recent import get_recent_messages
+
+
+class Command(BaseCommand):
+    help = 'Load-test ChatConsumer in-process on a throwaway test database and print a JSON report'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50, help='Connected users sending messages')
+        parser.add_argument('--rate', type=float, default=1.0, help='Messages per second sent by each user')
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds of message load')
+        parser.add_argument('--idle-users', type=int, default=0, help='Extra connected users that only churn presence')
+        parser.add_argument('--churn', type=float, default=0.0, help='Idle user reconnects per second')
+        parser.add_argument('--protocol', type=int, choices=(1, 2), default=1, help='Wire protocol version')
+        parser.add_argument('--batch', action='store_true', help='Connect with ?batch=1')
+        parser.add_argument('--seed', type=int, help='Seed of the random receivers and churn')
+        parser.add_argument('--output', help='Write the report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        if options['users'] < 2:
+            self.stderr.write('--users must be at least 2')
+            return
+
+        # A fresh test database, like the test runner's, so real data is
+        # never touched and every run starts from the same state
+        databases = setup_databases(verbosity=0, interactive=False, aliases={'default'})
+        try:
+            with override_settings(**BENCHMARK_SETTINGS):
+                report = self.run(options)
+        finally:
+            teardown_databases(databases, verbosity=0)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def run(self, options):
+        # Backends are built once per process; rebuild them from the overrides
+        get_presence_store.cache_clear()
+        get_recent_messages.cache_clear()
+        profile_cache.clear()
+        for key in overload_stats:
+            overload_stats[key] = 0
+
+        users = self.create_users('bench', options['users'])
+        idle_users = self.create_users('idle', options['idle_users'])
+        try:
+            return asyncio.run(run_benchmark(
+                users,
+                idle_users,
+                rate=options['rate'],
+                duration=options['duration'],
+                churn=options['churn'],
+                protocol=options['protocol'],
+                batch=options['batch'],
+                seed=options['seed'],
+            ))
+        finally:
+            get_presence_store.cache_clear()
+            get_recent_messages.cache_clear()
+
+    @staticmethod
+    def create_users(prefix, count):
+        """(User, UserProfile ID) pairs; no passwords, sockets are authenticated directly"""
+        users = User.objects.bulk_create(User(username=f'{prefix}{i:05d}') for i in range(count))
+        profiles = UserProfile.objects.bulk_create(UserProfile(user=user) for user in users)
+        return [(user, profile.id) for user, profile in zip(users, profiles)]
@@ -0,0 +1,41 @@
+import glob
+import io
+import os
+import pstats
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+SORT_KEYS = ('cumulative', 'tottime', 'ncalls')
+
+
+class Command(BaseCommand):
+    help = 'Summarize the hottest functions of the sampled profiles in PROFILING_DIR'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'entry_points', nargs='*',
+            help='Only these entry points, e.g. ws.websocket.receive or http.get_messages. Defaults to all.',
+        )
+        parser.add_argument('--sort', choices=SORT_KEYS, default='cumulative', help='Order of the functions')
+        parser.add_argument('--limit', type=int, default=25, help='Functions to show per entry point')
+        parser.add_argument('--dir', default=settings.PROFILING_DIR, help='Directory of the .prof files')
+
+    def handle(self, *args, **options):
+        # Every worker writes <entry point>.<pid>.prof; merge them per entry point
+        files = {}
+        for path in sorted(glob.glob(os.path.join(options['dir'], '*.prof'))):
+            entry_point = os.path.basename(path).rsplit('.', 2)[0]
+            if not options['entry_points'] or entry_point in options['entry_points']:
+                files.setdefault(entry_point, []).append(path)
+        if not files:
+            raise CommandError(f"No profiles in {options['dir']}; is PROFILING_ENABLED on?")
+
+        for entry_point, paths in files.items():
+            output = io.StringIO()
+            stats = pstats.Stats(*paths, stream=output)
+            stats.strip_dirs().sort_stats(options['sort']).print_stats(options['limit'])
+            self.stdout.write(self.style.MIGRATE_HEADING(
+                f'{entry_point}: {len(paths)} worker file(s), {stats.total_tt:.3f}s profiled'
+            ))
+            self.stdout.write(output.getvalue())
@@ -0,0 +1,82 @@
+import hashlib
+import os
+
+from django.core import signing
+from django.core.files.storage import default_storage
+
+from .models import MediaBlob
+
+MEDIA_ID_SALT = 'chat.media'
+# Uploads must be referenced by a chat message within this many seconds
+MEDIA_ID_MAX_AGE = 60 * 60
+
+
+class InvalidMediaId(ValueError):
+    pass
+
+
+def file_digest(uploaded_file):
+    """SHA-256 of an uploaded file, read chunk by chunk"""
+    sha256 = hashlib.sha256()
+    for chunk in uploaded_file.chunks():
+        sha256.update(chunk)
+    uploaded_file.seek(0)
+    return sha256.hexdigest()
+
+
+def blob_path(digest, extension):
+    """Sharded location of a blob, e.g. media/cas/ab/cd/abcd….jpg"""
+    return f'media/cas/{digest[:2]}/{digest[2:4]}/{digest}{extension}'
+
+
+def store_blob(uploaded_file):
+    """
+    Store a file under the digest of its content and return its MediaBlob.
+
+    Identical bytes are only written once: a known digest returns the
+    existing blob without touching storage. Since a path never changes
+    content, the URLs can be cached by clients indefinitely.
+    """
+    digest = file_digest(uploaded_file)
+    blob = MediaBlob.objects.filter(digest=digest).first()
+    if blob is not None:
+        return blob
+
+    extension = os.path.splitext(uploaded_file.name)[1].lower() or '.jpg'
+    path = blob_path(digest, extension)
+    saved_path = path if default_storage.exists(path) else default_storage.save(path, uploaded_file)
+
+    blob, created = MediaBlob.objects.get_or_create(
+        digest=digest,
+        defaults={
+            'path': saved_path,
+            'size': uploaded_file.size,
+            'content_type': getattr(uploaded_file, 'content_type', None) or '',
+        },
+    )
+    if not created and blob.path != saved_path:
+        # A concurrent upload of the same bytes won the race
+        default_storage.delete(saved_path)
+    return blob
+
+
+def store_upload(uploaded_file, profile_id):
+    """
+    Save an uploaded image and return a media id the uploader can attach to
+    a chat message. Runs in the view's worker thread; the storage copies the
+    (already spooled) upload in chunks so the event loop is never involved.
+    """
+    blob = store_blob(uploaded_file)
+    media_id = signing.dumps({'blob': blob.id, 'path': blob.path, 'owner': profile_id}, salt=MEDIA_ID_SALT)
+    return media_id, blob.url
+
+
+def resolve_media_id(media_id, profile_id):
+    """Return the (MediaBlob ID, storage path) behind a media id issued to ``profile_id``"""
+    try:
+        payload = signing.loads(media_id, salt=MEDIA_ID_SALT, max_age=MEDIA_ID_MAX_AGE)
+    except signing.BadSignature:
+        raise InvalidMediaId('Invalid or expired media_id')
+    if payload.get('owner') != profile_id or 'blob' not in payload:
+        raise InvalidMediaId('Invalid or expired media_id')
+    return payload['blob'], payload['path']
@@ -0,0 +1,350 @@
+"""
+In-process metrics, served in the Prometheus text format on /metrics.
+
+Counters, gauges and histograms live in plain Python objects; an update is
+an addition under an uncontended lock, cheap enough for every frame. Each
+metric may have labels, whose children are created on first use.
+
+Workers are separate processes, so with METRICS_DIR set every process
+writes its values to METRICS_DIR/<pid>.json every METRICS_FLUSH_INTERVAL
+seconds (from a background thread started by the ASGI lifespan) and a
+scrape adds up the files of all processes. Counters and histograms of
+processes that stopped writing are kept, so totals do not go backwards
+when a worker restarts; their gauges are dropped, as the sockets they
+counted are gone. Empty METRICS_DIR whenever the service starts.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from 0.5ms to 10s
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Buckets for counts of users, frames and bytes
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096, 16384, 65536)
+
+
+class _Timer:
+    """Observe the wall time of a block or a (sync) function call"""
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __call__(self, function):
+        @wraps(function)
+        def timed(*args, **kwargs):
+            # A fresh timer per call, so concurrent calls do not share one
+            with _Timer(self.histogram):
+                return function(*args, **kwargs)
+        return timed
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+
+class _CounterValue:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def snapshot(self):
+        return self.value
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One count per bucket plus +Inf; made cumulative on export
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def snapshot(self):
+        with self._lock:
+            return {'counts': list(self.counts), 'sum': self.sum}
+
+
+class Metric:
+    """A named metric with optional labels; unlabelled metrics update directly"""
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        self._unlabelled = None if self.labelnames else self.labels()
+        registry.register(self)
+
+    def _new_value(self):
+        return _CounterValue()
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_value())
+        return child
+
+    def snapshot(self):
+        return [[list(values), child.snapshot()] for values, child in list(self._children.items())]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1):
+        self._unlabelled.inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1):
+        self._unlabelled.inc(amount)
+
+    def dec(self, amount=1):
+        self._unlabelled.dec(amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=TIME_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labelnames)
+
+    def _new_value(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._unlabelled.observe(value)
+
+    def time(self):
+        return self._unlabelled.time()
+
+
+class CallbackCounter:
+    """A counter whose value is read from elsewhere when metrics are collected"""
+    kind = 'counter'
+    labelnames = ()
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self._read = read
+        registry.register(self)
+
+    def snapshot(self):
+        try:
+            return [[[], self._read()]]
+        except Exception:
+            logger.exception('Failed to read metric %s', self.name)
+            return []
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self._flusher = None
+        self._stop = threading.Event()
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+
+    def snapshot(self):
+        """This process's values, JSON-serializable"""
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def _snapshot_path(self):
+        return os.path.join(settings.METRICS_DIR, f'{os.getpid()}.json')
+
+    def flush(self):
+        """Write this process's snapshot for the other workers' scrapes"""
+        if not settings.METRICS_DIR:
+            return
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        # Written aside and renamed, so a scrape never reads half a file
+        fd, path = tempfile.mkstemp(dir=settings.METRICS_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path, self._snapshot_path())
+
+    def start_flusher(self):
+        if not settings.METRICS_DIR or self._flusher is not None:
+            return
+        self._stop.clear()
+        self._flusher = threading.Thread(target=self._flush_periodically, name='metrics-flusher', daemon=True)
+        self._flusher.start()
+
+    def stop_flusher(self):
+        if self._flusher is None:
+            return
+        self._stop.set()
+        self._flusher.join()
+        self._flusher = None
+        self.flush()
+
+    def _flush_periodically(self):
+        while not self._stop.wait(settings.METRICS_FLUSH_INTERVAL):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to write metrics snapshot')
+
+    def collect(self):
+        """Snapshots of every process to add up: only this one without METRICS_DIR"""
+        if not settings.METRICS_DIR:
+            return [(self.snapshot(), True)]
+        self.flush()
+        stale_before = time.time() - 3 * settings.METRICS_FLUSH_INTERVAL
+        snapshots = []
+        for filename in os.listdir(settings.METRICS_DIR):
+            if not filename.endswith('.json'):
+                continue
+            path = os.path.join(settings.METRICS_DIR, filename)
+            try:
+                live = os.path.getmtime(path) >= stale_before
+                with open(path) as f:
+                    snapshots.append((json.load(f), live))
+            except (OSError, ValueError):
+                # Removed or replaced while listing
+                continue
+        return snapshots
+
+    def render(self):
+        """All processes' metrics, added up, in the Prometheus text format"""
+        totals = {}
+        for snapshot, live in self.collect():
+            for name, samples in snapshot.items():
+                metric = self.metrics.get(name)
+                if metric is None or (metric.kind == 'gauge' and not live):
+                    continue
+                merged = totals.setdefault(name, {})
+                for values, value in samples:
+                    key = tuple(values)
+                    if metric.kind == 'histogram':
+                        total = merged.setdefault(key, {'counts': [0] * len(value['counts']), 'sum': 0})
+                        total['counts'] = [a + b for a, b in zip(total['counts'], value['counts'])]
+                        total['sum'] += value['sum']
+                    else:
+                        merged[key] = merged.get(key, 0) + value
+
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f'# HELP {name} {metric.help}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for key, value in sorted(totals.get(name, {}).items()):
+                labels = list(zip(metric.labelnames, key))
+                if metric.kind == 'histogram':
+                    cumulative = 0
+                    for bound, count in zip(list(metric.buckets) + ['+Inf'], value['counts']):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{_labels(labels + [("le", bound)])} {cumulative}')
+                    lines.append(f'{name}_sum{_labels(labels)} {value["sum"]}')
+                    lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+                else:
+                    lines.append(f'{name}{_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = Registry()
+
+
+def _overload(key):
+    from .ratelimit import overload_stats
+    return lambda: overload_stats[key]
+
+
+def _recent(attribute):
+    def read():
+        from .recent import get_recent_messages
+        # Only report a cache this process has actually built
+        if get_recent_messages.cache_info().currsize == 0:
+            return 0
+        return getattr(get_recent_messages(), attribute)
+    return read
+
+
+def _dropped_log_records():
+    from . import logqueue
+    return logqueue.dropped_records
+
+
+def _profiles(attribute):
+    def read():
+        from .profiles import profile_cache
+        return getattr(profile_cache, attribute)
+    return read
+
+
+# WebSocket consumer
+WS_CONNECTIONS = Gauge('chat_ws_connections', 'Open WebSocket connections')
+WS_CONNECTS = Counter('chat_ws_connects_total', 'Accepted WebSocket connections')
+WS_MESSAGES_RECEIVED = Counter('chat_ws_messages_received_total', 'Frames received from clients', ['type'])
+WS_MESSAGES_DELIVERED = Counter('chat_ws_messages_delivered_total', 'Chat messages forwarded to sockets', ['type'])
+WS_RECEIVE_SECONDS = Histogram('chat_ws_receive_seconds', 'Time to handle one received frame')
+WS_BATCH_FRAMES = Histogram('chat_ws_batch_frames', 'Frames per batched array frame', buckets=SIZE_BUCKETS)
+SAVE_MESSAGE_SECONDS = Histogram('chat_save_message_seconds', 'Database time to save a chat message')
+GROUP_SEND_SECONDS = Histogram('chat_group_send_seconds', 'Time of channel layer group sends', ['target'])
+PRESENCE_SNAPSHOT_USERS = Histogram(
+    'chat_presence_snapshot_users', 'Users in each presence snapshot sent', buckets=SIZE_BUCKETS
+)
+PRESENCE_DELTA_BYTES = Histogram(
+    'chat_presence_delta_bytes', 'Size of each broadcast presence delta (v1 frame)', buckets=SIZE_BUCKETS
+)
+
+# HTTP API
+GET_MESSAGES_SECONDS = Histogram('chat_get_messages_seconds', 'Time to serve a page of /api/messages/')
+
+# Counters kept by other modules
+CallbackCounter('chat_ws_rate_limited_total', 'Inbound messages refused by rate limits', _overload('rate_limited'))
+CallbackCounter('chat_ws_frames_dropped_total', 'Outbound frames dropped on full queues', _overload('frames_dropped'))
+CallbackCounter('chat_ws_slow_disconnects_total', 'Sockets closed for not reading', _overload('slow_disconnects'))
+CallbackCounter('chat_recent_cache_hits_total', 'Recent-messages cache hits', _recent('hits'))
+CallbackCounter('chat_recent_cache_misses_total', 'Recent-messages cache misses', _recent('misses'))
+CallbackCounter('chat_profile_cache_hits_total', 'Profile identity cache hits', _profiles('hits'))
+CallbackCounter('chat_profile_cache_misses_total', 'Profile identity cache misses', _profiles('misses'))
+CallbackCounter('chat_log_records_dropped_total', 'Log records dropped on a full logging queue', _dropped_log_records)
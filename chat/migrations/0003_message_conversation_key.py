@@ -0,0 +1,36 @@
+from django.db import migrations, models
+from django.db.models import Case, CharField, F, Value, When
+from django.db.models.functions import Cast, Concat
+
+
+def populate_conversation_key(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    sender = Cast('sender_id', CharField())
+    receiver = Cast('receiver_id', CharField())
+    Message.objects.update(
+        conversation_key=Case(
+            When(sender_id__lte=F('receiver_id'), then=Concat(sender, Value(':'), receiver)),
+            default=Concat(receiver, Value(':'), sender),
+            output_field=CharField(),
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_remove_message_image_message_image_url'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='conversation_key',
+            field=models.CharField(default='', editable=False, max_length=41),
+        ),
+        migrations.RunPython(populate_conversation_key, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation_key', '-timestamp', '-id'], name='chat_msg_conversation_idx'),
+        ),
+    ]
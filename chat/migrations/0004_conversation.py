@@ -0,0 +1,49 @@
+# Generated by Django 5.2 on 2026-10-18 01:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def populate_conversations(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    Conversation = apps.get_model('chat', 'Conversation')
+    latest_ids = Message.objects.values('conversation_key').annotate(latest_id=Max('id')).values_list('latest_id', flat=True)
+    conversations = []
+    for message in Message.objects.filter(id__in=list(latest_ids)).iterator():
+        low, high = sorted((message.sender_id, message.receiver_id))
+        conversations.append(Conversation(
+            key=message.conversation_key,
+            user_a_id=low,
+            user_b_id=high,
+            last_message_id=message.id,
+            last_activity=message.timestamp,
+        ))
+    Conversation.objects.bulk_create(conversations, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_message_conversation_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=41, unique=True)),
+                ('last_activity', models.DateTimeField()),
+                ('unread_a', models.PositiveIntegerField(default=0)),
+                ('unread_b', models.PositiveIntegerField(default=0)),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message')),
+                ('user_a', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.userprofile')),
+                ('user_b', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.userprofile')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user_a', '-last_activity'], name='chat_conv_user_a_idx'), models.Index(fields=['user_b', '-last_activity'], name='chat_conv_user_b_idx')],
+            },
+        ),
+        migrations.RunPython(populate_conversations, migrations.RunPython.noop),
+    ]
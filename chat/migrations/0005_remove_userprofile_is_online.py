@@ -0,0 +1,17 @@
+# Generated by Django 5.2 on 2026-10-18 01:32
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_conversation'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='userprofile',
+            name='is_online',
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2 on 2026-10-18 01:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_mediablob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['receiver', 'id'], name='chat_msg_receiver_id_idx'),
+        ),
+    ]
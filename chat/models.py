@@ -1,11 +1,11 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
 
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     profile_picture = models.ImageField(upload_to='profile_pics/', blank=True, null=True)
-    is_online = models.BooleanField(default=False)
 
     def __str__(self):
         return self.user.username
@@ -14,15 +14,192 @@ class UserProfile(models.Model):
         db_table = 'chat_userprofile'
 
 
+class MediaBlob(models.Model):
+    """An uploaded file stored once under the SHA-256 digest of its bytes"""
+    digest = models.CharField(max_length=64, unique=True)
+    path = models.CharField(max_length=255)
+    size = models.PositiveIntegerField()
+    content_type = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def url(self):
+        return default_storage.url(self.path)
+
+    def __str__(self):
+        return self.path
+
+
 class Message(models.Model):
     sender = models.ForeignKey(UserProfile, related_name='sent_messages', on_delete=models.CASCADE)
     receiver = models.ForeignKey(UserProfile, related_name='received_messages', on_delete=models.CASCADE)
+    # Canonical "low:high" pair of profile IDs, identical in both directions,
+    # so a whole conversation can be walked through a single index
+    conversation_key = models.CharField(max_length=41, default='', editable=False)
+    content = models.TextField()
+    image_url = models.CharField(blank=True, null=True)
+    media = models.ForeignKey(MediaBlob, related_name='messages', blank=True, null=True, on_delete=models.SET_NULL)
+    timestamp = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['conversation_key', '-timestamp', '-id'], name='chat_msg_conversation_idx'),
+            # Reconnect sync: messages a user received after a given ID
+            models.Index(fields=['receiver', 'id'], name='chat_msg_receiver_id_idx'),
+        ]
+
+    @staticmethod
+    def conversation_key_for(profile_id, other_profile_id):
+        """Return the conversation key shared by two UserProfile IDs"""
+        low, high = sorted((int(profile_id), int(other_profile_id)))
+        return f'{low}:{high}'
+
+    def save(self, *args, **kwargs):
+        if not self.conversation_key:
+            self.conversation_key = self.conversation_key_for(self.sender_id, self.receiver_id)
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.sender.user.username} to {self.receiver.user.username} at {self.timestamp}"
+
+
+class ConversationManager(models.Manager):
+    def for_profile(self, profile):
+        """Conversations a profile takes part in, most recently active first"""
+        return self.filter(
+            models.Q(user_a_id=profile.id) | models.Q(user_b_id=profile.id)
+        ).select_related('user_a__user', 'user_b__user', 'last_message')
+
+    def record_message(self, message):
+        """
+        Move a conversation's last message/activity forward and bump the
+        receiver's unread counter. Call inside the transaction that saved
+        ``message`` so the inbox never disagrees with the history.
+        """
+        self.record_messages([message])
+
+    def record_messages(self, messages):
+        """Batch form of ``record_message``: one UPDATE per conversation touched"""
+        changes = {}
+        for message in messages:
+            change = changes.setdefault(message.conversation_key, {'unread_a': 0, 'unread_b': 0})
+            change['last_message'] = message
+            low = min(message.sender_id, message.receiver_id)
+            change['unread_a' if message.receiver_id == low else 'unread_b'] += 1
+        # Always lock conversations in the same order, so concurrent batches
+        # touching the same ones cannot deadlock
+        for key in sorted(changes):
+            self._apply(key, **changes[key])
+
+    def _apply(self, key, last_message, unread_a, unread_b):
+        updated = self.filter(key=key).update(
+            last_message=last_message,
+            last_activity=last_message.timestamp,
+            unread_a=models.F('unread_a') + unread_a,
+            unread_b=models.F('unread_b') + unread_b,
+        )
+        if not updated:
+            conversation, created = self.get_or_create(
+                key=key,
+                defaults={
+                    'user_a_id': min(last_message.sender_id, last_message.receiver_id),
+                    'user_b_id': max(last_message.sender_id, last_message.receiver_id),
+                    'last_message': last_message,
+                    'last_activity': last_message.timestamp,
+                    'unread_a': unread_a,
+                    'unread_b': unread_b,
+                },
+            )
+            if not created:
+                # Lost a race with another first message; apply ours on top
+                self._apply(key, last_message, unread_a, unread_b)
+
+    def mark_read(self, profile_id, other_profile_id):
+        """Reset the unread counter of ``profile_id`` in its conversation with ``other_profile_id``"""
+        low, _ = sorted((int(profile_id), int(other_profile_id)))
+        unread_field = 'unread_a' if int(profile_id) == low else 'unread_b'
+        self.filter(
+            key=Message.conversation_key_for(profile_id, other_profile_id),
+            **{f'{unread_field}__gt': 0},
+        ).update(**{unread_field: 0})
+
+
+class Conversation(models.Model):
+    """Denormalized inbox row, one per pair of profiles that exchanged messages"""
+    key = models.CharField(max_length=41, unique=True)
+    # user_a always holds the lower profile ID, user_b the higher one
+    user_a = models.ForeignKey(UserProfile, related_name='+', on_delete=models.CASCADE, db_index=False)
+    user_b = models.ForeignKey(UserProfile, related_name='+', on_delete=models.CASCADE, db_index=False)
+    last_message = models.ForeignKey(Message, related_name='+', null=True, blank=True, on_delete=models.SET_NULL)
+    last_activity = models.DateTimeField()
+    unread_a = models.PositiveIntegerField(default=0)
+    unread_b = models.PositiveIntegerField(default=0)
+
+    objects = ConversationManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user_a', '-last_activity'], name='chat_conv_user_a_idx'),
+            models.Index(fields=['user_b', '-last_activity'], name='chat_conv_user_b_idx'),
+        ]
+
+    def peer_of(self, profile):
+        return self.user_b if self.user_a_id == profile.id else self.user_a
+
+    def unread_for(self, profile):
+        return self.unread_a if self.user_a_id == profile.id else self.unread_b
+
+    def __str__(self):
+        return f"{self.user_a} and {self.user_b}"
+
+
+class Room(models.Model):
+    """A group conversation; its messages are stored once, not per member"""
+    name = models.CharField(max_length=100)
+    created_by = models.ForeignKey(UserProfile, related_name='+', null=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_activity = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-last_activity', '-id'], name='chat_room_activity_idx'),
+        ]
+
+    def __str__(self):
+        return self.name
+
+
+class RoomMembership(models.Model):
+    room = models.ForeignKey(Room, related_name='memberships', on_delete=models.CASCADE)
+    profile = models.ForeignKey(UserProfile, related_name='room_memberships', on_delete=models.CASCADE)
+    joined_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'profile'], name='chat_room_member_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['profile', 'room'], name='chat_room_member_profile_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.profile} in {self.room}"
+
+
+class RoomMessage(models.Model):
+    room = models.ForeignKey(Room, related_name='messages', on_delete=models.CASCADE)
+    sender = models.ForeignKey(UserProfile, related_name='room_messages', on_delete=models.CASCADE)
     content = models.TextField()
     image_url = models.CharField(blank=True, null=True)
+    media = models.ForeignKey(MediaBlob, related_name='room_messages', blank=True, null=True, on_delete=models.SET_NULL)
     timestamp = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['room', '-timestamp', '-id'], name='chat_room_msg_history_idx'),
+        ]
 
     def __str__(self):
-        return f"{self.sender.user.username} to {self.receiver.user.username} at {self.timestamp}"
\ No newline at end of file
+        return f"{self.sender} in {self.room} at {self.timestamp}"
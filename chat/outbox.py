@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+from urllib.parse import parse_qs
+
+from .metrics import WS_BATCH_FRAMES
+from .ratelimit import overload_stats
+
+logger = logging.getLogger(__name__)
+
+
+def batching_requested(scope):
+    """Whether a WebSocket client opted into array frames with ?batch=1"""
+    query = parse_qs(scope.get('query_string', b'').decode())
+    return query.get('batch') == ['1']
+
+
+class FrameBatcher:
+    """
+    Coalesces a connection's outgoing frames into array frames.
+
+    Frames added within ``window`` seconds of the first pending one are
+    sent together, or as soon as ``max_frames`` are pending. Frames are
+    already encoded, so a batch is joined without re-encoding anything:
+    a JSON array for protocol v1 and a msgpack array for v2. A batch is
+    only droppable if every frame in it is.
+    """
+
+    def __init__(self, send_frame, codec, window, max_frames):
+        self._send_frame = send_frame
+        self.codec = codec
+        self.window = window
+        self.max_frames = max_frames
+        self._pending = []
+        self._droppable = True
+        self._timer = None
+        self._flushing = None
+        self.frames = 0
+        self.batches = 0
+        self.largest = 0
+        # Batch sizes bucketed by powers of two: 1, 2, 4, 8, ...
+        self.sizes = Counter()
+
+    async def add(self, frame, droppable=False):
+        self._pending.append(frame)
+        self._droppable = self._droppable and droppable
+        if len(self._pending) >= self.max_frames:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._schedule_flush)
+
+    def _schedule_flush(self):
+        self._timer = None
+        self._flushing = asyncio.ensure_future(self._flush_in_background())
+
+    async def _flush_in_background(self):
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception('Failed to send a batch of frames')
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        droppable, self._droppable = self._droppable, True
+        if not batch:
+            return
+        self.frames += len(batch)
+        self.batches += 1
+        self.largest = max(self.largest, len(batch))
+        self.sizes[1 << (len(batch) - 1).bit_length()] += 1
+        WS_BATCH_FRAMES.observe(len(batch))
+        await self._send_frame(self.codec.join(batch), droppable)
+
+    def close(self):
+        """Drop whatever is still pending once the socket is gone"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flushing is not None:
+            self._flushing.cancel()
+        self._pending = []
+        logger.debug('Frame batching stats: %s', self.stats())
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'batches': self.batches,
+            'mean_batch': round(self.frames / self.batches, 2) if self.batches else 0,
+            'largest_batch': self.largest,
+            'batch_sizes': {f'<={size}': count for size, count in sorted(self.sizes.items())},
+        }
+
+
+class OutboundQueue:
+    """
+    Bounded buffer between a consumer and its socket.
+
+    Frames are written by a single task in order, so a slow reader only
+    holds up its own queue. Once ``max_size`` frames are waiting the oldest
+    droppable frame (presence, which clients resync on a version gap) makes
+    room for each new one. Durable frames are never dropped: when one does
+    not fit, or a socket stays above ``high_water`` queued frames for more
+    than ``slow_timeout`` seconds, the socket is handed to ``on_slow``, which
+    is expected to close it so the client reconnects and replays with
+    ``?since=``.
+    """
+
+    def __init__(self, write_frame, max_size, high_water, slow_timeout, on_slow):
+        self._write_frame = write_frame
+        # (frame, droppable) pairs
+        self._frames = deque()
+        self._ready = asyncio.Event()
+        self.max_size = max_size
+        self.high_water = high_water
+        self.slow_timeout = slow_timeout
+        self._on_slow = on_slow
+        self._behind_since = None
+        self._slow = False
+        self.dropped = 0
+        self._task = asyncio.ensure_future(self._run())
+
+    def put(self, frame, droppable=False):
+        """
+        Queue a frame without waiting. False if a frame was dropped for it,
+        or it was not queued because the socket is being closed as slow.
+        """
+        if len(self._frames) >= self.high_water:
+            now = time.monotonic()
+            if self._behind_since is None:
+                self._behind_since = now
+            elif now - self._behind_since > self.slow_timeout:
+                self._close_slow(f'{now - self._behind_since:.1f}s behind')
+        else:
+            self._behind_since = None
+
+        if self._slow:
+            # Whatever is queued now is replayed after the reconnect
+            return False
+        if len(self._frames) < self.max_size:
+            self._append(frame, droppable)
+            return True
+        for i, (_, queued_droppable) in enumerate(self._frames):
+            if queued_droppable:
+                del self._frames[i]
+                self._count_dropped()
+                self._append(frame, droppable)
+                return False
+        if droppable:
+            self._count_dropped()
+        else:
+            self._close_slow('out of room for a durable frame')
+        return False
+
+    def _append(self, frame, droppable):
+        self._frames.append((frame, droppable))
+        self._ready.set()
+
+    def _count_dropped(self):
+        self.dropped += 1
+        overload_stats['frames_dropped'] += 1
+
+    def _close_slow(self, reason):
+        if self._slow:
+            return
+        self._slow = True
+        overload_stats['slow_disconnects'] += 1
+        logger.warning('Closing a socket %s with %d frames queued', reason, len(self._frames))
+        self._on_slow()
+
+    async def _run(self):
+        while True:
+            while not self._frames:
+                self._ready.clear()
+                await self._ready.wait()
+            frame, _ = self._frames.popleft()
+            try:
+                await self._write_frame(frame)
+            except Exception:
+                logger.exception('Failed to write a frame')
+                return
+
+    def close(self):
+        self._task.cancel()
@@ -0,0 +1,82 @@
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(obj, field='timestamp'):
+    """Build an opaque cursor from a row's (field, id) position"""
+    return encode_cursor_value(getattr(obj, field).isoformat(), obj.pk)
+
+
+def encode_cursor_value(isoformat, pk):
+    """Build a cursor from an ISO 8601 datetime string and an id"""
+    raw = f'{isoformat}|{pk}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into a (datetime, id) tuple"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        value, pk = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+        return datetime.fromisoformat(value), int(pk)
+    except (ValueError, UnicodeDecodeError):
+        raise InvalidCursor(f'Invalid cursor: {cursor}')
+
+
+def parse_page_size(value):
+    """Clamp a requested page size to 1..MAX_PAGE_SIZE"""
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def paginate_keyset(queryset, before=None, after=None, limit=DEFAULT_PAGE_SIZE, field='timestamp'):
+    """
+    Fetch one page of a (field, id) ordered queryset, ``field`` being a
+    datetime column (``timestamp`` by default).
+
+    Without cursors the newest page is returned; ``before`` walks towards
+    older rows and ``after`` towards newer ones. Each page is a single range
+    scan on the (…, field, id) index, so its cost does not depend on how
+    deep into the history it is. Rows are returned oldest first.
+
+    Returns (rows, page) where ``page`` holds the cursors for the next
+    older/newer pages and whether more rows exist in the requested direction.
+    """
+    if before and after:
+        raise InvalidCursor('Use either before or after, not both')
+
+    if after:
+        value, pk = decode_cursor(after)
+        queryset = queryset.filter(Q(**{f'{field}__gt': value}) | Q(**{field: value, 'id__gt': pk}))
+        rows = list(queryset.order_by(field, 'id')[:limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        has_older = True
+    else:
+        if before:
+            value, pk = decode_cursor(before)
+            queryset = queryset.filter(Q(**{f'{field}__lt': value}) | Q(**{field: value, 'id__lt': pk}))
+        rows = list(queryset.order_by(f'-{field}', '-id')[:limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+        has_older = has_more
+
+    page = {
+        'before': encode_cursor(rows[0], field) if rows and has_older else None,
+        'after': encode_cursor(rows[-1], field) if rows else after,
+        'has_more': has_more,
+    }
+    return rows, page
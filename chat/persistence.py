@@ -0,0 +1,156 @@
+import asyncio
+import logging
+
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import connections, transaction
+
+from .db_router import stick_to_primary
+from .metrics import registry
+from .models import Conversation, Message
+from .presence import run_presence_sweeper
+from .profiles import listen_for_invalidations
+from .profiling import install_signal_handler
+from .recent import remember_message
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    """
+    Per-process write-behind buffer for chat messages.
+
+    ``submit`` queues an unsaved Message and returns a future. The buffer is
+    written with one ``bulk_create`` (plus one inbox UPDATE per conversation)
+    once it holds ``flush_size`` messages or ``flush_interval`` seconds after
+    the first one was queued, whichever comes first. Futures resolve to the
+    saved Message after the transaction commits, or to the exception that
+    prevented it, so callers acknowledge only durable messages.
+    """
+
+    def __init__(self, flush_size, flush_interval):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._timer = None
+        self._flush_lock = asyncio.Lock()
+        self._flushes = set()
+
+    def submit(self, message):
+        future = asyncio.get_running_loop().create_future()
+        self._buffer.append((message, future))
+        if len(self._buffer) >= self.flush_size:
+            self._schedule_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self._schedule_flush)
+        return future
+
+    def _schedule_flush(self):
+        task = asyncio.ensure_future(self.flush())
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._buffer = self._buffer, []
+        if not batch:
+            return
+
+        # Flushes run one at a time so batches commit in submission order
+        async with self._flush_lock:
+            try:
+                results = await self._write([message for message, _ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    @database_sync_to_async
+    def _write(self, messages):
+        try:
+            with transaction.atomic():
+                Message.objects.bulk_create(messages)
+                Conversation.objects.record_messages(messages)
+            for message in messages:
+                remember_message(message)
+            stick_to_primary(*{message.sender_id for message in messages}, *{message.receiver_id for message in messages})
+            return messages
+        except Exception:
+            logger.exception('Batch insert of %d messages failed, retrying one by one', len(messages))
+            for message in messages:
+                message.pk = None
+                message._state.adding = True
+
+        # Isolate the bad rows (e.g. a receiver deleted meanwhile) so the
+        # rest of the batch is still persisted
+        results = []
+        for message in messages:
+            try:
+                with transaction.atomic():
+                    message.save(force_insert=True)
+                    Conversation.objects.record_message(message)
+                remember_message(message)
+                stick_to_primary(message.sender_id, message.receiver_id)
+                results.append(message)
+            except Exception as e:
+                message.pk = None
+                results.append(Exception(f"Failed to save message: {str(e)}"))
+        return results
+
+    async def drain(self):
+        """Write everything still buffered; used on graceful shutdown"""
+        await self.flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+
+_writer = None
+
+
+def get_message_writer():
+    """The process-wide MessageWriter, created on first use"""
+    global _writer
+    if _writer is None:
+        _writer = MessageWriter(settings.MESSAGE_FLUSH_SIZE, settings.MESSAGE_FLUSH_INTERVAL)
+    return _writer
+
+
+class LifespanApp:
+    """
+    ASGI lifespan handler: starts this worker's metrics snapshots,
+    profiling toggle, presence sweeps and profile invalidation listener,
+    and drains the message buffer and closes database connections on
+    shutdown
+    """
+
+    async def __call__(self, scope, receive, send):
+        tasks = []
+        while True:
+            event = await receive()
+            if event['type'] == 'lifespan.startup':
+                registry.start_flusher()
+                install_signal_handler()
+                tasks = [
+                    asyncio.ensure_future(run_presence_sweeper()),
+                    asyncio.ensure_future(listen_for_invalidations()),
+                ]
+                await send({'type': 'lifespan.startup.complete'})
+            elif event['type'] == 'lifespan.shutdown':
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                if _writer is not None:
+                    await _writer.drain()
+                await asyncio.to_thread(registry.stop_flusher)
+                # The consumers' ORM thread holds connections until it exits
+                await sync_to_async(connections.close_all)()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
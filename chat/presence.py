@@ -0,0 +1,289 @@
+import asyncio
+import logging
+import threading
+import time
+from functools import lru_cache
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+from .metrics import PRESENCE_DELTA_BYTES
+from .protocol import encode_frames
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_GROUP = 'presence'
+VERSION_KEY = 'presence:version'
+
+
+async def next_version():
+    """Allocate the version number of the next presence delta"""
+    try:
+        return await cache.aincr(VERSION_KEY)
+    except ValueError:
+        # First delta since the cache was (re)started
+        await cache.aadd(VERSION_KEY, 0, timeout=None)
+        return await cache.aincr(VERSION_KEY)
+
+
+async def current_version():
+    """Version of the latest presence delta handed out"""
+    return await cache.aget(VERSION_KEY, 0)
+
+
+def presence_delta(profile_id, is_online, version):
+    """PRESENCE_GROUP event carrying one user's change, encoded once for all sockets"""
+    # Only the changed user travels over the wire; subscribers patch
+    # their snapshot and resync if they see a version gap
+    frames = encode_frames({
+        "type": "presence",
+        "id": profile_id,
+        "is_online": is_online,
+        "version": version,
+    })
+    PRESENCE_DELTA_BYTES.observe(len(frames['1']))
+    return {"type": "presence_delta", "frames": frames}
+
+
+class PresenceStore:
+    """
+    Tracks live WebSocket connections per UserProfile ID.
+
+    Every connection is registered with an expiry of ``ttl`` seconds that is
+    pushed forward by heartbeats, so a user whose worker died without
+    running ``disconnect`` drops out of the online set within one TTL.
+    A user is online while they hold at least one live connection, from
+    any tab or worker; ``add_connection``/``heartbeat`` and
+    ``remove_connection`` return True only when that changes, so callers
+    broadcast on the first connect and the last disconnect alone.
+    Async methods are for consumers, the sync ``online_ids`` for views.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    async def add_connection(self, profile_id, channel_name):
+        """Register a connection; True if the user just came online"""
+        raise NotImplementedError
+
+    async def heartbeat(self, profile_id, channel_name):
+        """Refresh a connection's expiry; True if the user had expired"""
+        raise NotImplementedError
+
+    async def remove_connection(self, profile_id, channel_name):
+        """Forget a connection; True if it was the user's last one"""
+        raise NotImplementedError
+
+    async def sweep(self):
+        """
+        Forget users whose connections all expired without a
+        ``remove_connection`` (their worker died) and return their IDs.
+        Each such user is returned by one sweep only, across all workers.
+        """
+        raise NotImplementedError
+
+    async def aonline_ids(self, profile_ids):
+        """Return the subset of ``profile_ids`` that is currently online"""
+        raise NotImplementedError
+
+    def online_ids(self, profile_ids):
+        """Sync variant of ``aonline_ids``"""
+        raise NotImplementedError
+
+
+class InMemoryPresenceStore(PresenceStore):
+    """Single-process store for DEBUG, mirrors InMemoryChannelLayer"""
+
+    def __init__(self, ttl):
+        super().__init__(ttl)
+        self._connections = {}
+        # Users who expired since the last sweep
+        self._expired = set()
+        self._lock = threading.Lock()
+
+    def _prune(self, profile_id, now):
+        connections = self._connections.get(profile_id)
+        if connections is None:
+            return None
+        for channel_name, expires_at in list(connections.items()):
+            if expires_at <= now:
+                del connections[channel_name]
+        if not connections:
+            del self._connections[profile_id]
+            self._expired.add(profile_id)
+            return None
+        return connections
+
+    async def add_connection(self, profile_id, channel_name):
+        now = time.monotonic()
+        with self._lock:
+            was_online = self._prune(profile_id, now) is not None
+            # Back online before a sweep noticed; the caller broadcasts that
+            self._expired.discard(profile_id)
+            self._connections.setdefault(profile_id, {})[channel_name] = now + self.ttl
+            return not was_online
+
+    async def heartbeat(self, profile_id, channel_name):
+        return await self.add_connection(profile_id, channel_name)
+
+    async def remove_connection(self, profile_id, channel_name):
+        with self._lock:
+            removed = self._connections.get(profile_id, {}).pop(channel_name, None)
+            remaining = self._prune(profile_id, time.monotonic())
+            went_offline = removed is not None and remaining is None
+            if went_offline:
+                # The caller broadcasts this one
+                self._expired.discard(profile_id)
+            return went_offline
+
+    async def sweep(self):
+        now = time.monotonic()
+        with self._lock:
+            for profile_id in list(self._connections):
+                self._prune(profile_id, now)
+            expired, self._expired = self._expired, set()
+            return expired
+
+    async def aonline_ids(self, profile_ids):
+        return self.online_ids(profile_ids)
+
+    def online_ids(self, profile_ids):
+        now = time.monotonic()
+        with self._lock:
+            return {profile_id for profile_id in profile_ids if self._prune(profile_id, now)}
+
+
+class RedisPresenceStore(PresenceStore):
+    """
+    Store shared by all workers.
+
+    ``presence:conn:<id>`` is a sorted set of a user's channel names scored
+    by expiry, and ``presence:online`` scores each user by the expiry of
+    their longest-lived connection, so an online lookup for any number of
+    users is a single ZMSCORE.
+    """
+
+    ONLINE_KEY = 'presence:online'
+
+    # Add or refresh one connection; returns 1 if the user had none live
+    ADD_SCRIPT = """
+        redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+        local live = redis.call('ZCARD', KEYS[1])
+        redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+        redis.call('EXPIRE', KEYS[1], ARGV[4])
+        redis.call('ZADD', KEYS[2], 'GT', ARGV[3], ARGV[5])
+        if live == 0 then
+            return 1
+        end
+        return 0
+    """
+
+    # Drop one connection and rescore the user by what is left; returns 1
+    # if that was the user's last live connection
+    REMOVE_SCRIPT = """
+        local removed = redis.call('ZREM', KEYS[1], ARGV[1])
+        redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+        local latest = redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')
+        if latest[2] then
+            redis.call('ZADD', KEYS[2], latest[2], ARGV[3])
+            return 0
+        end
+        redis.call('ZREM', KEYS[2], ARGV[3])
+        return removed
+    """
+
+    # Take users whose latest connection expired out of the online set and
+    # return them; atomic, so only one worker's sweep reports each
+    SWEEP_SCRIPT = """
+        local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+        if #expired > 0 then
+            redis.call('ZREM', KEYS[1], unpack(expired))
+        end
+        return expired
+    """
+    SWEEP_BATCH = 1000
+
+    def __init__(self, ttl, url=None):
+        super().__init__(ttl)
+        import redis
+        import redis.asyncio
+
+        url = url or settings.REDIS_URL
+        self._redis = redis.Redis.from_url(url)
+        self._aredis = redis.asyncio.Redis.from_url(url)
+        self._add = self._aredis.register_script(self.ADD_SCRIPT)
+        self._remove = self._aredis.register_script(self.REMOVE_SCRIPT)
+        self._sweep = self._aredis.register_script(self.SWEEP_SCRIPT)
+
+    @staticmethod
+    def _connections_key(profile_id):
+        return f'presence:conn:{profile_id}'
+
+    async def add_connection(self, profile_id, channel_name):
+        now = time.time()
+        came_online = await self._add(
+            keys=[self._connections_key(profile_id), self.ONLINE_KEY],
+            args=[channel_name, now, now + self.ttl, self.ttl * 2, profile_id],
+        )
+        return bool(came_online)
+
+    async def heartbeat(self, profile_id, channel_name):
+        return await self.add_connection(profile_id, channel_name)
+
+    async def remove_connection(self, profile_id, channel_name):
+        went_offline = await self._remove(
+            keys=[self._connections_key(profile_id), self.ONLINE_KEY],
+            args=[channel_name, time.time(), profile_id],
+        )
+        return bool(went_offline)
+
+    async def sweep(self):
+        expired = set()
+        while True:
+            batch = await self._sweep(keys=[self.ONLINE_KEY], args=[time.time(), self.SWEEP_BATCH])
+            expired.update(int(profile_id) for profile_id in batch)
+            if len(batch) < self.SWEEP_BATCH:
+                return expired
+
+    @staticmethod
+    def _filter_online(profile_ids, scores):
+        now = time.time()
+        return {profile_id for profile_id, score in zip(profile_ids, scores) if score and score > now}
+
+    async def aonline_ids(self, profile_ids):
+        profile_ids = list(profile_ids)
+        if not profile_ids:
+            return set()
+        return self._filter_online(profile_ids, await self._aredis.zmscore(self.ONLINE_KEY, profile_ids))
+
+    def online_ids(self, profile_ids):
+        profile_ids = list(profile_ids)
+        if not profile_ids:
+            return set()
+        return self._filter_online(profile_ids, self._redis.zmscore(self.ONLINE_KEY, profile_ids))
+
+
+@lru_cache(maxsize=None)
+def get_presence_store():
+    """The process-wide presence store configured by PRESENCE_BACKEND"""
+    return import_string(settings.PRESENCE_BACKEND)(ttl=settings.PRESENCE_TTL)
+
+
+async def sweep_presence():
+    """Broadcast that users whose worker died without a disconnect are offline"""
+    for profile_id in await get_presence_store().sweep():
+        await get_channel_layer().group_send(
+            PRESENCE_GROUP, presence_delta(profile_id, False, await next_version())
+        )
+
+
+async def run_presence_sweeper():
+    """Sweep every PRESENCE_SWEEP_INTERVAL seconds until cancelled (from the lifespan)"""
+    while True:
+        await asyncio.sleep(settings.PRESENCE_SWEEP_INTERVAL)
+        try:
+            await sweep_presence()
+        except Exception:
+            logger.exception('Presence sweep failed')
@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .models import UserProfile
+from .thumbnails import avatar_url, thumbnail_ready
+
+logger = logging.getLogger(__name__)
+
+# Channel layer event that tells every worker to drop a cached profile, and
+# the group of one listener per worker process it is sent to
+INVALIDATE_EVENT = 'profile.invalidate'
+INVALIDATE_GROUP = 'profiles'
+# Group memberships expire (channels_redis' group_expiry), so the listener
+# joins again this often
+INVALIDATE_REJOIN_SECONDS = 3600
+
+
+@dataclass(frozen=True)
+class ProfileIdentity:
+    """The parts of a UserProfile the chat hot paths need"""
+    id: int
+    user_id: int
+    username: str
+    avatar_url: str
+
+
+class ProfileCache:
+    """
+    Bounded LRU of ProfileIdentity, indexed by profile ID and user ID.
+
+    Entries are dropped by model signals in this process and by
+    ``profile.invalidate`` channel layer events in every other one; the TTL
+    bounds staleness for processes that missed an event.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._by_user = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, profile_id):
+        with self._lock:
+            entry = self._entries.get(profile_id)
+            if entry is None or entry[1] < time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(profile_id)
+            self.hits += 1
+            return entry[0]
+
+    def get_by_user(self, user_id):
+        profile_id = self._by_user.get(user_id)
+        return self.get(profile_id) if profile_id is not None else None
+
+    def put(self, identity):
+        with self._lock:
+            self._entries[identity.id] = (identity, time.monotonic() + self.ttl)
+            self._entries.move_to_end(identity.id)
+            self._by_user[identity.user_id] = identity.id
+            while len(self._entries) > self.maxsize:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._by_user.pop(evicted.user_id, None)
+
+    def invalidate(self, profile_id=None, user_id=None):
+        with self._lock:
+            if profile_id is None and user_id is not None:
+                profile_id = self._by_user.get(user_id)
+            entry = self._entries.pop(profile_id, None)
+            if entry is not None:
+                self._by_user.pop(entry[0].user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+
+
+profile_cache = ProfileCache(settings.PROFILE_CACHE_SIZE, settings.PROFILE_CACHE_TTL)
+
+
+def _remember(profile):
+    identity = ProfileIdentity(
+        id=profile.id,
+        user_id=profile.user_id,
+        username=profile.user.username,
+        avatar_url=avatar_url(profile),
+    )
+    # Keep re-reading a profile whose avatar thumbnail is still being made,
+    # so the cache never pins the full-size picture
+    if not profile.profile_picture or thumbnail_ready(profile.profile_picture.name, 'avatar'):
+        profile_cache.put(identity)
+    return identity
+
+
+def get_identity(profile_id):
+    """ProfileIdentity for a UserProfile ID, or None if there is no such profile (sync)"""
+    try:
+        profile_id = int(profile_id)
+    except (TypeError, ValueError):
+        return None
+    identity = profile_cache.get(profile_id)
+    if identity is None:
+        profile = UserProfile.objects.select_related('user').filter(id=profile_id).first()
+        if profile is None:
+            return None
+        identity = _remember(profile)
+    return identity
+
+
+def get_identities(profile_ids):
+    """ProfileIdentity per UserProfile ID for a page of rows: cache misses are read in one query (sync)"""
+    identities = {}
+    missing = set()
+    for profile_id in set(profile_ids):
+        identity = profile_cache.get(profile_id)
+        if identity is None:
+            missing.add(profile_id)
+        else:
+            identities[profile_id] = identity
+    if missing:
+        for profile in UserProfile.objects.select_related('user').filter(id__in=missing):
+            identities[profile.id] = _remember(profile)
+    return identities
+
+
+def get_identity_for_user(user):
+    """ProfileIdentity of a User, creating the UserProfile if it is missing (sync)"""
+    identity = profile_cache.get_by_user(user.id)
+    if identity is None:
+        profile, created = UserProfile.objects.get_or_create(user=user)
+        profile.user = user
+        identity = _remember(profile)
+    return identity
+
+
+async def aget_identity(profile_id):
+    """Async ``get_identity``; only a cache miss queries, through the async ORM"""
+    try:
+        profile_id = int(profile_id)
+    except (TypeError, ValueError):
+        return None
+    identity = profile_cache.get(profile_id)
+    if identity is None:
+        profile = await UserProfile.objects.select_related('user').filter(id=profile_id).afirst()
+        if profile is None:
+            return None
+        identity = await _aremember(profile)
+    return identity
+
+
+async def aget_identity_for_user(user):
+    """Async ``get_identity_for_user``"""
+    identity = profile_cache.get_by_user(user.id)
+    if identity is None:
+        profile, created = await UserProfile.objects.aget_or_create(user=user)
+        profile.user = user
+        identity = await _aremember(profile)
+    return identity
+
+
+async def _aremember(profile):
+    # Resolving a custom avatar's thumbnail may touch storage, which needs
+    # a thread but not the one serializing database access
+    if profile.profile_picture:
+        return await sync_to_async(_remember, thread_sensitive=False)(profile)
+    return _remember(profile)
+
+
+async def listen_for_invalidations():
+    """Drop the profiles other workers report as changed; one per process, run by the lifespan"""
+    layer = get_channel_layer()
+    channel = await layer.new_channel('profiles.')
+    joined_at = None
+    try:
+        while True:
+            try:
+                if joined_at is None or time.monotonic() - joined_at >= INVALIDATE_REJOIN_SECONDS:
+                    await layer.group_add(INVALIDATE_GROUP, channel)
+                    joined_at = time.monotonic()
+                event = await asyncio.wait_for(layer.receive(channel), INVALIDATE_REJOIN_SECONDS)
+            except asyncio.TimeoutError:
+                continue
+            except Exception:
+                logger.exception('Failed to receive profile invalidations')
+                joined_at = None
+                await asyncio.sleep(1)
+                continue
+            if event.get('type') == INVALIDATE_EVENT:
+                profile_cache.invalidate(profile_id=event.get('profile_id'), user_id=event.get('user_id'))
+    finally:
+        if joined_at is not None:
+            await layer.group_discard(INVALIDATE_GROUP, channel)
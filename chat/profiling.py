@@ -0,0 +1,167 @@
+"""
+Sampling profiler for views and consumer events.
+
+While profiling is on (PROFILING_ENABLED, or toggled at runtime with
+SIGUSR2 to a worker) one in PROFILING_SAMPLE_RATE calls of every profiled
+entry point runs under cProfile. Samples are added up per entry point in
+a background thread and written as pstats files to
+PROFILING_DIR/<entry point>.<pid>.prof; ``manage.py profile_summary``
+merges them. While it is off an entry point costs a flag check.
+
+Coroutines are only profiled while they are being stepped, so the time
+other tasks spend on the event loop in between is not charged to them.
+From Python 3.12 cProfile is process-wide, so one sampled call runs at a
+time (others overlapping it go unprofiled) and a sample can include
+frames from other threads running during its steps.
+"""
+import cProfile
+import logging
+import os
+import pstats
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class _State:
+    def __init__(self):
+        self.enabled = settings.PROFILING_ENABLED
+        # Calls seen per entry point while on
+        self.calls = {}
+
+
+_state = _State()
+# Held by the sampled call being profiled; cProfile allows one at a time
+_sampling = threading.Lock()
+_stats = {}
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='profiling')
+
+
+def set_enabled(enabled):
+    _state.enabled = enabled
+
+
+def _toggle(signum, frame):
+    # Nothing but the flag: a signal handler must not take logging's locks
+    _state.enabled = not _state.enabled
+
+
+def install_signal_handler():
+    """Toggle profiling on SIGUSR2; only possible from the main thread"""
+    try:
+        signal.signal(signal.SIGUSR2, _toggle)
+    except (AttributeError, ValueError):
+        # No SIGUSR2 on this platform, or not the main thread
+        pass
+
+
+def _sampled(name):
+    if not _state.enabled:
+        return False
+    # Races between threads only skew the sample slightly
+    calls = _state.calls[name] = _state.calls.get(name, 0) + 1
+    return calls % settings.PROFILING_SAMPLE_RATE == 0
+
+
+def _aggregate(name, profile):
+    stats = _stats.get(name)
+    if stats is None:
+        stats = _stats[name] = pstats.Stats(profile)
+    else:
+        stats.add(profile)
+    os.makedirs(settings.PROFILING_DIR, exist_ok=True)
+    stats.dump_stats(os.path.join(settings.PROFILING_DIR, f'{name}.{os.getpid()}.prof'))
+
+
+def _record(name, profile):
+    # Building and writing the stats happens off the request's thread
+    def report(future):
+        if future.exception() is not None:
+            logger.error('Failed to write profile of %s', name, exc_info=future.exception())
+
+    _writer.submit(_aggregate, name, profile).add_done_callback(report)
+
+
+def _step(profile, step, *args, **kwargs):
+    try:
+        profile.enable()
+    except ValueError:
+        # Another profiling tool (a debugger, coverage) holds the hooks
+        return step(*args, **kwargs)
+    try:
+        return step(*args, **kwargs)
+    finally:
+        profile.disable()
+
+
+class _ProfiledCoroutine:
+    """Await a coroutine with the profiler on only during its own steps"""
+
+    def __init__(self, coroutine, profile):
+        self.coroutine = coroutine
+        self.profile = profile
+
+    def __await__(self):
+        send, error = None, None
+        while True:
+            try:
+                if error is not None:
+                    awaited = _step(self.profile, self.coroutine.throw, error)
+                else:
+                    awaited = _step(self.profile, self.coroutine.send, send)
+            except StopIteration as e:
+                return e.value
+            try:
+                send, error = (yield awaited), None
+            except GeneratorExit:
+                self.coroutine.close()
+                raise
+            except BaseException as e:
+                send, error = None, e
+
+
+async def profile_coroutine(name, coroutine):
+    if not _sampling.acquire(blocking=False):
+        return await coroutine
+    profile = cProfile.Profile()
+    try:
+        return await _ProfiledCoroutine(coroutine, profile)
+    finally:
+        _sampling.release()
+        _record(name, profile)
+
+
+def sample(name, coroutine):
+    """``coroutine``, profiled under ``name`` if this call is sampled"""
+    if not _sampled(name):
+        return coroutine
+    return profile_coroutine(name, coroutine)
+
+
+def profiled(name):
+    """Decorator sampling calls of a sync or async function under ``name``"""
+    def decorator(function):
+        if iscoroutinefunction(function):
+            @wraps(function)
+            async def wrapper(*args, **kwargs):
+                return await sample(name, function(*args, **kwargs))
+        else:
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if not _sampled(name) or not _sampling.acquire(blocking=False):
+                    return function(*args, **kwargs)
+                profile = cProfile.Profile()
+                try:
+                    return _step(profile, function, *args, **kwargs)
+                finally:
+                    _sampling.release()
+                    _record(name, profile)
+        return wrapper
+    return decorator
+
@@ -0,0 +1,151 @@
+"""
+Wire formats of the chat WebSocket.
+
+Version 1 is the original JSON text protocol. Version 2 is negotiated at
+connect, either with the ``chat.msgpack.v2`` subprotocol or ``?proto=2``,
+and sends msgpack binary frames with short field codes. It also drops the
+per-message identity fields (sender name, avatar, duplicate content): v2
+clients get their own identity once in a ``hello`` frame and everyone
+else's from the user list.
+"""
+import json
+from urllib.parse import parse_qs
+
+import msgpack
+
+MSGPACK_SUBPROTOCOL = 'chat.msgpack.v2'
+
+# Frame types travel as small integers in v2
+TYPE_CODES = {
+    'chat_message': 1,
+    'message_ack': 2,
+    'presence': 3,
+    'status_update': 4,
+    'error': 5,
+    'ping': 6,
+    'pong': 7,
+    'presence_sync': 8,
+    'hello': 9,
+    'sync': 10,
+    'room_message': 11,
+    'room_joined': 12,
+    'room_left': 13,
+    'rate_limited': 14,
+}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+FIELD_CODES = {
+    'type': 't',
+    'id': 'i',
+    'message': 'm',
+    'sender_id': 's',
+    'receiver_id': 'r',
+    'timestamp': 'ts',
+    'image_url': 'u',
+    'thumbnail_url': 'tu',
+    'media_id': 'mid',
+    'client_id': 'c',
+    'error': 'e',
+    'is_online': 'o',
+    'version': 'v',
+    'self_id': 'me',
+    'users': 'us',
+    'username': 'n',
+    'profile_picture': 'p',
+    'messages': 'ms',
+    'last_id': 'l',
+    'done': 'd',
+    'truncated': 'x',
+    'room_id': 'rm',
+    'retry_after': 'ra',
+}
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+
+# Identity and compatibility fields v2 clients already know from elsewhere
+OMITTED_FIELDS = {'content', 'sender', 'sender_profile_picture'}
+
+
+class JsonCodec:
+    """Protocol version 1: JSON text frames, unchanged for existing clients"""
+    version = 1
+    binary = False
+
+    def encode(self, event):
+        return json.dumps(event)
+
+    def decode(self, text_data=None, bytes_data=None):
+        return json.loads(text_data if text_data is not None else bytes_data)
+
+    def join(self, frames):
+        """Combine encoded frames into one JSON array frame"""
+        return '[' + ','.join(frames) + ']'
+
+
+class MsgpackCodec:
+    """Protocol version 2: msgpack binary frames with short field codes"""
+    version = 2
+    binary = True
+
+    @classmethod
+    def compact(cls, event):
+        frame = {}
+        for name, value in event.items():
+            if name in OMITTED_FIELDS or value is None:
+                continue
+            if name == 'type':
+                value = TYPE_CODES.get(value, value)
+            elif name in ('users', 'messages'):
+                value = [cls.compact(item) for item in value]
+            frame[FIELD_CODES.get(name, name)] = value
+        return frame
+
+    @classmethod
+    def expand(cls, frame):
+        event = {}
+        for code, value in frame.items():
+            name = FIELD_NAMES.get(code, code)
+            if name == 'type':
+                value = TYPE_NAMES.get(value, value)
+            elif name in ('users', 'messages'):
+                value = [cls.expand(item) for item in value]
+            event[name] = value
+        return event
+
+    def encode(self, event):
+        return msgpack.packb(self.compact(event))
+
+    def decode(self, text_data=None, bytes_data=None):
+        # Text frames are always accepted as v1 JSON
+        if text_data is not None:
+            return json.loads(text_data)
+        return self.expand(msgpack.unpackb(bytes_data))
+
+    def join(self, frames):
+        """Combine encoded frames into one msgpack array frame"""
+        return msgpack.Packer().pack_array_header(len(frames)) + b''.join(frames)
+
+
+JSON_CODEC = JsonCodec()
+MSGPACK_CODEC = MsgpackCodec()
+CODECS = (JSON_CODEC, MSGPACK_CODEC)
+
+
+def encode_frames(event):
+    """
+    Encode an event once per protocol version, for fan-out through the
+    channel layer. Keys are strings so the mapping survives channels_redis.
+    """
+    return {str(codec.version): codec.encode(event) for codec in CODECS}
+
+
+def negotiate(scope):
+    """
+    Pick the codec for a connection. Returns (codec, subprotocol) where
+    ``subprotocol`` must be echoed in the accept if it is not None.
+    """
+    if MSGPACK_SUBPROTOCOL in scope.get('subprotocols', []):
+        return MSGPACK_CODEC, MSGPACK_SUBPROTOCOL
+    query = parse_qs(scope.get('query_string', b'').decode())
+    if query.get('proto') == ['2']:
+        return MSGPACK_CODEC, None
+    return JSON_CODEC, None
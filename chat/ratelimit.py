@@ -0,0 +1,72 @@
+import logging
+import threading
+import time
+import weakref
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Process-wide overload counters, exported with the other metrics
+overload_stats = {
+    'rate_limited': 0,
+    'frames_dropped': 0,
+    'slow_disconnects': 0,
+}
+
+
+class TokenBucket:
+    """
+    Allows ``rate`` events per second on average and bursts of up to
+    ``burst``. Refilled lazily from the monotonic clock on every take.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, tokens=1):
+        """Consume ``tokens`` if available; False means the caller is over the limit"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+    def refund(self, tokens=1):
+        """Give back ``tokens`` taken for an event that did not happen"""
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + tokens)
+
+    def retry_after(self, tokens=1):
+        """Seconds until ``tokens`` will be available"""
+        with self._lock:
+            self._refill(time.monotonic())
+            return max(0.0, (tokens - self.tokens) / self.rate)
+
+
+# One bucket per user shared by all their connections in this process; it
+# goes away with the last connection holding it
+_user_buckets = weakref.WeakValueDictionary()
+_user_buckets_lock = threading.Lock()
+
+
+def user_bucket(profile_id):
+    with _user_buckets_lock:
+        bucket = _user_buckets.get(profile_id)
+        if bucket is None:
+            bucket = TokenBucket(settings.WS_USER_MESSAGE_RATE, settings.WS_USER_MESSAGE_BURST)
+            _user_buckets[profile_id] = bucket
+        return bucket
+
+
+def connection_bucket():
+    return TokenBucket(settings.WS_CONNECTION_MESSAGE_RATE, settings.WS_CONNECTION_MESSAGE_BURST)
@@ -0,0 +1,204 @@
+import json
+import logging
+import threading
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.module_loading import import_string
+
+from .models import Message
+from .pagination import encode_cursor_value
+
+logger = logging.getLogger(__name__)
+
+
+class RecentMessagesCache:
+    """
+    The newest ``size`` messages of each conversation, newest first.
+
+    Entries are filled from the database on a miss and then written through
+    by every message save, so the head page of a conversation is served
+    without a query. A write bumps the conversation's generation and a fill
+    is only stored if the generation did not move while the rows were read,
+    so a message committed during a fill is never left out. Writes to a
+    conversation that is not cached do nothing; it is filled on next read.
+    Items are small dicts (see ``message_item``), stored as JSON.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, conversation_key):
+        """Return (items or None on a miss, generation)"""
+        raise NotImplementedError
+
+    def fill(self, conversation_key, items, generation):
+        """Store ``items`` unless the conversation changed since ``generation``"""
+        raise NotImplementedError
+
+    def push(self, conversation_key, item):
+        """Write through one newly saved message"""
+        raise NotImplementedError
+
+
+class LocmemRecentMessages(RecentMessagesCache):
+    """Backed by the local-memory Django cache, for DEBUG"""
+
+    def __init__(self, size, ttl):
+        super().__init__(size, ttl)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _keys(conversation_key):
+        return f'recent:{conversation_key}', f'recent:{conversation_key}:gen'
+
+    def get(self, conversation_key):
+        items_key, generation_key = self._keys(conversation_key)
+        with self._lock:
+            return cache.get(items_key), cache.get(generation_key, 0)
+
+    def fill(self, conversation_key, items, generation):
+        items_key, generation_key = self._keys(conversation_key)
+        with self._lock:
+            if cache.get(generation_key, 0) == generation:
+                cache.set(items_key, items[:self.size], self.ttl)
+
+    def push(self, conversation_key, item):
+        items_key, generation_key = self._keys(conversation_key)
+        with self._lock:
+            cache.set(generation_key, cache.get(generation_key, 0) + 1, self.ttl)
+            items = cache.get(items_key)
+            if items is not None:
+                cache.set(items_key, [item] + items[:self.size - 1], self.ttl)
+
+
+class RedisRecentMessages(RecentMessagesCache):
+    """
+    Shared by all workers: a Redis list per conversation, reached through
+    django-redis's connection pool.
+    """
+
+    # Replace the list only if no write happened since the fill started
+    FILL_SCRIPT = """
+        local generation = redis.call('GET', KEYS[2]) or '0'
+        if generation ~= ARGV[1] then
+            return 0
+        end
+        redis.call('DEL', KEYS[1])
+        if #ARGV > 2 then
+            redis.call('RPUSH', KEYS[1], unpack(ARGV, 3))
+            redis.call('EXPIRE', KEYS[1], ARGV[2])
+        end
+        return 1
+    """
+
+    def __init__(self, size, ttl):
+        super().__init__(size, ttl)
+        from django_redis import get_redis_connection
+
+        self._redis = get_redis_connection('default')
+        self._fill = self._redis.register_script(self.FILL_SCRIPT)
+
+    @staticmethod
+    def _keys(conversation_key):
+        # The hash tag keeps both keys in one slot on Redis Cluster
+        return f'recent:{{{conversation_key}}}', f'recent:{{{conversation_key}}}:gen'
+
+    def get(self, conversation_key):
+        items_key, generation_key = self._keys(conversation_key)
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.lrange(items_key, 0, self.size - 1)
+        pipe.get(generation_key)
+        items, generation = pipe.execute()
+        # Redis has no empty lists, so a conversation without messages is
+        # always a miss; loading it is a cheap empty range scan
+        return ([json.loads(item) for item in items] if items else None), int(generation or 0)
+
+    def fill(self, conversation_key, items, generation):
+        self._fill(
+            keys=list(self._keys(conversation_key)),
+            args=[generation, self.ttl] + [json.dumps(item) for item in items[:self.size]],
+        )
+
+    def push(self, conversation_key, item):
+        items_key, generation_key = self._keys(conversation_key)
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.incr(generation_key)
+        pipe.expire(generation_key, self.ttl)
+        pipe.lpushx(items_key, json.dumps(item))
+        pipe.ltrim(items_key, 0, self.size - 1)
+        pipe.execute()
+
+
+@lru_cache(maxsize=None)
+def get_recent_messages():
+    """The process-wide recent-messages cache configured by RECENT_MESSAGES_BACKEND"""
+    return import_string(settings.RECENT_MESSAGES_BACKEND)(
+        size=settings.RECENT_MESSAGES_SIZE,
+        ttl=settings.RECENT_MESSAGES_TTL,
+    )
+
+
+def message_item(message):
+    """
+    Cached form of a Message. Usernames and thumbnail URLs are resolved
+    when the item is served, so renames and finished thumbnails show up.
+    Read ``message.media`` with select_related, or attach the blob when
+    saving, or this costs a query per message.
+    """
+    return {
+        'id': message.id,
+        'content': message.content,
+        'timestamp': message.timestamp.isoformat(),
+        'sender_id': message.sender_id,
+        'image_url': message.image_url if message.image_url else None,
+        'media_path': message.media.path if message.media_id else None,
+    }
+
+
+def remember_message(message):
+    """Write a saved message through to the cache (sync; call after commit)"""
+    try:
+        get_recent_messages().push(message.conversation_key, message_item(message))
+    except Exception:
+        # The message itself is saved; the cache entry expires with its TTL
+        logger.exception('Failed to cache message %s', message.id)
+
+
+def head_page(conversation_key, limit):
+    """
+    The newest ``limit`` messages of a conversation from the cache, as
+    (items oldest first, page) shaped like ``paginate_keyset``'s result.
+    Returns None when the cache cannot answer (``limit`` not below its size).
+    """
+    recent = get_recent_messages()
+    if limit >= recent.size:
+        return None
+
+    items, generation = recent.get(conversation_key)
+    if items is None:
+        recent.misses += 1
+        # Always from the primary: a lagging replica could leave out a
+        # message whose write-through happened before this fill started
+        messages = Message.objects.using(DEFAULT_DB_ALIAS).filter(conversation_key=conversation_key).select_related('media')
+        items = [message_item(message) for message in messages.order_by('-timestamp', '-id')[:recent.size]]
+        recent.fill(conversation_key, items, generation)
+    else:
+        recent.hits += 1
+
+    # Fewer items than the cache holds means it has the whole conversation
+    complete = len(items) < recent.size
+    page_items = items[:limit]
+    has_more = len(items) > limit or not complete
+    page_items.reverse()
+    page = {
+        'before': encode_cursor_value(page_items[0]['timestamp'], page_items[0]['id']) if page_items and has_more else None,
+        'after': encode_cursor_value(page_items[-1]['timestamp'], page_items[-1]['id']) if page_items else None,
+        'has_more': has_more,
+    }
+    return page_items, page
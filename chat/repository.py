@@ -0,0 +1,112 @@
+"""
+Data access shared by the views and the WebSocket consumer.
+
+The querysets are built here once; views evaluate them synchronously and
+the consumer awaits them through Django's async ORM (``afirst``, ``acreate``,
+``async for``). Each async ORM call is a thread hop of its own, so work that
+needs several queries per call (a transaction, a replay batch) is wrapped
+whole in ``database_sync_to_async`` instead.
+"""
+from channels.db import database_sync_to_async
+from django.db import transaction
+from django.db.models import Q
+
+from .db_router import astick_to_primary, stick_to_primary
+from .models import Conversation, Message, Room, RoomMembership, RoomMessage, UserProfile
+from .profiles import get_identities
+from .recent import remember_message
+from .thumbnails import thumbnail_url
+
+
+def conversation_messages(conversation_key):
+    """Messages of one conversation, for keyset pages on its index"""
+    return Message.objects.filter(conversation_key=conversation_key).select_related('media')
+
+
+def received_messages(profile_id, after_id=0):
+    """Messages a profile received after a message ID, oldest first"""
+    return Message.objects.filter(receiver_id=profile_id, id__gt=after_id).select_related('media').order_by('id')
+
+
+# Conversations rendered into the chat page (and covered by the presence
+# snapshot a socket gets on connect); the rest load through /api/inbox/
+CHAT_VIEW_CONVERSATIONS = 30
+
+
+def other_profiles(profile_id):
+    """Every profile but one, with its user"""
+    return UserProfile.objects.exclude(id=profile_id).select_related('user')
+
+
+async def arecent_peer_ids(profile_id, limit):
+    """Peers of a profile's ``limit`` most recently active conversations"""
+    pairs = Conversation.objects.filter(
+        Q(user_a_id=profile_id) | Q(user_b_id=profile_id)
+    ).order_by('-last_activity').values_list('user_a_id', 'user_b_id')[:limit]
+    return [user_b if user_a == profile_id else user_a async for user_a, user_b in pairs]
+
+
+def room_memberships(profile_id):
+    return RoomMembership.objects.filter(profile_id=profile_id)
+
+
+@database_sync_to_async
+def missed_messages(profile_id, after_id, limit):
+    """
+    One batch of a reconnect replay in a single thread hop: up to ``limit``
+    messages received after ``after_id`` as (Message, sender identity,
+    thumbnail URL), with the senders missing from the cache read in one query
+    """
+    messages = list(received_messages(profile_id, after_id)[:limit])
+    senders = get_identities(message.sender_id for message in messages)
+    return [
+        (
+            message,
+            senders[message.sender_id],
+            thumbnail_url(message.media.path, 'preview') if message.media else message.image_url,
+        )
+        for message in messages
+    ]
+
+
+async def alast_received_id(profile_id):
+    last = await Message.objects.filter(receiver_id=profile_id).order_by('-id').values_list('id', flat=True).afirst()
+    return last or 0
+
+
+async def aroom_ids_for(profile_id):
+    return [room_id async for room_id in room_memberships(profile_id).values_list('room_id', flat=True)]
+
+
+@database_sync_to_async
+def create_message(sender_id, receiver_id, content, image_url, media):
+    # The async ORM has no transactions yet, so the message and its inbox
+    # row are written together in one thread hop
+    with transaction.atomic():
+        message = Message.objects.create(
+            sender_id=sender_id,
+            receiver_id=receiver_id,
+            content=content,
+            image_url=image_url,
+            media=media
+        )
+        Conversation.objects.record_message(message)
+        transaction.on_commit(lambda: remember_message(message))
+        # Both ends read the conversation from the primary for a while
+        transaction.on_commit(lambda: stick_to_primary(sender_id, receiver_id))
+    return message
+
+
+async def acreate_room_message(room_id, sender_id, content, image_url, media):
+    message = await RoomMessage.objects.acreate(
+        room_id=room_id,
+        sender_id=sender_id,
+        content=content,
+        image_url=image_url,
+        media=media
+    )
+    # Only orders the room list, so it does not need to share a transaction
+    await Room.objects.filter(id=room_id).aupdate(last_activity=message.timestamp)
+    # Every member, not just the sender, reads the room from the primary for a while
+    await astick_to_primary(sender_id, room_ids=[room_id])
+    return message
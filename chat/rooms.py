@@ -0,0 +1,73 @@
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import RoomMembership
+
+logger = logging.getLogger(__name__)
+
+# Channel layer events that move a member's consumers in or out of a room group
+JOINED_EVENT = 'room.joined'
+LEFT_EVENT = 'room.left'
+
+
+def room_group(room_id):
+    """Channel layer group every connection of a room's members belongs to"""
+    return f'room_{room_id}'
+
+
+def _members_key(room_id):
+    return f'room:{room_id}:members'
+
+
+def get_member_ids(room_id):
+    """
+    Profile IDs of a room's members (sync). Cached as one entry per room, so
+    checking a sender's membership does not touch the membership table;
+    signals on RoomMembership drop the entry when the membership changes.
+    """
+    key = _members_key(room_id)
+    member_ids = cache.get(key)
+    if member_ids is None:
+        member_ids = frozenset(RoomMembership.objects.filter(room_id=room_id).values_list('profile_id', flat=True))
+        # No members may mean the room is not created (or committed) yet
+        if member_ids:
+            cache.set(key, member_ids, settings.ROOM_MEMBERS_CACHE_TTL)
+    return member_ids
+
+
+async def aget_member_ids(room_id):
+    """Async ``get_member_ids``"""
+    key = _members_key(room_id)
+    member_ids = await cache.aget(key)
+    if member_ids is None:
+        member_ids = frozenset([
+            profile_id
+            async for profile_id in RoomMembership.objects.filter(room_id=room_id).values_list('profile_id', flat=True)
+        ])
+        if member_ids:
+            await cache.aset(key, member_ids, settings.ROOM_MEMBERS_CACHE_TTL)
+    return member_ids
+
+
+def invalidate_members(room_id):
+    cache.delete(_members_key(room_id))
+
+
+def room_ids_for(profile_id):
+    """IDs of the rooms a profile belongs to (sync)"""
+    return list(RoomMembership.objects.filter(profile_id=profile_id).values_list('room_id', flat=True))
+
+
+def notify_member(profile_id, event_type, room_id):
+    """Tell a member's consumers to join or leave a room's group (sync)"""
+    try:
+        async_to_sync(get_channel_layer().group_send)(f'chat_{profile_id}', {
+            'type': event_type,
+            'room_id': room_id,
+        })
+    except Exception:
+        logger.exception('Failed to notify profile %s about room %s', profile_id, room_id)
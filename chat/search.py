@@ -0,0 +1,87 @@
+import re
+
+from django.db import DEFAULT_DB_ALIAS, connections, router
+
+from .models import Message
+
+# Words of a search query; everything else (operators, quotes) is dropped so
+# user input can never be parsed as FTS syntax
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+MAX_TOKENS = 16
+
+
+class SearchUnavailable(Exception):
+    """The database has no full-text index for messages"""
+
+
+def search_tokens(query):
+    return TOKEN_RE.findall(query or '')[:MAX_TOKENS]
+
+
+def _sqlite_search(connection, profile_id, tokens, limit, offset):
+    # Every word must match; the last one also as a prefix while typing
+    match = ' '.join(f'"{token}"' for token in tokens[:-1])
+    match = f'{match} "{tokens[-1]}"*'.strip()
+    # The MATCH drives the query (CROSS JOIN keeps SQLite from starting at
+    # the sender or receiver index instead); each hit is a rowid lookup of
+    # its message row, kept only if the profile sent or received it
+    sql = """
+        SELECT m.id, bm25(chat_message_fts) AS rank
+        FROM chat_message_fts CROSS JOIN chat_message m ON m.id = chat_message_fts.rowid
+        WHERE chat_message_fts MATCH %s AND (m.sender_id = %s OR m.receiver_id = %s)
+        ORDER BY rank, m.id DESC
+        LIMIT %s OFFSET %s
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [match, profile_id, profile_id, limit, offset])
+        # bm25 is lower for better matches; flip it so higher is better
+        return [(row[0], -row[1]) for row in cursor.fetchall()]
+
+
+def _postgres_search(connection, profile_id, tokens, limit, offset):
+    tsquery = ' & '.join(tokens[:-1] + [f'{tokens[-1]}:*'])
+    # The GIN index finds the matches; the participant filter applies to
+    # each matching row
+    sql = """
+        SELECT m.id, ts_rank(m.search_vector, query) AS rank
+        FROM chat_message m, to_tsquery('simple', %s) query
+        WHERE m.search_vector @@ query AND (m.sender_id = %s OR m.receiver_id = %s)
+        ORDER BY rank DESC, m.id DESC
+        LIMIT %s OFFSET %s
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [tsquery, profile_id, profile_id, limit, offset])
+        return cursor.fetchall()
+
+
+BACKENDS = {
+    'sqlite': _sqlite_search,
+    'postgresql': _postgres_search,
+}
+
+
+def search_messages(profile_id, query, limit=20, offset=0):
+    """
+    Ranked full-text search over the messages a profile sent or received.
+
+    Matches come from the database's full-text index (FTS5 or a GIN
+    tsvector index) and are narrowed to the profile's messages on the
+    matching rows, so the cost follows how common the words are, not how
+    long the profile's history is. Returns (list of (Message, rank),
+    has_more), best match first.
+    """
+    # Raw SQL bypasses the routers; ask them where message reads go
+    connection = connections[router.db_for_read(Message) or DEFAULT_DB_ALIAS]
+    backend = BACKENDS.get(connection.vendor)
+    if backend is None:
+        raise SearchUnavailable(f'Full-text search is not supported on {connection.vendor}')
+
+    tokens = search_tokens(query)
+    if not tokens:
+        return [], False
+
+    hits = backend(connection, profile_id, tokens, limit + 1, offset)
+    has_more = len(hits) > limit
+    hits = hits[:limit]
+    messages = Message.objects.using(connection.alias).select_related('media').in_bulk([message_id for message_id, _ in hits])
+    return [(messages[message_id], rank) for message_id, rank in hits if message_id in messages], has_more
@@ -0,0 +1,62 @@
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import RoomMembership, UserProfile
+from .profiles import INVALIDATE_EVENT, INVALIDATE_GROUP, profile_cache
+from .rooms import JOINED_EVENT, LEFT_EVENT, invalidate_members, notify_member
+
+logger = logging.getLogger(__name__)
+
+
+def broadcast_invalidation(profile_id=None, user_id=None):
+    """Ask every worker to drop a cached profile: one event per process, not per socket"""
+    try:
+        async_to_sync(get_channel_layer().group_send)(INVALIDATE_GROUP, {
+            'type': INVALIDATE_EVENT,
+            'profile_id': profile_id,
+            'user_id': user_id,
+        })
+    except Exception:
+        logger.exception('Failed to broadcast profile invalidation')
+
+
+def invalidate_profile(profile_id=None, user_id=None):
+    profile_cache.invalidate(profile_id=profile_id, user_id=user_id)
+    transaction.on_commit(lambda: broadcast_invalidation(profile_id, user_id))
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def userprofile_changed(sender, instance, **kwargs):
+    invalidate_profile(profile_id=instance.id, user_id=instance.user_id)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, update_fields=None, **kwargs):
+    # Logins only touch last_login, which the cache does not hold
+    if update_fields is not None and 'username' not in update_fields:
+        return
+    invalidate_profile(user_id=instance.id)
+
+
+@receiver(post_save, sender=RoomMembership)
+@receiver(post_delete, sender=RoomMembership)
+def membership_changed(sender, instance, created=False, **kwargs):
+    if kwargs['signal'] is post_save and not created:
+        return
+    event_type = JOINED_EVENT if created else LEFT_EVENT
+    invalidate_members(instance.room_id)
+
+    def on_commit():
+        # Drop again in case a reader refilled the entry before the commit
+        invalidate_members(instance.room_id)
+        notify_member(instance.profile_id, event_type, instance.room_id)
+
+    transaction.on_commit(on_commit)
@@ -1,3 +1,1296 @@
-from django.test import TestCase
+import asyncio
+import contextvars
+import io
+import json
+import logging
+import os
+import tempfile
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import msgpack
+from PIL import Image as PILImage
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import persistence, profiling
+from .benchmark import BENCHMARK_SETTINGS, percentiles, run_benchmark
+from . import consumers
+from .consumers import ChatConsumer
+from .db_router import ReplicaRouter, reading_from, replica_for, stick_to_primary
+from .logqueue import QueueListenerHandler, bind_log_context
+from .metrics import WS_CONNECTIONS, WS_CONNECTS, registry
+from .models import Conversation, MediaBlob, Message, Room, RoomMembership, RoomMessage, UserProfile
+from .outbox import FrameBatcher, OutboundQueue
+from .persistence import LifespanApp, MessageWriter
+from .presence import (
+    PRESENCE_GROUP, InMemoryPresenceStore, current_version, get_presence_store, next_version, sweep_presence,
+)
+from .profiles import INVALIDATE_GROUP, ProfileIdentity, listen_for_invalidations, profile_cache
+from .protocol import (
+    FIELD_CODES, JSON_CODEC, MSGPACK_CODEC, MSGPACK_SUBPROTOCOL, TYPE_CODES, MsgpackCodec, negotiate,
+)
+from .ratelimit import TokenBucket, overload_stats
+from .recent import get_recent_messages, head_page, message_item
+from .repository import acreate_room_message, create_message, missed_messages
+from .rooms import get_member_ids
+from .search import search_messages
+from .signals import broadcast_invalidation
+from .thumbnails import _store, thumbnail_path
+from .views import CHAT_VIEW_CONVERSATIONS
+
+
+class ChatViewTests(TestCase):
+    """chat_view must render in bounded time and size however large the history"""
+
+    def setUp(self):
+        cache.clear()
+        profile_cache.clear()
+        self.user = User.objects.create_user('user0000', password='password')
+        self.profile = UserProfile.objects.create(user=self.user)
+        self.peers = []
+        self.client.force_login(self.user)
+
+    def add_history(self, peers, messages_per_peer):
+        for _ in range(peers):
+            user = User.objects.create(username=f'user{len(self.peers) + 1:04d}')
+            self.peers.append(UserProfile.objects.create(user=user))
+        for peer in self.peers:
+            messages = Message.objects.bulk_create(
+                Message(
+                    sender=self.profile if i % 2 else peer,
+                    receiver=peer if i % 2 else self.profile,
+                    conversation_key=Message.conversation_key_for(self.profile.id, peer.id),
+                    content='x' * 20,
+                )
+                for i in range(messages_per_peer)
+            )
+            Conversation.objects.record_messages(messages)
+
+    def render(self):
+        url = f"{reverse('chat')}?with={self.peers[0].id}"
+        # Compare cold renders; the caches would hide queries otherwise
+        cache.clear()
+        profile_cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), len(response.content)
+
+    def test_query_count_and_size_do_not_grow_with_history(self):
+        self.add_history(peers=CHAT_VIEW_CONVERSATIONS + 5, messages_per_peer=60)
+        baseline_queries, baseline_size = self.render()
+
+        # More conversations and a much longer history in every one of them
+        self.add_history(peers=40, messages_per_peer=200)
+        queries, size = self.render()
+
+        self.assertEqual(queries, baseline_queries)
+        # Only the digits of IDs and timestamps may differ
+        self.assertAlmostEqual(size, baseline_size, delta=baseline_size * 0.02)
+
+    def test_renders_only_the_first_page_of_conversations(self):
+        self.add_history(peers=CHAT_VIEW_CONVERSATIONS + 10, messages_per_peer=1)
+        response = self.client.get(reverse('chat'))
+        self.assertEqual(len(response.context['users']), CHAT_VIEW_CONVERSATIONS)
+        self.assertIsNone(response.context['selected_thread'])
+
+
+class PaginationTests(TestCase):
+    """Keyset pages of a conversation's history through /api/messages/"""
+
+    def setUp(self):
+        cache.clear()
+        profile_cache.clear()
+        self.addCleanup(profile_cache.clear)
+        self.user = User.objects.create(username='reader')
+        self.me = UserProfile.objects.create(user=self.user)
+        self.peer = UserProfile.objects.create(user=User.objects.create(username='peer'))
+        messages = Message.objects.bulk_create(
+            Message(
+                sender=self.peer,
+                receiver=self.me,
+                conversation_key=Message.conversation_key_for(self.me.id, self.peer.id),
+                content=str(i),
+            )
+            for i in range(5)
+        )
+        # Equal timestamps leave the order to the id tiebreak
+        Message.objects.filter(id__in=[message.id for message in messages]).update(timestamp=messages[0].timestamp)
+        self.client.force_login(self.user)
+
+    def page(self, **params):
+        response = self.client.get(reverse('get_messages'), {'receiver': self.peer.id, 'limit': 2, **params})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        return [message['content'] for message in data['messages']], data
+
+    def test_cursors_walk_both_ways_without_gaps(self):
+        contents, newest = self.page()
+        self.assertEqual(contents, ['3', '4'])
+        contents, middle = self.page(before=newest['before'])
+        self.assertEqual(contents, ['1', '2'])
+        contents, oldest = self.page(before=middle['before'])
+        self.assertEqual(contents, ['0'])
+        self.assertFalse(oldest['has_more'])
+        self.assertIsNone(oldest['before'])
+
+        contents, page = self.page(after=oldest['after'])
+        self.assertEqual(contents, ['1', '2'])
+        self.assertTrue(page['has_more'])
+        contents, page = self.page(after=page['after'])
+        self.assertEqual(contents, ['3', '4'])
+        self.assertFalse(page['has_more'])
+
+    def test_malformed_cursors_are_rejected(self):
+        url = reverse('get_messages')
+        for params in ({'before': 'not a cursor'}, {'after': '!!'}, {'before': 'x', 'after': 'y'}):
+            with self.assertLogs('django.request', 'WARNING'):
+                response = self.client.get(url, {'receiver': self.peer.id, **params})
+            self.assertEqual(response.status_code, 400, params)
+
+
+class InboxTests(TestCase):
+    """Conversation rows follow the messages written and the history read"""
+
+    def setUp(self):
+        cache.clear()
+        profile_cache.clear()
+        self.addCleanup(profile_cache.clear)
+        self.user = User.objects.create(username='me')
+        self.me = UserProfile.objects.create(user=self.user)
+        self.ann, self.bob = (
+            UserProfile.objects.create(user=User.objects.create(username=name)) for name in ('ann', 'bob')
+        )
+        self.start = timezone.now()
+        self.client.force_login(self.user)
+
+    def message(self, sender, receiver, minute):
+        message = Message.objects.create(sender=sender, receiver=receiver, content=f'at {minute}')
+        message.timestamp = self.start + timedelta(minutes=minute)
+        Message.objects.filter(id=message.id).update(timestamp=message.timestamp)
+        return message
+
+    def conversation(self, peer):
+        return Conversation.objects.get(key=Message.conversation_key_for(self.me.id, peer.id))
+
+    def test_recording_moves_activity_and_counts_unread(self):
+        Conversation.objects.record_message(self.message(self.ann, self.me, 1))
+        batch = [self.message(self.ann, self.me, 2), self.message(self.me, self.ann, 3), self.message(self.ann, self.me, 4)]
+        Conversation.objects.record_messages(batch)
+
+        conversation = self.conversation(self.ann)
+        self.assertEqual(conversation.last_message, batch[-1])
+        self.assertEqual(conversation.last_activity, batch[-1].timestamp)
+        self.assertEqual(conversation.unread_for(self.me), 3)
+        self.assertEqual(conversation.unread_for(self.ann), 1)
+
+    def test_inbox_is_most_recent_first_and_reading_clears_unread(self):
+        Conversation.objects.record_message(self.message(self.ann, self.me, 1))
+        Conversation.objects.record_message(self.message(self.bob, self.me, 2))
+        inbox = self.client.get(reverse('get_inbox')).json()['conversations']
+        self.assertEqual([(item['username'], item['unread']) for item in inbox], [('bob', 1), ('ann', 1)])
+
+        self.client.get(reverse('get_messages'), {'receiver': self.ann.id})
+        Conversation.objects.record_message(self.message(self.me, self.ann, 3))
+        inbox = self.client.get(reverse('get_inbox')).json()['conversations']
+        self.assertEqual([(item['username'], item['unread']) for item in inbox], [('ann', 0), ('bob', 1)])
+        self.assertEqual(self.conversation(self.ann).unread_for(self.ann), 1)
+
+
+@override_settings(**BENCHMARK_SETTINGS)
+class BenchmarkTests(TransactionTestCase):
+    """A tiny run of the load test, to keep the benchmark itself working"""
+
+    def setUp(self):
+        get_presence_store.cache_clear()
+        profile_cache.clear()
+        self.addCleanup(get_presence_store.cache_clear)
+
+    def test_report(self):
+        users = []
+        for i in range(4):
+            user = User.objects.create(username=f'bench{i}')
+            users.append((user, UserProfile.objects.create(user=user).id))
+
+        report = asyncio.run(run_benchmark(users[:3], users[3:], rate=20, duration=0.5, churn=10, seed=1))
+
+        self.assertEqual(report['connect']['count'], 4)
+        self.assertGreater(report['messages']['sent'], 0)
+        self.assertEqual(report['messages']['lost'], 0)
+        self.assertEqual(report['messages']['errors'], 0)
+        self.assertGreater(report['messages']['queries_per_message'], 0)
+        self.assertGreater(report['presence']['reconnects'], 0)
+        self.assertEqual(Message.objects.count(), report['messages']['sent'])
+        json.dumps(report)
+
+    def test_percentiles(self):
+        self.assertEqual(percentiles([i / 1000 for i in range(1, 101)]), {'p50': 50, 'p95': 95, 'p99': 99, 'max': 100})
+        self.assertEqual(percentiles([])['p99'], None)
+
+
+class MetricsTests(TestCase):
+    """Every worker's metrics add up in one scrape"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write_worker(self, pid, age=0):
+        # Another worker's snapshot: this process's values, doubled
+        snapshot = registry.snapshot()
+        snapshot['chat_ws_connects_total'] = [[[], 2 * WS_CONNECTS.labels().value]]
+        snapshot['chat_ws_connections'] = [[[], 3]]
+        path = os.path.join(self.directory, f'{pid}.json')
+        with open(path, 'w') as f:
+            json.dump(snapshot, f)
+        os.utime(path, (time.time() - age,) * 2)
+
+    def sample(self, body, name):
+        return next(float(line.split()[-1]) for line in body.splitlines() if line.startswith(f'{name} '))
+
+    def test_workers_add_up(self):
+        WS_CONNECTS.inc()
+        WS_CONNECTIONS.inc()
+        self.addCleanup(WS_CONNECTIONS.dec)
+        with self.settings(METRICS_DIR=self.directory, DEBUG=True):
+            self.write_worker(pid=1)
+            # A worker that stopped writing keeps its counters but not its gauges
+            self.write_worker(pid=2, age=3600)
+            body = self.client.get('/metrics').content.decode()
+
+        connects = WS_CONNECTS.labels().value
+        self.assertEqual(self.sample(body, 'chat_ws_connects_total'), connects + 2 * connects * 2)
+        self.assertEqual(self.sample(body, 'chat_ws_connections'), WS_CONNECTIONS.labels().value + 3)
+
+    def test_token(self):
+        with self.settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics').status_code, 401)
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('# TYPE chat_ws_receive_seconds histogram', response.content.decode())
+
+    def test_no_token_outside_debug(self):
+        with self.settings(METRICS_TOKEN='', DEBUG=False):
+            self.assertEqual(self.client.get('/metrics').status_code, 404)
+        with self.settings(METRICS_TOKEN='', DEBUG=True):
+            self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+
+class LogQueueTests(TestCase):
+    def test_records_are_written_as_json_by_the_listener(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'test.log')
+            handler = QueueListenerHandler(filename, max_bytes=1024 * 1024, backup_count=1,
+                                           debug_sample_rate=10, console=False)
+            logger = logging.getLogger('chat.tests.logqueue')
+            logger.addHandler(handler)
+            logger.setLevel(logging.DEBUG)
+            logger.propagate = False
+            try:
+                def log():
+                    bind_log_context(connection='specific.test', user=7)
+                    for i in range(20):
+                        logger.debug('frame %d', i)
+                    try:
+                        raise ValueError('boom')
+                    except ValueError:
+                        logger.exception('Failed to handle %s', 'a frame')
+
+                contextvars.copy_context().run(log)
+            finally:
+                logger.removeHandler(handler)
+                handler.close()
+
+            with open(filename) as f:
+                records = [json.loads(line) for line in f]
+
+        # One DEBUG record in ten is kept, errors always are
+        self.assertEqual([record['message'] for record in records], ['frame 9', 'frame 19', 'Failed to handle a frame'])
+        self.assertEqual(records[-1]['connection_id'], 'specific.test')
+        self.assertEqual(records[-1]['user_id'], 7)
+        self.assertIn('ValueError: boom', records[-1]['exception'])
+
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        user = User.objects.create(username='profiled')
+        self.peer = UserProfile.objects.create(user=User.objects.create(username='peer'))
+        self.client.force_login(user)
+
+    def get_messages(self, times):
+        for _ in range(times):
+            self.client.get(reverse('get_messages'), {'receiver': self.peer.id})
+        # Wait for the background writer
+        profiling._writer.submit(lambda: None).result()
+
+    def test_samples_are_written_and_summarized(self):
+        with self.settings(PROFILING_DIR=self.directory, PROFILING_SAMPLE_RATE=2):
+            self.get_messages(times=4)
+            self.assertEqual(os.listdir(self.directory), [])
+
+            profiling.set_enabled(True)
+            self.addCleanup(profiling.set_enabled, False)
+            self.get_messages(times=4)
+
+        self.assertEqual(os.listdir(self.directory), [f'http.get_messages.{os.getpid()}.prof'])
+        output = io.StringIO()
+        call_command('profile_summary', '--dir', self.directory, '--limit', '5', stdout=output)
+        self.assertIn('http.get_messages: 1 worker file(s)', output.getvalue())
+        self.assertIn('views.py', output.getvalue())
+
+    def test_overlapping_samples_run_unprofiled(self):
+        profiling.set_enabled(True)
+        self.addCleanup(profiling.set_enabled, False)
+        with self.settings(PROFILING_DIR=self.directory, PROFILING_SAMPLE_RATE=1):
+            with profiling._sampling:
+                self.get_messages(times=2)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_calls_run_when_the_profiler_cannot_start(self):
+        profile = mock.Mock(enable=mock.Mock(side_effect=ValueError('Another profiling tool is already active')))
+        self.assertEqual(profiling._step(profile, sum, [1, 2]), 3)
+        profile.disable.assert_not_called()
+
+
+@override_settings(DATABASE_REPLICAS=['replica0'], REPLICA_STICKY_SECONDS=60)
+class ReplicaRouterTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.router = ReplicaRouter()
+
+    def test_only_opted_in_reads_use_a_replica(self):
+        self.assertIsNone(self.router.db_for_read(Message))
+        with reading_from(replica_for(1)):
+            self.assertEqual(self.router.db_for_read(Message), 'replica0')
+            self.assertEqual(self.router.db_for_write(Message), 'default')
+        self.assertIsNone(self.router.db_for_read(Message))
+
+    def test_writers_stay_on_the_primary(self):
+        stick_to_primary(1)
+        self.assertIsNone(replica_for(1))
+        self.assertEqual(replica_for(2), 'replica0')
+
+
+class ThumbnailTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        media = self.settings(MEDIA_ROOT=self.directory)
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def stored(self):
+        return sorted(
+            os.path.relpath(os.path.join(root, name), self.directory)
+            for root, _, names in os.walk(self.directory) for name in names
+        )
+
+    def test_sources_differing_in_extension_do_not_collide(self):
+        self.assertNotEqual(thumbnail_path('chat/a.png', 'preview'), thumbnail_path('chat/a.jpg', 'preview'))
+
+    def test_writes_never_leave_renamed_copies(self):
+        path = thumbnail_path('chat/a.png', 'preview')
+        _store(path, b'first', replace=False)
+        # A second worker rendering the same source keeps the first's file
+        _store(path, b'second', replace=False)
+        with default_storage.open(path) as f:
+            self.assertEqual(f.read(), b'first')
+        # A forced rewrite replaces it in place
+        _store(path, b'forced', replace=True)
+        with default_storage.open(path) as f:
+            self.assertEqual(f.read(), b'forced')
+        self.assertEqual(self.stored(), [path])
+
+
+class MessageWriterTests(TransactionTestCase):
+    def setUp(self):
+        self.sender, self.receiver = (
+            UserProfile.objects.create(user=User.objects.create(username=name)) for name in ('writer', 'reader')
+        )
+
+    def message(self, content, receiver_id=None):
+        receiver_id = receiver_id or self.receiver.id
+        return Message(
+            sender_id=self.sender.id,
+            receiver_id=receiver_id,
+            conversation_key=Message.conversation_key_for(self.sender.id, receiver_id),
+            content=content,
+        )
+
+    async def test_flushes_when_full(self):
+        writer = MessageWriter(flush_size=2, flush_interval=60)
+        first = writer.submit(self.message('one'))
+        await asyncio.sleep(0)
+        self.assertFalse(first.done())
+        second = writer.submit(self.message('two'))
+        saved = await asyncio.wait_for(asyncio.gather(first, second), 5)
+        self.assertTrue(all(message.pk for message in saved))
+        conversation = await Conversation.objects.aget()
+        self.assertEqual(conversation.last_message_id, saved[1].pk)
+
+    async def test_flushes_after_the_interval(self):
+        writer = MessageWriter(flush_size=100, flush_interval=0.01)
+        saved = await asyncio.wait_for(writer.submit(self.message('one')), 5)
+        self.assertEqual(await Message.objects.filter(pk=saved.pk).acount(), 1)
+
+    async def test_bad_rows_do_not_fail_the_batch(self):
+        writer = MessageWriter(flush_size=2, flush_interval=60)
+        good = writer.submit(self.message('good'))
+        bad = writer.submit(self.message('bad', receiver_id=self.receiver.id + 1000))
+        with self.assertLogs('chat.persistence', 'ERROR'):
+            results = await asyncio.wait_for(asyncio.gather(good, bad, return_exceptions=True), 5)
+        self.assertIsNotNone(results[0].pk)
+        self.assertIsInstance(results[1], Exception)
+        self.assertEqual([message.content async for message in Message.objects.all()], ['good'])
+
+    async def test_lifespan_shutdown_drains_the_buffer(self):
+        writer = MessageWriter(flush_size=100, flush_interval=60)
+        self.addCleanup(setattr, persistence, '_writer', persistence._writer)
+        persistence._writer = writer
+        saved = writer.submit(self.message('buffered'))
+
+        events = asyncio.Queue()
+        for event in ('lifespan.startup', 'lifespan.shutdown'):
+            events.put_nowait({'type': event})
+        sent = []
+
+        async def send(event):
+            sent.append(event['type'])
+
+        await asyncio.wait_for(LifespanApp()({'type': 'lifespan'}, events.get, send), 5)
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertTrue(saved.done())
+        self.assertEqual(await Message.objects.filter(pk=saved.result().pk).acount(), 1)
+
+
+@override_settings(
+    PRESENCE_BACKEND='chat.presence.InMemoryPresenceStore',
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+)
+class PresenceSweepTests(SimpleTestCase):
+    def setUp(self):
+        get_presence_store.cache_clear()
+        self.addCleanup(get_presence_store.cache_clear)
+        self.now = 1000.0
+        clock = mock.patch('chat.presence.time.monotonic', lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    async def test_expired_users_are_swept_once(self):
+        store = InMemoryPresenceStore(ttl=60)
+        await store.add_connection(1, 'crashed')
+        await store.add_connection(2, 'closed')
+        self.assertTrue(await store.remove_connection(2, 'closed'))
+        self.assertEqual(await store.sweep(), set())
+
+        self.now += 61
+        self.assertEqual(store.online_ids([1]), set())
+        # Reported even though a lookup already pruned it, and only once
+        self.assertEqual(await store.sweep(), {1})
+        self.assertEqual(await store.sweep(), set())
+
+        # Coming back before a sweep is an online change, not an offline one
+        await store.add_connection(3, 'a')
+        self.now += 61
+        self.assertTrue(await store.add_connection(3, 'b'))
+        self.assertEqual(await store.sweep(), set())
+
+    async def test_sweep_broadcasts_offline_deltas(self):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(PRESENCE_GROUP, channel)
+        await get_presence_store().add_connection(7, 'crashed')
+        self.now += settings.PRESENCE_TTL + 1
+
+        await sweep_presence()
+        event = await asyncio.wait_for(layer.receive(channel), 1)
+        self.assertEqual(event['type'], 'presence_delta')
+        delta = json.loads(event['frames']['1'])
+        self.assertEqual(delta, {'type': 'presence', 'id': 7, 'is_online': False, 'version': await current_version()})
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class ProfileInvalidationTests(SimpleTestCase):
+    async def test_one_listener_per_process_drops_changed_profiles(self):
+        layer = get_channel_layer()
+        listener = asyncio.ensure_future(listen_for_invalidations())
+        self.addCleanup(profile_cache.clear)
+        try:
+            while not layer.groups.get(INVALIDATE_GROUP):
+                await asyncio.sleep(0.01)
+            profile_cache.put(ProfileIdentity(id=5, user_id=50, username='changed', avatar_url=''))
+
+            await sync_to_async(broadcast_invalidation)(user_id=50)
+            for _ in range(100):
+                if profile_cache.get(5) is None:
+                    break
+                await asyncio.sleep(0.01)
+            self.assertIsNone(profile_cache.get(5))
+            self.assertEqual(len(layer.groups[INVALIDATE_GROUP]), 1)
+        finally:
+            listener.cancel()
+            await asyncio.gather(listener, return_exceptions=True)
+        self.assertFalse(layer.groups.get(INVALIDATE_GROUP))
+
+
+class ProtocolTests(SimpleTestCase):
+    def test_codes_are_unique(self):
+        self.assertEqual(len(set(FIELD_CODES.values())), len(FIELD_CODES))
+        self.assertEqual(len(set(TYPE_CODES.values())), len(TYPE_CODES))
+
+    def test_every_field_and_type_round_trips(self):
+        fields = {name: f'value of {name}' for name in FIELD_CODES if name not in ('type', 'users', 'messages')}
+        for name, code in TYPE_CODES.items():
+            event = {'type': name, **fields}
+            frame = MsgpackCodec.compact(event)
+            self.assertEqual(frame['t'], code)
+            self.assertEqual(set(frame), set(FIELD_CODES.values()) - {'us', 'ms'})
+            self.assertEqual(MSGPACK_CODEC.decode(bytes_data=MSGPACK_CODEC.encode(event)), event)
+
+    def test_nested_items_round_trip_without_omitted_fields(self):
+        event = {
+            'type': 'sync',
+            'messages': [{'id': 1, 'message': 'hi', 'content': 'hi', 'sender': 'ann', 'image_url': None}],
+            'users': [{'id': 2, 'username': 'bob', 'is_online': True}],
+            'done': True,
+        }
+        self.assertEqual(MSGPACK_CODEC.decode(bytes_data=MSGPACK_CODEC.encode(event)), {
+            'type': 'sync',
+            'messages': [{'id': 1, 'message': 'hi'}],
+            'users': [{'id': 2, 'username': 'bob', 'is_online': True}],
+            'done': True,
+        })
+
+    def test_negotiate(self):
+        self.assertEqual(negotiate({'subprotocols': [MSGPACK_SUBPROTOCOL]}), (MSGPACK_CODEC, MSGPACK_SUBPROTOCOL))
+        # The query string opts in for clients that cannot set subprotocols
+        self.assertEqual(negotiate({'query_string': b'proto=2'}), (MSGPACK_CODEC, None))
+        self.assertEqual(negotiate({'subprotocols': ['other'], 'query_string': b'proto=1'}), (JSON_CODEC, None))
+        self.assertEqual(negotiate({}), (JSON_CODEC, None))
+
+    def test_join_makes_array_frames(self):
+        events = [{'type': 'pong'}, {'type': 'presence', 'id': 3, 'is_online': False}]
+        self.assertEqual(json.loads(JSON_CODEC.join([JSON_CODEC.encode(event) for event in events])), events)
+        frame = MSGPACK_CODEC.join([MSGPACK_CODEC.encode(event) for event in events])
+        self.assertEqual([MsgpackCodec.expand(item) for item in msgpack.unpackb(frame)], events)
+
+
+class FrameBatcherTests(SimpleTestCase):
+    """Frames are coalesced into array frames by count or after the window"""
+
+    def setUp(self):
+        self.sent = []
+
+    async def send_frame(self, frame, droppable):
+        self.sent.append((json.loads(frame), droppable))
+
+    def batcher(self, window=60, max_frames=3):
+        batcher = FrameBatcher(self.send_frame, JSON_CODEC, window=window, max_frames=max_frames)
+        self.addCleanup(self.close, batcher)
+        return batcher
+
+    def close(self, batcher):
+        with self.assertLogs('chat.outbox', 'DEBUG'):
+            batcher.close()
+
+    async def test_flushes_when_full_in_order(self):
+        batcher = self.batcher()
+        for i in range(4):
+            await batcher.add(JSON_CODEC.encode({'type': 'pong', 'n': i}))
+        self.assertEqual(self.sent, [([{'type': 'pong', 'n': 0}, {'type': 'pong', 'n': 1}, {'type': 'pong', 'n': 2}], False)])
+        self.assertEqual(batcher.stats()['frames'], 3)
+
+    async def test_flushes_after_the_window(self):
+        batcher = self.batcher(window=0.01)
+        await batcher.add(JSON_CODEC.encode({'type': 'pong', 'n': 0}))
+        await batcher.add(JSON_CODEC.encode({'type': 'pong', 'n': 1}))
+        self.assertEqual(self.sent, [])
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.sent, [([{'type': 'pong', 'n': 0}, {'type': 'pong', 'n': 1}], False)])
+
+    async def test_batch_is_droppable_only_if_every_frame_is(self):
+        batcher = self.batcher(max_frames=2)
+        for droppable in (True, True, True, False):
+            await batcher.add(JSON_CODEC.encode({'type': 'presence'}), droppable)
+        self.assertEqual([droppable for _, droppable in self.sent], [True, False])
+
+
+@override_settings(**BENCHMARK_SETTINGS)
+class ConsumerProtocolTests(TransactionTestCase):
+    """v1 and v2 clients talk to each other through the same consumer"""
+
+    def setUp(self):
+        get_presence_store.cache_clear()
+        profile_cache.clear()
+        self.addCleanup(get_presence_store.cache_clear)
+        self.ann, self.bob = (User.objects.create(username=name) for name in ('ann', 'bob'))
+        self.ann_id = UserProfile.objects.create(user=self.ann).id
+        self.bob_id = UserProfile.objects.create(user=self.bob).id
+
+    @staticmethod
+    async def connect(user, path='/ws/chat/', subprotocols=None):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), path, subprotocols=subprotocols)
+        communicator.scope['user'] = user
+        connected, subprotocol = await communicator.connect()
+        assert connected
+        return communicator, subprotocol
+
+    @staticmethod
+    async def next_event(communicator, event_type):
+        while True:
+            output = await communicator.receive_output(timeout=5)
+            if output.get('bytes') is not None:
+                event = MSGPACK_CODEC.decode(bytes_data=output['bytes'])
+            else:
+                event = JSON_CODEC.decode(output['text'])
+            if event['type'] == event_type:
+                return event, output
+
+    async def exchange(self):
+        v1, subprotocol = await self.connect(self.ann)
+        self.assertIsNone(subprotocol)
+        v2, subprotocol = await self.connect(self.bob, subprotocols=[MSGPACK_SUBPROTOCOL])
+        self.assertEqual(subprotocol, MSGPACK_SUBPROTOCOL)
+        try:
+            hello, output = await self.next_event(v2, 'hello')
+            self.assertIsNone(output.get('text'))
+            self.assertEqual(hello['self_id'], self.bob_id)
+            _, output = await self.next_event(v1, 'status_update')
+            self.assertIsNone(output.get('bytes'))
+
+            # v2 sends binary, v1 receives the full JSON event
+            await v2.send_to(bytes_data=MSGPACK_CODEC.encode({
+                'type': 'chat_message', 'message': 'to v1', 'receiver_id': self.ann_id, 'client_id': 1,
+            }))
+            received, _ = await self.next_event(v1, 'chat_message')
+            self.assertEqual((received['message'], received['content'], received['sender']), ('to v1', 'to v1', 'bob'))
+            ack, _ = await self.next_event(v2, 'message_ack')
+            self.assertEqual(ack['client_id'], 1)
+
+            # v1 sends JSON, v2 receives the compact event without identity fields
+            await v1.send_to(text_data=JSON_CODEC.encode({
+                'type': 'chat_message', 'message': 'to v2', 'receiver_id': self.bob_id,
+            }))
+            received, _ = await self.next_event(v2, 'chat_message')
+            self.assertEqual((received['message'], received['sender_id']), ('to v2', self.ann_id))
+            self.assertNotIn('sender', received)
+        finally:
+            await v1.disconnect()
+            await v2.disconnect()
+
+    def test_v1_and_v2_clients(self):
+        asyncio.run(self.exchange())
+
+
+@override_settings(**BENCHMARK_SETTINGS)
+class PresenceSnapshotTests(TransactionTestCase):
+    """The presence a socket gets covers the users on the client's page"""
+
+    def setUp(self):
+        get_presence_store.cache_clear()
+        profile_cache.clear()
+        self.addCleanup(get_presence_store.cache_clear)
+        self.ann, bob, carol = (User.objects.create(username=name) for name in ('ann', 'bob', 'carol'))
+        self.ann_id, self.bob_id, self.carol_id = (UserProfile.objects.create(user=user).id for user in (self.ann, bob, carol))
+        async_to_sync(create_message)(self.ann_id, self.bob_id, 'hi', None, None)
+
+    async def snapshots(self):
+        communicator, _ = await ConsumerProtocolTests.connect(self.ann)
+        try:
+            on_connect, _ = await ConsumerProtocolTests.next_event(communicator, 'status_update')
+            await communicator.send_json_to({'type': 'presence_sync', 'ids': [self.carol_id, 'x']})
+            on_sync, _ = await ConsumerProtocolTests.next_event(communicator, 'status_update')
+        finally:
+            await communicator.disconnect()
+        return on_connect, on_sync
+
+    def test_snapshots_cover_conversations_or_the_asked_users(self):
+        on_connect, on_sync = asyncio.run(self.snapshots())
+        self.assertEqual(on_connect['users'], [{'id': self.bob_id, 'is_online': False}])
+        self.assertEqual(on_sync['users'], [{'id': self.carol_id, 'is_online': False}])
+        self.assertGreaterEqual(on_sync['version'], on_connect['version'])
+
+
+@override_settings(**BENCHMARK_SETTINGS)
+class PresenceDeltaTests(TransactionTestCase):
+    """
+    Only status transitions are announced, and a snapshot plus the deltas
+    after its version add up to a fresh snapshot
+    """
+
+    def setUp(self):
+        cache.clear()
+        get_presence_store.cache_clear()
+        profile_cache.clear()
+        self.addCleanup(get_presence_store.cache_clear)
+        self.ann, self.bob = (User.objects.create(username=name) for name in ('ann', 'bob'))
+        self.ann_id, self.bob_id = (UserProfile.objects.create(user=user).id for user in (self.ann, self.bob))
+        async_to_sync(create_message)(self.ann_id, self.bob_id, 'hi', None, None)
+
+    @staticmethod
+    def state(snapshot):
+        return {user['id']: user['is_online'] for user in snapshot['users']}
+
+    async def resync(self, communicator):
+        await communicator.send_json_to({'type': 'presence_sync'})
+        snapshot, _ = await ConsumerProtocolTests.next_event(communicator, 'status_update')
+        return snapshot
+
+    async def converge(self):
+        ann, _ = await ConsumerProtocolTests.connect(self.ann)
+        try:
+            snapshot, _ = await ConsumerProtocolTests.next_event(ann, 'status_update')
+            state, version = self.state(snapshot), snapshot['version']
+            # Ann coming online was announced after her snapshot was read
+            delta, _ = await ConsumerProtocolTests.next_event(ann, 'presence')
+            self.assertEqual((delta['id'], delta['version']), (self.ann_id, version + 1))
+            version = delta['version']
+
+            bob, _ = await ConsumerProtocolTests.connect(self.bob)
+            await bob.disconnect()
+            for is_online in (True, False):
+                delta, _ = await ConsumerProtocolTests.next_event(ann, 'presence')
+                self.assertEqual((delta['id'], delta['is_online'], delta['version']), (self.bob_id, is_online, version + 1))
+                state[delta['id']], version = delta['is_online'], delta['version']
+
+            fresh = await self.resync(ann)
+        finally:
+            await ann.disconnect()
+        self.assertEqual((self.state(fresh), fresh['version']), (state, version))
+
+    def test_snapshot_and_deltas_converge(self):
+        asyncio.run(self.converge())
+
+    async def gap(self):
+        ann, _ = await ConsumerProtocolTests.connect(self.ann)
+        try:
+            await ConsumerProtocolTests.next_event(ann, 'status_update')
+            own, _ = await ConsumerProtocolTests.next_event(ann, 'presence')
+            # A delta this socket never sees
+            await next_version()
+            bob, _ = await ConsumerProtocolTests.connect(self.bob)
+            delta, _ = await ConsumerProtocolTests.next_event(ann, 'presence')
+            self.assertGreater(delta['version'], own['version'] + 1)
+
+            # The client resyncs instead of applying deltas past the gap
+            fresh = await self.resync(ann)
+            await bob.disconnect()
+        finally:
+            await ann.disconnect()
+        self.assertGreaterEqual(fresh['version'], delta['version'])
+        self.assertEqual(self.state(fresh), {self.bob_id: True})
+
+    def test_version_gap_resyncs(self):
+        asyncio.run(self.gap())
+
+    async def tabs(self):
+        ann, _ = await ConsumerProtocolTests.connect(self.ann)
+        try:
+            await ConsumerProtocolTests.next_event(ann, 'presence')
+            first, _ = await ConsumerProtocolTests.connect(self.bob)
+            online, _ = await ConsumerProtocolTests.next_event(ann, 'presence')
+            # A second tab and closing either of the two is not a transition
+            second, _ = await ConsumerProtocolTests.connect(self.bob)
+            await first.disconnect()
+            self.assertTrue(await ann.receive_nothing())
+            await second.disconnect()
+            offline, _ = await ConsumerProtocolTests.next_event(ann, 'presence')
+        finally:
+            await ann.disconnect()
+        self.assertEqual((online['id'], online['is_online']), (self.bob_id, True))
+        self.assertEqual((offline['id'], offline['is_online']), (self.bob_id, False))
+        self.assertEqual(offline['version'], online['version'] + 1)
+
+    def test_only_the_first_and_last_connection_change_status(self):
+        asyncio.run(self.tabs())
+
+
+@override_settings(**BENCHMARK_SETTINGS)
+class MediaTests(TransactionTestCase):
+    """Images are uploaded over HTTP and attached to messages by media id"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        media = self.settings(MEDIA_ROOT=directory.name)
+        media.enable()
+        self.addCleanup(media.disable)
+        get_presence_store.cache_clear()
+        profile_cache.clear()
+        self.addCleanup(get_presence_store.cache_clear)
+        self.ann, self.bob = (User.objects.create(username=name) for name in ('ann', 'bob'))
+        self.ann_id, self.bob_id = (UserProfile.objects.create(user=user).id for user in (self.ann, self.bob))
+
+    def upload(self, user, name='photo.png'):
+        image = io.BytesIO()
+        PILImage.new('RGB', (4, 4), 'red').save(image, 'PNG')
+        self.client.force_login(user)
+        response = self.client.post(reverse('upload_media'), {'image': SimpleUploadedFile(name, image.getvalue())})
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    async def send_with_media(self, user, media_id, receiver_id):
+        communicator, _ = await ConsumerProtocolTests.connect(user)
+        try:
+            await communicator.send_json_to({
+                'type': 'chat_message', 'message': 'look', 'receiver_id': receiver_id, 'media_id': media_id,
+            })
+            reply, _ = await ConsumerProtocolTests.next_event(communicator, 'error')
+        finally:
+            await communicator.disconnect()
+        return reply
+
+    def test_media_id_of_another_user_is_rejected(self):
+        media_id = self.upload(self.ann)['media_id']
+        reply = asyncio.run(self.send_with_media(self.bob, media_id, self.ann_id))
+        self.assertEqual(reply['error'], 'Invalid or expired media_id')
+        self.assertFalse(Message.objects.exists())
+
+    def test_identical_bytes_are_stored_once(self):
+        first = self.upload(self.ann, 'photo.png')
+        second = self.upload(self.bob, 'copy.PNG')
+        self.assertEqual(MediaBlob.objects.count(), 1)
+        self.assertEqual(first['url'], second['url'])
+        self.assertNotEqual(first['media_id'], second['media_id'])
+        blob = MediaBlob.objects.get()
+        self.assertEqual(os.listdir(os.path.dirname(os.path.join(settings.MEDIA_ROOT, blob.path))), [os.path.basename(blob.path)])
+
+
+class RoomTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        profile_cache.clear()
+        self.addCleanup(profile_cache.clear)
+        self.user = User.objects.create(username='member')
+        self.profile = UserProfile.objects.create(user=self.user)
+        self.room = Room.objects.create(name='room', created_by=self.profile)
+        RoomMembership.objects.create(room=self.room, profile=self.profile)
+        self.client.force_login(self.user)
+
+    def test_member_ids_are_cached_until_membership_changes(self):
+        self.assertEqual(get_member_ids(self.room.id), {self.profile.id})
+        with self.assertNumQueries(0):
+            get_member_ids(self.room.id)
+
+        other = UserProfile.objects.create(user=User.objects.create(username='joiner'))
+        membership = RoomMembership.objects.create(room=self.room, profile=other)
+        self.assertEqual(get_member_ids(self.room.id), {self.profile.id, other.id})
+        membership.delete()
+        self.assertEqual(get_member_ids(self.room.id), {self.profile.id})
+
+    def test_creator_reads_a_room_looked_up_before_it_existed(self):
+        next_id = self.room.id + 1
+        self.assertEqual(get_member_ids(next_id), frozenset())
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('rooms'), {'name': 'new'})
+        self.assertEqual(response.json()['id'], next_id)
+        self.assertEqual(get_member_ids(next_id), {self.profile.id})
+        self.assertEqual(self.client.get(reverse('get_room_messages', args=[next_id])).status_code, 200)
+
+    def test_only_members_read_the_history(self):
+        outsider = User.objects.create(username='outsider')
+        outsider_profile = UserProfile.objects.create(user=outsider)
+        self.client.force_login(outsider)
+        url = reverse('get_room_messages', args=[self.room.id])
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+        self.client.force_login(self.user)
+        self.client.post(reverse('add_room_member', args=[self.room.id]), {'profile': outsider_profile.id})
+        self.client.force_login(outsider)
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_history_queries_do_not_grow_with_senders(self):
+        def page_queries(senders):
+            for i in range(senders):
+                sender = UserProfile.objects.create(user=User.objects.create(username=f'sender{senders}.{i}'))
+                RoomMessage.objects.create(room=self.room, sender=sender, content=f'hi {i}')
+            profile_cache.clear()
+            get_member_ids(self.room.id)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse('get_room_messages', args=[self.room.id]))
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+
+        self.assertEqual(page_queries(2), page_queries(5))
+
+
+class SearchTests(TestCase):
+    """The full-text index of migration 0009, as maintained by the SQLite triggers"""
+
+    def setUp(self):
+        profile_cache.clear()
+        self.addCleanup(profile_cache.clear)
+        self.user = User.objects.create(username='searcher')
+        self.me, self.peer, self.stranger = (
+            UserProfile.objects.create(user=user)
+            for user in (self.user, User.objects.create(username='peer'), User.objects.create(username='stranger'))
+        )
+
+    def send(self, sender, receiver, content):
+        return Message.objects.create(sender=sender, receiver=receiver, content=content)
+
+    def found(self, query):
+        results, _ = search_messages(self.me.id, query)
+        return [message.id for message, _ in results]
+
+    def test_index_follows_inserts_updates_and_deletes(self):
+        message = self.send(self.me, self.peer, 'meet at the harbour')
+        self.assertEqual(self.found('harbour'), [message.id])
+        # The last word also matches as a prefix
+        self.assertEqual(self.found('meet harb'), [message.id])
+
+        message.content = 'meet at the station'
+        message.save()
+        self.assertEqual(self.found('harbour'), [])
+        self.assertEqual(self.found('station'), [message.id])
+
+        message.delete()
+        self.assertEqual(self.found('station'), [])
+
+    def test_only_own_conversations_best_match_first(self):
+        once = self.send(self.peer, self.me, 'lunch tomorrow or maybe later this week')
+        often = self.send(self.me, self.peer, 'lunch lunch lunch')
+        self.send(self.peer, self.stranger, 'lunch lunch lunch lunch')
+        self.assertEqual(self.found('lunch'), [often.id, once.id])
+
+    def test_view_resolves_senders_in_one_query(self):
+        def search_queries(senders):
+            for i in range(senders):
+                sender = UserProfile.objects.create(user=User.objects.create(username=f'sender{senders}.{i}'))
+                self.send(sender, self.me, f'ping {i}')
+            profile_cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse('search'), {'q': 'ping'})
+            self.assertEqual(len(response.json()['results']), senders + (2 if senders == 5 else 0))
+            return len(queries)
+
+        self.client.force_login(self.user)
+        self.assertEqual(search_queries(2), search_queries(5))
+
+
+@override_settings(
+    RECENT_MESSAGES_BACKEND='chat.recent.LocmemRecentMessages',
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+)
+class RecentMessagesTests(TransactionTestCase):
+    def setUp(self):
+        get_recent_messages.cache_clear()
+        self.addCleanup(get_recent_messages.cache_clear)
+        cache.clear()
+        self.sender, self.receiver = (
+            UserProfile.objects.create(user=User.objects.create(username=name)) for name in ('sender', 'receiver')
+        )
+        self.key = Message.conversation_key_for(self.sender.id, self.receiver.id)
+
+    def test_stale_fill_does_not_overwrite_a_write_through(self):
+        recent = get_recent_messages()
+        old = Message.objects.create(sender=self.sender, receiver=self.receiver, content='old')
+        items, generation = recent.get(self.key)
+        self.assertIsNone(items)
+
+        # A message is written through while the fill is reading rows
+        new = Message.objects.create(sender=self.sender, receiver=self.receiver, content='new')
+        recent.push(self.key, message_item(new))
+        recent.fill(self.key, [message_item(old)], generation)
+        self.assertIsNone(recent.get(self.key)[0])
+
+        # The next read fills it again, with both
+        items, _ = head_page(self.key, limit=10)
+        self.assertEqual([item['id'] for item in items], [old.id, new.id])
+
+    def test_write_through_does_not_load_the_media(self):
+        blob = MediaBlob.objects.create(digest='0' * 64, path='media/cas/00/00/blob.png', size=1)
+        head_page(self.key, limit=10)
+
+        with CaptureQueriesContext(connection) as queries:
+            message = async_to_sync(create_message)(
+                self.sender.id, self.receiver.id, 'picture', None, MediaBlob(id=blob.id, path=blob.path)
+            )
+        self.assertIn('INSERT INTO "chat_message"', ' '.join(query['sql'] for query in queries))
+        self.assertFalse([query for query in queries if 'chat_mediablob' in query['sql']])
+        items, _ = head_page(self.key, limit=10)
+        self.assertEqual((items[-1]['id'], items[-1]['media_path']), (message.id, blob.path))
+
+
+class OverloadTests(SimpleTestCase):
+    """Rate limits and outbound backpressure, on a fake monotonic clock"""
+
+    def setUp(self):
+        self.now = 1000.0
+        for module in ('chat.ratelimit', 'chat.outbox'):
+            clock = mock.patch(f'{module}.time.monotonic', lambda: self.now)
+            clock.start()
+            self.addCleanup(clock.stop)
+
+    def test_token_bucket_refills_up_to_the_burst(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        self.assertEqual([bucket.take() for _ in range(4)], [True, True, True, False])
+        self.assertEqual(bucket.retry_after(), 0.5)
+
+        self.now += 0.5
+        self.assertTrue(bucket.take())
+        self.assertFalse(bucket.take())
+
+        # A long pause refills no more than the burst
+        self.now += 60
+        self.assertEqual(sum(bucket.take() for _ in range(10)), 3)
+
+    async def test_rate_limited_reply(self):
+        consumer = ChatConsumer()
+        consumer.message_bucket = TokenBucket(rate=1, burst=1)
+        consumer.user_message_bucket = TokenBucket(rate=0.5, burst=5)
+        sent = []
+
+        async def send_event(event):
+            sent.append(event)
+
+        consumer.send_event = send_event
+        limited = overload_stats['rate_limited']
+        self.assertTrue(await consumer.allow_message({'client_id': 1}))
+        self.assertFalse(await consumer.allow_message({'client_id': 2}))
+        self.assertEqual(sent, [{
+            'type': 'rate_limited',
+            'error': 'Too many messages, slow down',
+            # The longer wait of the two buckets
+            'retry_after': 1.0,
+            'client_id': 2,
+        }])
+        self.assertEqual(overload_stats['rate_limited'], limited + 1)
+
+    async def test_user_refusal_keeps_the_connection_token(self):
+        consumer = ChatConsumer()
+        consumer.message_bucket = TokenBucket(rate=1, burst=2)
+        # Another tab of the same user used up the shared bucket
+        consumer.user_message_bucket = TokenBucket(rate=1, burst=1)
+        consumer.user_message_bucket.take()
+
+        async def send_event(event):
+            pass
+
+        consumer.send_event = send_event
+        self.assertFalse(await consumer.allow_message({}))
+        self.assertEqual(consumer.message_bucket.tokens, 2)
+
+        self.now += 1
+        self.assertTrue(await consumer.allow_message({}))
+        self.assertEqual(consumer.message_bucket.tokens, 1)
+
+    async def test_full_queue_drops_only_presence_frames(self):
+        written = []
+        closed = []
+        reader = asyncio.Event()
+
+        async def write_frame(frame):
+            written.append(frame)
+            await reader.wait()
+
+        queue = OutboundQueue(write_frame, max_size=3, high_water=3, slow_timeout=10, on_slow=lambda: closed.append(True))
+        self.addCleanup(queue.close)
+        queue.put('a')
+        await asyncio.sleep(0)
+        # 'a' is being written; the presence frames make way for newer frames
+        self.assertEqual(
+            [queue.put(frame, droppable=frame.startswith('p')) for frame in ('p1', 'b', 'c', 'p2', 'd', 'p3')],
+            [True, True, True, False, False, False],
+        )
+        self.assertEqual(queue.dropped, 3)
+        self.assertEqual(closed, [])
+
+        # A chat message or ack is never dropped; the socket is closed instead
+        with self.assertLogs('chat.outbox', 'WARNING'):
+            self.assertFalse(queue.put('e'))
+        self.assertFalse(queue.put('f'))
+        self.assertEqual(closed, [True])
+
+        reader.set()
+        for _ in range(10):
+            await asyncio.sleep(0)
+        self.assertEqual(written, ['a', 'b', 'c', 'd'])
+
+    async def test_slow_consumer_is_disconnected_once(self):
+        closed = []
+
+        async def write_frame(frame):
+            await asyncio.Event().wait()
+
+        queue = OutboundQueue(write_frame, max_size=100, high_water=2, slow_timeout=10, on_slow=lambda: closed.append(True))
+        self.addCleanup(queue.close)
+        queue.put('writing')
+        await asyncio.sleep(0)
+        slow_disconnects = overload_stats['slow_disconnects']
+
+        for frame in range(3):
+            queue.put(frame)
+        self.now += 5
+        queue.put('behind, but not for long enough')
+        self.assertEqual(closed, [])
+
+        self.now += 6
+        with self.assertLogs('chat.outbox', 'WARNING'):
+            queue.put('too far behind')
+        queue.put('still behind')
+        self.assertEqual(closed, [True])
+        self.assertEqual(overload_stats['slow_disconnects'], slow_disconnects + 1)
+
+
+@override_settings(**BENCHMARK_SETTINGS)
+class ReplayTests(TransactionTestCase):
+    """Reconnect replay resolves a batch's senders and thumbnails together"""
+
+    def setUp(self):
+        get_presence_store.cache_clear()
+        profile_cache.clear()
+        self.addCleanup(get_presence_store.cache_clear)
+        self.addCleanup(profile_cache.clear)
+        self.user = User.objects.create(username='reconnecting')
+        self.profile = UserProfile.objects.create(user=self.user)
+        thumbnails = mock.patch('chat.repository.thumbnail_url', lambda path, size: f'/thumbs/{size}/{path}')
+        thumbnails.start()
+        self.addCleanup(thumbnails.stop)
+
+    def receive_from(self, senders, media=None):
+        for i in range(senders):
+            sender = UserProfile.objects.create(user=User.objects.create(username=f'{self.profile.id}.{senders}.{i}'))
+            Message.objects.create(sender=sender, receiver=self.profile, content=f'missed {i}', media=media)
+
+    def test_queries_do_not_grow_with_senders(self):
+        def replay_queries(senders):
+            self.receive_from(senders)
+            profile_cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                replayed = async_to_sync(missed_messages)(self.profile.id, 0, 100)
+            self.assertEqual(len(replayed), Message.objects.filter(receiver=self.profile).count())
+            return len(queries)
+
+        self.assertEqual(replay_queries(2), replay_queries(5))
+
+    def test_sync_frames_carry_senders_and_thumbnails(self):
+        blob = MediaBlob.objects.create(digest='1' * 64, path='media/cas/11/11/blob.png', size=1)
+        self.receive_from(2, media=blob)
+
+        async def replay():
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), '/ws/chat/?since=0')
+            communicator.scope['user'] = self.user
+            await communicator.connect()
+            try:
+                while True:
+                    event = json.loads(await communicator.receive_from(timeout=5))
+                    if event['type'] == 'sync':
+                        return event
+            finally:
+                await communicator.disconnect()
+
+        event = asyncio.run(replay())
+        self.assertTrue(event['done'])
+        self.assertEqual([message['message'] for message in event['messages']], ['missed 0', 'missed 1'])
+        self.assertEqual(
+            [message['sender'] for message in event['messages']],
+            [f'{self.profile.id}.2.0', f'{self.profile.id}.2.1'],
+        )
+        self.assertEqual({message['thumbnail_url'] for message in event['messages']}, {f'/thumbs/preview/{blob.path}'})
+
+
+class ConnectionCheckTests(SimpleTestCase):
+    async def test_consumer_events_recycle_connections_once_a_second(self):
+        now = 1000.0
+        with mock.patch('chat.consumers.time.monotonic', lambda: now), \
+                mock.patch('chat.consumers.close_old_connections') as close_old_connections, \
+                mock.patch.object(consumers, '_connections_checked_at', None):
+            await consumers.check_connections()
+            await consumers.check_connections()
+            self.assertEqual(close_old_connections.call_count, 1)
+            now += consumers.CONNECTION_CHECK_SECONDS
+            await consumers.check_connections()
+            self.assertEqual(close_old_connections.call_count, 2)
+
+
+@override_settings(
+    DATABASE_REPLICAS=['replica0'],
+    REPLICA_STICKY_SECONDS=60,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+)
+class ReplicaReadTests(TransactionTestCase):
+    """Views read from the replica (a test mirror of the primary) until their user or room writes"""
+    # Every alias once setUpClass has added the mirror
+    databases = '__all__'
+
+    @classmethod
+    def setUpClass(cls):
+        # Without DATABASE_REPLICA_URLS there is no 'replica0'; add one for
+        # these tests, with its own connection to the test database
+        if 'replica0' not in connections.settings:
+            connections.settings['replica0'] = dict(connections['default'].settings_dict)
+            cls.addClassCleanup(cls.remove_mirror)
+        super().setUpClass()
+
+    @classmethod
+    def remove_mirror(cls):
+        connections['replica0'].close()
+        del connections['replica0']
+        del connections.settings['replica0']
+
+    def setUp(self):
+        cache.clear()
+        profile_cache.clear()
+        self.addCleanup(profile_cache.clear)
+        self.user = User.objects.create(username='reader')
+        self.me = UserProfile.objects.create(user=self.user)
+        self.peer = UserProfile.objects.create(user=User.objects.create(username='writer'))
+        self.room = Room.objects.create(name='room', created_by=self.me)
+        RoomMembership.objects.bulk_create([
+            RoomMembership(room=self.room, profile=self.me), RoomMembership(room=self.room, profile=self.peer),
+        ])
+        Message.objects.create(sender=self.peer, receiver=self.me, content='hello there')
+        self.client.force_login(self.user)
+
+    def reads(self, url, params=None):
+        """Queries the view sent to (primary, replica), by table"""
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica0']) as replica:
+            self.assertEqual(self.client.get(url, params).status_code, 200)
+        return (
+            ' '.join(query['sql'] for query in primary),
+            ' '.join(query['sql'] for query in replica),
+        )
+
+    def test_reads_stick_to_the_primary_after_a_send(self):
+        search = reverse('search')
+        primary, replica = self.reads(search, {'q': 'hello'})
+        self.assertIn('chat_message_fts', replica)
+        self.assertNotIn('chat_message_fts', primary)
+
+        async_to_sync(create_message)(self.me.id, self.peer.id, 'hello back', None, None)
+        primary, replica = self.reads(search, {'q': 'hello'})
+        self.assertIn('chat_message_fts', primary)
+        self.assertEqual(replica, '')
+
+    def test_room_sticks_to_the_primary_for_every_member(self):
+        history = reverse('get_room_messages', args=[self.room.id])
+        primary, replica = self.reads(history)
+        self.assertIn('chat_roommessage', replica)
+
+        # Another member posts; this reader has written nothing
+        async_to_sync(acreate_room_message)(self.room.id, self.peer.id, 'news', None, None)
+        primary, replica = self.reads(history)
+        self.assertIn('chat_roommessage', primary)
+        self.assertNotIn('chat_roommessage', replica)
@@ -0,0 +1,160 @@
+import io
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+logger = logging.getLogger(__name__)
+
+# Longest edge in pixels of each derivative
+THUMBNAIL_SIZES = {
+    'avatar': 96,
+    'preview': 480,
+    'large': 1280,
+}
+DEFAULT_AVATAR = '/static/images/profile-icon.png'
+
+# Derivatives already known to exist in storage, so repeated lookups skip
+# the storage round trip. Bounded by clearing once it grows too large.
+_known = set()
+_KNOWN_MAX = 10000
+_pending = set()
+_lock = threading.Lock()
+_process_pool = None
+_scheduler = ThreadPoolExecutor(max_workers=2, thread_name_prefix='thumbnails')
+
+
+def render_thumbnail(data, max_px):
+    """Resize image bytes to fit ``max_px`` and re-encode them as WebP"""
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_px, max_px))
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        output = io.BytesIO()
+        image.save(output, 'WEBP', quality=80, method=4)
+        return output.getvalue()
+
+
+def thumbnail_path(source_path, size):
+    """Deterministic storage path of a derivative, e.g. thumbs/avatar/profile_pics/me.png.webp"""
+    # The source's extension stays in, so me.png and me.jpg do not collide
+    return f'thumbs/{size}/{source_path}.webp'
+
+
+def _get_process_pool():
+    global _process_pool
+    with _lock:
+        if _process_pool is None:
+            # Spawned workers keep Pillow's CPU time out of the web process
+            # and avoid forking a process that runs an event loop
+            _process_pool = ProcessPoolExecutor(
+                max_workers=settings.THUMBNAIL_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return _process_pool
+
+
+def generate_thumbnail(source_path, size, force=False):
+    """Create one derivative in storage (blocking) and return its path"""
+    path = thumbnail_path(source_path, size)
+    if force or not default_storage.exists(path):
+        with default_storage.open(source_path, 'rb') as source:
+            data = source.read()
+        thumbnail = _get_process_pool().submit(render_thumbnail, data, THUMBNAIL_SIZES[size]).result()
+        _store(path, thumbnail, replace=force)
+    _remember(path)
+    return path
+
+
+def _store(path, data, replace):
+    """Write a derivative at exactly ``path``, never under a renamed key"""
+    if replace:
+        try:
+            target = default_storage.path(path)
+        except NotImplementedError:
+            # Remote storage without local paths: free the key, then save
+            default_storage.delete(path)
+        else:
+            # Written aside and renamed, so readers never see a missing or
+            # half-written file
+            directory = os.path.dirname(target)
+            os.makedirs(directory, exist_ok=True)
+            fd, temp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            mode = getattr(default_storage, 'file_permissions_mode', None)
+            if mode is not None:
+                os.chmod(temp, mode)
+            os.replace(temp, target)
+            return
+    elif default_storage.exists(path):
+        # Another worker rendered the same source meanwhile
+        return
+    saved = default_storage.save(path, ContentFile(data))
+    if saved != path:
+        # Lost a race for the key; storage renamed ours, so keep theirs
+        default_storage.delete(saved)
+
+
+def _remember(path):
+    with _lock:
+        if len(_known) >= _KNOWN_MAX:
+            _known.clear()
+        _known.add(path)
+
+
+def _generate_in_background(source_path, size):
+    try:
+        generate_thumbnail(source_path, size)
+    except Exception:
+        logger.exception('Failed to generate %s thumbnail for %s', size, source_path)
+    finally:
+        with _lock:
+            _pending.discard((source_path, size))
+
+
+def thumbnail_url(source_path, size):
+    """
+    URL of a derivative of ``source_path``, generated lazily.
+
+    If the derivative does not exist yet it is queued for generation and the
+    original's URL is returned meanwhile. Call from sync code (a view or a
+    database_sync_to_async function): the first lookup may hit storage.
+    """
+    if not source_path:
+        return None
+
+    path = thumbnail_path(source_path, size)
+    if path in _known:
+        return default_storage.url(path)
+    if default_storage.exists(path):
+        _remember(path)
+        return default_storage.url(path)
+
+    with _lock:
+        queued = (source_path, size) in _pending
+        _pending.add((source_path, size))
+    if not queued:
+        _scheduler.submit(_generate_in_background, source_path, size)
+    return default_storage.url(source_path)
+
+
+def avatar_url(profile):
+    """Small profile picture for user lists and message bubbles"""
+    if profile.profile_picture:
+        return thumbnail_url(profile.profile_picture.name, 'avatar')
+    return DEFAULT_AVATAR
+
+
+def thumbnail_ready(source_path, size):
+    """Whether a derivative is known to exist (e.g. after a ``thumbnail_url`` lookup)"""
+    return thumbnail_path(source_path, size) in _known
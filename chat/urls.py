@@ -7,4 +7,13 @@ urlpatterns = [
     path('signup/', views.signup_view, name='signup'),
     path('logout/', views.logout_view, name='logout'),
     path('api/messages/', views.get_messages, name='get_messages'),
+    path('api/inbox/', views.get_inbox, name='get_inbox'),
+    path('api/users/', views.get_users, name='get_users'),
+    path('api/media/', views.upload_media, name='upload_media'),
+    path('api/search/', views.search, name='search'),
+    path('api/rooms/', views.rooms, name='rooms'),
+    path('api/rooms/<int:room_id>/messages/', views.get_room_messages, name='get_room_messages'),
+    path('api/rooms/<int:room_id>/members/', views.add_room_member, name='add_room_member'),
+    path('api/rooms/<int:room_id>/leave/', views.leave_room, name='leave_room'),
+    path('metrics', views.metrics, name='metrics'),
 ]
\ No newline at end of file
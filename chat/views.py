@@ -1,12 +1,15 @@
-from django.http import JsonResponse
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import render, redirect
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib import messages
-from django.db.models import Q
+from django.db import transaction
+from django.utils.crypto import constant_time_compare
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
 from channels.layers import get_channel_layer
@@ -15,61 +18,376 @@ import json
 import base64
 import uuid
 import os
-from .models import Message, UserProfile
+from .db_router import replica_reads
+from .forms import ImageUploadForm, RoomForm, RoomMemberForm
+from .media import store_upload
+from .metrics import GET_MESSAGES_SECONDS, registry
+from .models import Conversation, Message, Room, RoomMembership, RoomMessage, UserProfile
+from .pagination import DEFAULT_PAGE_SIZE, InvalidCursor, paginate_keyset, parse_page_size
+from .presence import get_presence_store
+from .profiles import get_identities, get_identity, get_identity_for_user
+from .profiling import profiled
+from .recent import head_page, message_item
+from .repository import CHAT_VIEW_CONVERSATIONS, conversation_messages, other_profiles
+from .rooms import JOINED_EVENT, get_member_ids, invalidate_members, notify_member
+from .search import SearchUnavailable, search_messages
+from .thumbnails import avatar_url, thumbnail_url
+
 
 
 @login_required
+@replica_reads
+@profiled('http.chat_view')
 def chat_view(request):
-    # Get the user profile of the current user
-    user_profile = UserProfile.objects.get(user=request.user)
+    # Render a bounded shell: the first page of conversations plus the
+    # selected thread (?with=<profile id>), whatever the account's age.
+    # Older conversations, the user directory and older messages are
+    # loaded lazily through the JSON APIs.
+    user_profile = get_identity_for_user(request.user)
+
+    conversations, _ = paginate_keyset(
+        Conversation.objects.for_profile(user_profile),
+        limit=CHAT_VIEW_CONVERSATIONS,
+        field='last_activity',
+    )
+    # Most recent conversation first, flagged with a single presence lookup
+    users = [conversation.peer_of(user_profile) for conversation in reversed(conversations)]
+    online_ids = get_presence_store().online_ids(profile.id for profile in users)
+    for profile in users:
+        profile.online = profile.id in online_ids
+        profile.avatar_url = avatar_url(profile)
+
+    selected_thread = None
+    receiver_profile = get_identity(request.GET.get('with'))
+    if receiver_profile is not None:
+        message_list, thread_page = conversation_page(user_profile, receiver_profile)
+        selected_thread = {
+            'id': receiver_profile.id,
+            'username': receiver_profile.username,
+            'messages': message_list,
+            **thread_page,
+        }
+
+    return render(request, 'chat.html', {
+        'users': users,
+        'selected_thread': selected_thread,
+    })
 
-    # Get all other user profiles
-    users = UserProfile.objects.exclude(user=request.user)
 
-    # Get messages involving the current user profile
-    messages = Message.objects.filter(
-        Q(sender=user_profile) | Q(receiver=user_profile)
-    ).select_related('sender__user', 'receiver__user').order_by('timestamp')
+def conversation_page(user_profile, receiver_profile, before=None, after=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    One page of the messages between two profiles, serialized for the
+    client. Raises InvalidCursor for a bad cursor. Opening the conversation
+    at its newest page marks it as read.
+    """
+    usernames = {user_profile.id: user_profile.username, receiver_profile.id: receiver_profile.username}
+    conversation_key = Message.conversation_key_for(user_profile.id, receiver_profile.id)
 
-    return render(request, 'chat.html', {'users': users, 'messages': messages})
+    # The head page usually comes from the recent-messages cache
+    cached = None
+    if not before and not after:
+        cached = head_page(conversation_key, limit)
+        Conversation.objects.mark_read(user_profile.id, receiver_profile.id)
+
+    if cached is not None:
+        items, page = cached
+    else:
+        messages, page = paginate_keyset(conversation_messages(conversation_key), before=before, after=after, limit=limit)
+        items = [message_item(message) for message in messages]
+
+    # Convert messages to JSON-serializable format
+    message_list = []
+    for item in items:
+        message_dict = {
+            'id': item['id'],
+            'content': item['content'],
+            'timestamp': item['timestamp'],
+            'sender': usernames[item['sender_id']],
+            'image_url': item['image_url'],
+            'thumbnail_url': thumbnail_url(item['media_path'], 'preview') if item['media_path'] else item['image_url'],
+        }
+
+        message_list.append(message_dict)
+    return message_list, page
 
 
 @login_required
+@GET_MESSAGES_SECONDS.time()
+@replica_reads
+@profiled('http.get_messages')
 def get_messages(request):
-    # API endpoint to get messages for a specific receiver
+    # API endpoint to get a page of messages for a specific receiver.
+    # Pages are newest first; pass ?before=<cursor> for older messages,
+    # ?after=<cursor> for newer ones and ?limit=N for the page size.
     receiver_id = request.GET.get('receiver')
 
     if not receiver_id:
         return JsonResponse({'error': 'Receiver ID is required'}, status=400)
 
-    try:
-        # Get the current user's profile
-        sender_profile = UserProfile.objects.get(user=request.user)
-        # Get the receiver's profile
-        receiver_profile = UserProfile.objects.get(id=receiver_id)
-    except UserProfile.DoesNotExist:
+    # Get the current user's and the receiver's profiles (cached)
+    sender_profile = get_identity_for_user(request.user)
+    receiver_profile = get_identity(receiver_id)
+    if receiver_profile is None:
         return JsonResponse({'error': 'Receiver not found'}, status=404)
 
-    # Get messages between current user and selected receiver
-    messages = Message.objects.filter(
-        (Q(sender=sender_profile) & Q(receiver=receiver_profile)) |
-        (Q(sender=receiver_profile) & Q(receiver=sender_profile))
-    ).select_related('sender__user', 'receiver__user').order_by('timestamp')
+    try:
+        message_list, page = conversation_page(
+            sender_profile,
+            receiver_profile,
+            before=request.GET.get('before'),
+            after=request.GET.get('after'),
+            limit=parse_page_size(request.GET.get('limit')),
+        )
+    except InvalidCursor as e:
+        return JsonResponse({'error': str(e)}, status=400)
 
-    # Convert messages to JSON-serializable format
+    return JsonResponse({'messages': message_list, **page})
+
+
+@login_required
+@replica_reads
+@profiled('http.get_users')
+def get_users(request):
+    # API endpoint for the user directory, in pages of ?limit=N profiles
+    # ordered by ID; pass ?after=<id> (the previous page's "after") for more
+    user_profile = get_identity_for_user(request.user)
+    try:
+        after = int(request.GET.get('after', 0))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+    limit = parse_page_size(request.GET.get('limit'))
+
+    profiles = list(other_profiles(user_profile.id).filter(id__gt=after).order_by('id')[:limit + 1])
+    has_more = len(profiles) > limit
+    profiles = profiles[:limit]
+    online_ids = get_presence_store().online_ids(profile.id for profile in profiles)
+
+    user_list = [
+        {
+            'id': profile.id,
+            'username': profile.user.username,
+            'profile_picture': avatar_url(profile),
+            'is_online': profile.id in online_ids,
+        }
+        for profile in profiles
+    ]
+    return JsonResponse({
+        'users': user_list,
+        'after': profiles[-1].id if has_more else None,
+        'has_more': has_more,
+    })
+
+
+@login_required
+@replica_reads
+@profiled('http.search')
+def search(request):
+    # API endpoint for full-text search over the current user's messages,
+    # best match first. Pass ?q=<words>, ?limit=N and ?offset=M for paging.
+    user_profile = get_identity_for_user(request.user)
+    limit = parse_page_size(request.GET.get('limit'))
+    try:
+        offset = max(0, int(request.GET.get('offset', 0)))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid offset'}, status=400)
+
+    try:
+        results, has_more = search_messages(user_profile.id, request.GET.get('q', ''), limit=limit, offset=offset)
+    except SearchUnavailable as e:
+        return JsonResponse({'error': str(e)}, status=501)
+
+    senders = get_identities(message.sender_id for message, _ in results)
+    result_list = []
+    for message, rank in results:
+        peer_id = message.receiver_id if message.sender_id == user_profile.id else message.sender_id
+        result_list.append({
+            'id': message.id,
+            'content': message.content,
+            'timestamp': message.timestamp.isoformat(),
+            'sender': senders[message.sender_id].username,
+            'sender_id': message.sender_id,
+            'receiver_id': message.receiver_id,
+            'peer_id': peer_id,
+            'image_url': message.image_url if message.image_url else None,
+            'rank': rank,
+        })
+
+    return JsonResponse({
+        'results': result_list,
+        'next_offset': offset + len(result_list) if has_more else None,
+        'has_more': has_more,
+    })
+
+
+@login_required
+@profiled('http.get_inbox')
+def get_inbox(request):
+    # API endpoint listing the current user's conversations, most recently
+    # active first. Pass ?before=<cursor> for the next page.
+    user_profile = get_identity_for_user(request.user)
+
+    try:
+        conversations, page = paginate_keyset(
+            Conversation.objects.for_profile(user_profile),
+            before=request.GET.get('before'),
+            limit=parse_page_size(request.GET.get('limit')),
+            field='last_activity',
+        )
+    except InvalidCursor as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    peers = [conversation.peer_of(user_profile) for conversation in conversations]
+    online_ids = get_presence_store().online_ids(peer.id for peer in peers)
+
+    conversation_list = []
+    for conversation, peer in reversed(list(zip(conversations, peers))):
+        last_message = conversation.last_message
+        conversation_list.append({
+            'id': peer.id,
+            'username': peer.user.username,
+            'profile_picture': avatar_url(peer),
+            'is_online': peer.id in online_ids,
+            'last_activity': conversation.last_activity.isoformat(),
+            'unread': conversation.unread_for(user_profile),
+            'last_message': {
+                'id': last_message.id,
+                'content': last_message.content,
+                'sender_id': last_message.sender_id,
+                'image_url': last_message.image_url if last_message.image_url else None,
+                'timestamp': last_message.timestamp.isoformat(),
+            } if last_message else None,
+        })
+
+    return JsonResponse({'conversations': conversation_list, 'before': page['before'], 'has_more': page['has_more']})
+
+
+@login_required
+@require_POST
+def upload_media(request):
+    # API endpoint for chat images; the returned media_id is sent with the
+    # chat message over the WebSocket instead of the image bytes
+    form = ImageUploadForm(request.POST, request.FILES)
+    if not form.is_valid():
+        return JsonResponse({'error': form.errors['image'][0]}, status=400)
+
+    user_profile = get_identity_for_user(request.user)
+    media_id, url = store_upload(form.cleaned_data['image'], user_profile.id)
+    return JsonResponse({'media_id': media_id, 'url': url}, status=201)
+
+
+@login_required
+def rooms(request):
+    # GET lists the current user's rooms, most recently active first
+    # (?before=<cursor> for the next page); POST creates a room with the
+    # current user and the given members in it
+    user_profile = get_identity_for_user(request.user)
+
+    if request.method == 'POST':
+        form = RoomForm(request.POST)
+        if not form.is_valid():
+            return JsonResponse({'errors': form.errors}, status=400)
+        member_ids = {user_profile.id} | {profile.id for profile in form.cleaned_data['members']}
+        with transaction.atomic():
+            room = Room.objects.create(name=form.cleaned_data['name'], created_by_id=user_profile.id)
+            # bulk_create skips the membership signals, so the cached member
+            # list is dropped and the new members' consumers are told to join
+            # the room's group explicitly
+            RoomMembership.objects.bulk_create(
+                RoomMembership(room=room, profile_id=profile_id) for profile_id in member_ids
+            )
+            invalidate_members(room.id)
+
+            def joined():
+                invalidate_members(room.id)
+                for profile_id in member_ids:
+                    notify_member(profile_id, JOINED_EVENT, room.id)
+
+            transaction.on_commit(joined)
+        return JsonResponse({'id': room.id, 'name': room.name, 'members': sorted(member_ids)}, status=201)
+
+    try:
+        user_rooms, page = paginate_keyset(
+            Room.objects.filter(memberships__profile_id=user_profile.id),
+            before=request.GET.get('before'),
+            limit=parse_page_size(request.GET.get('limit')),
+            field='last_activity',
+        )
+    except InvalidCursor as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    room_list = [
+        {
+            'id': room.id,
+            'name': room.name,
+            'last_activity': room.last_activity.isoformat(),
+        }
+        for room in reversed(user_rooms)
+    ]
+    return JsonResponse({'rooms': room_list, 'before': page['before'], 'has_more': page['has_more']})
+
+
+@login_required
+@replica_reads
+def get_room_messages(request, room_id):
+    # API endpoint for a page of a room's history, newest first like
+    # get_messages; only members can read it
+    user_profile = get_identity_for_user(request.user)
+    if user_profile.id not in get_member_ids(room_id):
+        return JsonResponse({'error': 'Room not found'}, status=404)
+
+    try:
+        messages, page = paginate_keyset(
+            RoomMessage.objects.filter(room_id=room_id).select_related('media'),
+            before=request.GET.get('before'),
+            after=request.GET.get('after'),
+            limit=parse_page_size(request.GET.get('limit')),
+        )
+    except InvalidCursor as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    # Senders of the whole page in (at most) one query
+    senders = get_identities(message.sender_id for message in messages)
     message_list = []
     for message in messages:
-        message_dict = {
+        sender = senders[message.sender_id]
+        message_list.append({
             'id': message.id,
+            'room_id': message.room_id,
             'content': message.content,
             'timestamp': message.timestamp.isoformat(),
-            'sender': message.sender.user.username,
+            'sender': sender.username,
+            'sender_id': message.sender_id,
+            'sender_profile_picture': sender.avatar_url,
             'image_url': message.image_url if message.image_url else None,
-        }
+            'thumbnail_url': thumbnail_url(message.media.path, 'preview') if message.media else message.image_url,
+        })
+
+    return JsonResponse({'messages': message_list, **page})
 
-        message_list.append(message_dict)
 
-    return JsonResponse(message_list, safe=False)
+@login_required
+@require_POST
+def add_room_member(request, room_id):
+    # Any member can add another profile to the room
+    user_profile = get_identity_for_user(request.user)
+    if user_profile.id not in get_member_ids(room_id):
+        return JsonResponse({'error': 'Room not found'}, status=404)
+
+    form = RoomMemberForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    membership, created = RoomMembership.objects.get_or_create(room_id=room_id, profile=form.cleaned_data['profile'])
+    return JsonResponse({'room_id': room_id, 'profile_id': membership.profile_id}, status=201 if created else 200)
+
+
+@login_required
+@require_POST
+def leave_room(request, room_id):
+    user_profile = get_identity_for_user(request.user)
+    # Deleted one by one so the membership signals fire
+    for membership in RoomMembership.objects.filter(room_id=room_id, profile_id=user_profile.id):
+        membership.delete()
+    return JsonResponse({'room_id': room_id, 'left': True})
 
 
 def login_view(request):
@@ -107,4 +425,17 @@ def signup_view(request):
 
 def logout_view(request):
     logout(request)
-    return redirect('login')
\ No newline at end of file
+    return redirect('login')
+
+
+def metrics(request):
+    # Prometheus scrape endpoint, adding up every worker's metrics. Outside
+    # DEBUG it is only served to scrapes that send METRICS_TOKEN
+    if not settings.METRICS_TOKEN:
+        if not settings.DEBUG:
+            return HttpResponse(status=404)
+    elif not constant_time_compare(
+        request.headers.get('Authorization', ''), f'Bearer {settings.METRICS_TOKEN}'
+    ):
+        return HttpResponse(status=401)
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
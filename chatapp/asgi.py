@@ -18,9 +18,11 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatapp.settings')
 django_app = get_asgi_application()
 
 from chat import routing
+from chat.persistence import LifespanApp
 
 application = ProtocolTypeRouter({
     "http": django_app,
+    "lifespan": LifespanApp(),
     "websocket": AuthMiddlewareStack(
         URLRouter(
           routing.websocket_urlpatterns
@@ -8,11 +8,24 @@ let pingInterval = null;
 let reconnectAttempts = 0;
 let selectedImageFile = null;
 let selectedImageData = null;
+let olderMessagesCursor = null;
+let presenceVersion = null;
+let selfProfileId = null;
+let loadingOlderMessages = false;
+// Cursor of the next /api/users/ page; null once the directory is loaded
+let usersCursor = 0;
+let loadingUsers = false;
+// Newest message ID received over the socket, sent back on reconnect so
+// the server replays only what was missed
+let lastMessageId = null;
+let seenMessageIds = new Set();
 const MAX_RECONNECT_ATTEMPTS = 5;
 
 // Initialize WebSocket connection
 function connectWebSocket() {
-  ws = new WebSocket(`${protocol}//${window.location.host}/ws/chat/`);
+  const since = lastMessageId !== null ? `?since=${lastMessageId}` : '';
+  ws = new WebSocket(`${protocol}//${window.location.host}/ws/chat/${since}`);
+  seenMessageIds = new Set();
 
   ws.onopen = () => {
     console.log('WebSocket connection established');
@@ -54,24 +67,37 @@ function connectWebSocket() {
       }
 
       if (data.type === 'status_update') {
+        presenceVersion = data.version;
+        selfProfileId = data.self_id;
         updateUserStatuses(data.users);
         return;
       }
 
+      if (data.type === 'presence') {
+        applyPresenceDelta(data);
+        return;
+      }
+
       if (data.type === 'user_status') {
         updateUserStatus(data.username, data.status);
         return;
       }
 
-      if (data.type === 'chat_message') {
-        if (
-          data.sender === loggedInUser ||
-          (selectedUser && data.sender === selectedUser.username) ||
-          (currentReceiverId && data.sender_id === parseInt(currentReceiverId)) ||
-          (currentReceiverId && data.receiver_id === parseInt(currentReceiverId))
-        ) {
-          onChatMessage(data, loggedInUser, chatMessages);
+      if (data.type === 'sync') {
+        data.messages.forEach((message) => handleChatMessage(message, loggedInUser, chatMessages));
+        lastMessageId = Math.max(lastMessageId || 0, data.last_id);
+        if (data.truncated) {
+          // Too much was missed to replay; reload the open conversation
+          showNotification('Missed too many messages while offline, reloading chat.', 'info');
+          if (currentReceiverId) {
+            selectUser(currentReceiverId, currentUsername);
+          }
         }
+        return;
+      }
+
+      if (data.type === 'chat_message') {
+        handleChatMessage(data, loggedInUser, chatMessages);
       }
     } catch (error) {
       console.error('Error processing message:', error);
@@ -114,19 +140,26 @@ function connectWebSocket() {
   };
 }
 
-// Filter users when typing in search
-document.getElementById('user-search').addEventListener('input', (e) => {
-  const searchTerm = e.target.value.toLowerCase();
+function filterUsers() {
+  const searchTerm = document.getElementById('user-search').value.toLowerCase();
   document.querySelectorAll('.user-item').forEach((item) => {
     const username = item.getAttribute('data-username').toLowerCase();
     item.style.display = username.includes(searchTerm) ? 'flex' : 'none';
   });
+}
+
+// Filter users when typing in search; the rest of the directory is only
+// loaded once someone searches or scrolls past the conversations
+document.getElementById('user-search').addEventListener('input', () => {
+  filterUsers();
+  loadUsers();
 });
 
-function selectUser(userId, username) {
+function selectUser(userId, username, preloadedPage = null) {
   currentReceiverId = userId;
   currentUsername = username;
   selectedUser = { id: userId, username };
+  olderMessagesCursor = null;
 
   // Update UI
   document.getElementById('receiver-id').value = userId;
@@ -168,20 +201,23 @@ function selectUser(userId, username) {
     </div>
   `;
 
-  // Fetch and display messages
-  fetch(`/api/messages/?receiver=${userId}`)
-    .then((response) => {
-      if (!response.ok) {
-        throw new Error(`HTTP error! status: ${response.status}`);
-      }
-      return response.json();
-    })
+  // Display the newest page of messages, rendered into the page by the
+  // server for the thread selected on load and fetched otherwise
+  const newestPage = preloadedPage
+    ? Promise.resolve(preloadedPage)
+    : fetch(`/api/messages/?receiver=${userId}`).then((response) => {
+        if (!response.ok) {
+          throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        return response.json();
+      });
+  newestPage
     .then((data) => {
-      console.log('Response Data:', JSON.stringify(data));
       chatMessages.innerHTML = '';
       const loggedInUser = chatMessages.dataset.username;
+      olderMessagesCursor = data.before;
 
-      if (data.length === 0) {
+      if (data.messages.length === 0) {
         chatMessages.innerHTML = `
           <div class="flex justify-center items-center h-full">
             <p class="text-gray-500">No messages yet. Start a conversation!</p>
@@ -190,35 +226,8 @@ function selectUser(userId, username) {
         return;
       }
 
-      data.forEach((message) => {
-        const messageDiv = document.createElement('div');
-        messageDiv.className = message.sender === loggedInUser
-          ? 'flex justify-end mb-3 px-3'
-          : 'flex justify-start mb-3 px-3';
-
-        let contentHtml = '';
-        if (message.image_url) {
-          contentHtml += `
-            <img src="${message.image_url}" width="350" alt="Uploaded Image" 
-                 class="w-[60px] h-auto rounded-lg shadow-sm object-cover mb-1">
-          `;
-        }
-        if (message.content) {
-          contentHtml += `<p class="text-sm leading-relaxed">${message.content}</p>`;
-        }
-
-        const timestamp = new Date(message.timestamp).toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' });
-
-        messageDiv.innerHTML = `
-          <div class="inline-block p-3 rounded-xl shadow-sm transition-all duration-200 hover:shadow-md 
-                      ${message.sender === loggedInUser ? 'bg-green-100' : 'bg-white'}">
-            ${contentHtml}
-            <p class="text-xs text-gray-500 mt-1 text-${message.sender === loggedInUser ? 'right' : 'left'}">
-              ${timestamp}
-            </p>
-          </div>
-        `;
-        chatMessages.appendChild(messageDiv);
+      data.messages.forEach((message) => {
+        chatMessages.appendChild(createHistoryMessage(message, loggedInUser));
       });
       chatMessages.scrollTop = chatMessages.scrollHeight;
     })
@@ -237,6 +246,74 @@ function selectUser(userId, username) {
     });
 }
 
+function createHistoryMessage(message, loggedInUser) {
+  const messageDiv = document.createElement('div');
+  messageDiv.className = message.sender === loggedInUser
+    ? 'flex justify-end mb-3 px-3'
+    : 'flex justify-start mb-3 px-3';
+
+  let contentHtml = '';
+  if (message.image_url) {
+    contentHtml += `
+      <a href="${message.image_url}" target="_blank">
+        <img src="${message.thumbnail_url || message.image_url}" width="350" alt="Uploaded Image" 
+             class="w-[60px] h-auto rounded-lg shadow-sm object-cover mb-1">
+      </a>
+    `;
+  }
+  if (message.content) {
+    contentHtml += `<p class="text-sm leading-relaxed">${message.content}</p>`;
+  }
+
+  const timestamp = new Date(message.timestamp).toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' });
+
+  messageDiv.innerHTML = `
+    <div class="inline-block p-3 rounded-xl shadow-sm transition-all duration-200 hover:shadow-md 
+                ${message.sender === loggedInUser ? 'bg-green-100' : 'bg-white'}">
+      ${contentHtml}
+      <p class="text-xs text-gray-500 mt-1 text-${message.sender === loggedInUser ? 'right' : 'left'}">
+        ${timestamp}
+      </p>
+    </div>
+  `;
+  return messageDiv;
+}
+
+// Load the next older page when the user scrolls to the top of the thread
+function loadOlderMessages() {
+  if (!olderMessagesCursor || loadingOlderMessages || !currentReceiverId) return;
+
+  const receiverId = currentReceiverId;
+  loadingOlderMessages = true;
+  fetch(`/api/messages/?receiver=${receiverId}&before=${encodeURIComponent(olderMessagesCursor)}`)
+    .then((response) => {
+      if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+      }
+      return response.json();
+    })
+    .then((data) => {
+      if (receiverId !== currentReceiverId) return;
+
+      const chatMessages = document.getElementById('chat-messages');
+      const loggedInUser = chatMessages.dataset.username;
+      const previousHeight = chatMessages.scrollHeight;
+      const fragment = document.createDocumentFragment();
+      data.messages.forEach((message) => {
+        fragment.appendChild(createHistoryMessage(message, loggedInUser));
+      });
+      chatMessages.insertBefore(fragment, chatMessages.firstChild);
+      chatMessages.scrollTop = chatMessages.scrollHeight - previousHeight;
+      olderMessagesCursor = data.before;
+    })
+    .catch((error) => {
+      console.error('Error fetching older messages:', error);
+    })
+    .finally(() => {
+      loadingOlderMessages = false;
+    });
+}
+
 function handleImageUpload() {
   const fileInput = document.getElementById('image-file');
   const imageUploadBtn = document.getElementById('image-upload-btn');
@@ -319,16 +396,17 @@ function sendMessage(event) {
   chatMessages.appendChild(tempMessageDiv);
   chatMessages.scrollTop = chatMessages.scrollHeight;
 
-  const sendWebSocketMessage = (imageBase64 = '') => {
+  const sendWebSocketMessage = (mediaId = null) => {
     if (ws && ws.readyState === WebSocket.OPEN) {
       const messageData = {
         type: 'chat_message',
         receiver_id: parseInt(receiverId),
-        message: message || '',
-        image_base64: imageBase64
+        message: message || ''
       };
+      if (mediaId) {
+        messageData.media_id = mediaId;
+      }
 
-      console.log(messageData);
       ws.send(JSON.stringify(messageData));
       messageInput.value = '';
       if (selectedImageFile) {
@@ -343,22 +421,55 @@ function sendMessage(event) {
   };
 
   if (selectedImageFile) {
-    const reader = new FileReader();
-    reader.onload = (e) => {
-      const base64String = e.target.result.split(',')[1];
-      sendWebSocketMessage(base64String);
-    };
-    reader.onerror = (e) => {
-      console.error('Error reading image file:', e.toString());
-      tempMessageDiv.remove();
-      showNotification('Failed to process image. Please try again.', 'error');
-    };
-    reader.readAsDataURL(selectedImageFile);
+    // Upload the image over HTTP and reference it from the chat message
+    uploadImage(selectedImageFile)
+      .then((upload) => sendWebSocketMessage(upload.media_id))
+      .catch((error) => {
+        console.error('Error uploading image:', error);
+        tempMessageDiv.remove();
+        showNotification(`Failed to upload image: ${error.message}`, 'error');
+      });
   } else {
     sendWebSocketMessage();
   }
 }
 
+function uploadImage(file) {
+  const formData = new FormData();
+  formData.append('image', file);
+
+  return fetch('/api/media/', {
+    method: 'POST',
+    body: formData,
+    headers: { 'X-CSRFToken': document.querySelector('[name=csrfmiddlewaretoken]').value },
+  }).then((response) => response.json().then((data) => {
+    if (!response.ok) {
+      throw new Error(data.error || `HTTP error! status: ${response.status}`);
+    }
+    return data;
+  }));
+}
+
+function handleChatMessage(data, loggedInUser, chatMessages) {
+  // A message can arrive both live and in the reconnect replay
+  if (data.id) {
+    if (seenMessageIds.has(data.id)) return;
+    seenMessageIds.add(data.id);
+    if (data.sender !== loggedInUser) {
+      lastMessageId = Math.max(lastMessageId || 0, data.id);
+    }
+  }
+
+  if (
+    data.sender === loggedInUser ||
+    (selectedUser && data.sender === selectedUser.username) ||
+    (currentReceiverId && data.sender_id === parseInt(currentReceiverId)) ||
+    (currentReceiverId && data.receiver_id === parseInt(currentReceiverId))
+  ) {
+    onChatMessage(data, loggedInUser, chatMessages);
+  }
+}
+
 function onChatMessage(data, loggedInUser, chatMessages) {
   if (data.sender === loggedInUser) {
     const sendingMessages = chatMessages.querySelectorAll('.opacity-60');
@@ -379,9 +490,11 @@ function onChatMessage(data, loggedInUser, chatMessages) {
   let contentHtml = '';
   if (imageUrl) {
     contentHtml += `
-      <img src="${imageUrl}" class="max-w-xs max-h-60 rounded" alt="Image" 
-           onerror="this.onerror=null; this.src='/static/images/image-placeholder.png'; this.classList.add('error-image'); 
-           this.parentElement.insertAdjacentHTML('beforeend', '<p class=\\'text-xs text-red-500 mt-1\\'>Image failed to load</p>');">
+      <a href="${imageUrl}" target="_blank">
+        <img src="${data.thumbnail_url || imageUrl}" class="max-w-xs max-h-60 rounded" alt="Image" 
+             onerror="this.onerror=null; this.src='/static/images/image-placeholder.png'; this.classList.add('error-image'); 
+             this.parentElement.insertAdjacentHTML('beforeend', '<p class=\\'text-xs text-red-500 mt-1\\'>Image failed to load</p>');">
+      </a>
     `;
   }
   if (messageContent) {
@@ -400,34 +513,16 @@ function onChatMessage(data, loggedInUser, chatMessages) {
   chatMessages.scrollTop = chatMessages.scrollHeight;
 }
 
+// Apply a presence snapshot ({id, is_online} for the users on the page)
+// to the list as it is; users not shown yet are skipped
 function updateUserStatuses(users) {
   const userList = document.getElementById('user-list');
   if (!userList) return;
 
-  const selectedUserId = document.querySelector('.user-item.bg-gray-200')?.getAttribute('data-user-id');
-
-  while (userList.firstChild) {
-    if (userList.firstChild.id !== 'users-loading') {
-      userList.removeChild(userList.firstChild);
-    } else if (userList.firstChild.id === 'users-loading' && users.length > 0) {
-      userList.removeChild(userList.firstChild);
-    }
-  }
-
-  const addedUsernames = new Set();
   users.forEach((user) => {
-    if (addedUsernames.has(user.username)) return;
-    addedUsernames.add(user.username);
-    createUserItem(userList, user);
+    const userItem = userList.querySelector(`.user-item[data-user-id="${user.id}"]`);
+    if (userItem) setItemStatus(userItem, user.is_online);
   });
-
-  if (selectedUserId) {
-    const selectedItem = userList.querySelector(`.user-item[data-user-id="${selectedUserId}"]`);
-    if (selectedItem) {
-      selectedItem.classList.add('bg-gray-200');
-    }
-  }
-
   sortUserList(userList);
 
   const receiverId = document.getElementById('receiver-id').value;
@@ -439,6 +534,50 @@ function updateUserStatuses(users) {
   }
 }
 
+function setItemStatus(userItem, isOnline) {
+  const statusIndicator = userItem.querySelector('.status-indicator');
+  statusIndicator.classList.remove('online', 'offline');
+  statusIndicator.classList.add(isOnline ? 'online' : 'offline');
+  userItem.querySelector('.user-status').textContent = isOnline ? 'Online' : 'Offline';
+}
+
+// Apply a single {id, is_online} presence change to the users on the
+// page; ask for a fresh snapshot of them when a version was skipped
+function applyPresenceDelta(delta) {
+  if (presenceVersion === null || delta.version <= presenceVersion) return;
+
+  const missedUpdates = delta.version !== presenceVersion + 1;
+  presenceVersion = delta.version;
+  if (delta.id === selfProfileId) {
+    if (missedUpdates) requestPresenceSync();
+    return;
+  }
+
+  const userItem = document.querySelector(`.user-item[data-user-id="${delta.id}"]`);
+  if (!userItem) {
+    // Not on the page; its status comes with it when it is loaded
+    if (missedUpdates) requestPresenceSync();
+    return;
+  }
+
+  setItemStatus(userItem, delta.is_online);
+  sortUserList(document.getElementById('user-list'));
+
+  const receiverId = document.getElementById('receiver-id').value;
+  if (receiverId && receiverId === delta.id.toString()) {
+    updateReceiverStatus({ is_online: delta.is_online });
+  }
+
+  if (missedUpdates) requestPresenceSync();
+}
+
+function requestPresenceSync() {
+  if (ws && ws.readyState === WebSocket.OPEN) {
+    const ids = Array.from(document.querySelectorAll('.user-item'), (item) => Number(item.getAttribute('data-user-id')));
+    ws.send(JSON.stringify({ type: 'presence_sync', ids }));
+  }
+}
+
 function updateReceiverStatus(user) {
   const receiverStatus = document.getElementById('receiver-status');
   const receiverStatusText = document.getElementById('receiver-status-text');
@@ -549,11 +688,13 @@ function showNotification(message, type = 'info') {
   }, 4000);
 }
 
+// Append the next page of the user directory to the list
 function loadUsers() {
-  console.log('Loading Users...');
   const userList = document.getElementById('user-list');
-  if (!userList || userList.children.length > 0) return;
+  if (!userList || usersCursor === null || loadingUsers) return;
+  loadingUsers = true;
 
+  document.getElementById('users-loading')?.remove();
   const loadingIndicator = document.createElement('div');
   loadingIndicator.id = 'users-loading';
   loadingIndicator.className = 'p-4 text-center';
@@ -564,9 +705,8 @@ function loadUsers() {
 
   userList.appendChild(loadingIndicator);
 
-  fetch('/api/users/')
+  fetch(`/api/users/?after=${usersCursor}`)
     .then((response) => {
-      console.log(response);
       if (!response.ok) {
         throw new Error(`HTTP error! status: ${response.status}`);
       }
@@ -578,9 +718,14 @@ function loadUsers() {
         loadingElem.remove();
       }
 
-      if (data.users) {
-        updateUserStatuses(data.users);
-      }
+      data.users.forEach((user) => {
+        if (!userList.querySelector(`.user-item[data-user-id="${user.id}"]`)) {
+          createUserItem(userList, user);
+        }
+      });
+      sortUserList(userList);
+      filterUsers();
+      usersCursor = data.has_more ? data.after : null;
     })
     .catch((error) => {
       console.error('Error loading users:', error);
@@ -593,6 +738,9 @@ function loadUsers() {
           </button>
         `;
       }
+    })
+    .finally(() => {
+      loadingUsers = false;
     });
 }
 
@@ -636,8 +784,8 @@ document.addEventListener('DOMContentLoaded', () => {
     handleImageUpload();
 
     const originalSelectUser = window.selectUser || selectUser;
-    window.selectUser = (userId, username) => {
-      originalSelectUser(userId, username);
+    window.selectUser = (userId, username, preloadedPage = null) => {
+      originalSelectUser(userId, username, preloadedPage);
       enableChatInput(true);
       document.getElementById('image-upload-btn').disabled = false;
     };
@@ -663,6 +811,27 @@ document.addEventListener('DOMContentLoaded', () => {
     }
   });
 
+  const userList = document.getElementById('user-list');
+  userList.addEventListener('scroll', () => {
+    if (userList.scrollTop + userList.clientHeight >= userList.scrollHeight - 50) {
+      loadUsers();
+    }
+  });
+
+  const chatMessages = document.getElementById('chat-messages');
+  chatMessages.addEventListener('scroll', () => {
+    if (chatMessages.scrollTop === 0) {
+      loadOlderMessages();
+    }
+  });
+
+  // Open the thread the server rendered into the page (?with=<profile id>)
+  const selectedThread = document.getElementById('selected-thread');
+  if (selectedThread) {
+    const thread = JSON.parse(selectedThread.textContent);
+    window.selectUser(thread.id, thread.username, thread);
+  }
+
   connectWebSocket();
 
   document.addEventListener('visibilitychange', () => {